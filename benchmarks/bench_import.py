@@ -0,0 +1,115 @@
+"""
+Import time benchmark for payments_redsys, using python -X importtime.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --json import.json
+    python -m benchmarks.bench_import --compare import.json --max-regression 0.25
+
+Every run imports payments_redsys in a fresh interpreter after django.http and
+django-payments, which any process using the provider loads anyway, so the
+time reported is what this package adds to a cold start. The exit
+status is 1 if a module that should only be loaded on first use (the REST
+client, the 3DES libraries, the forms) was imported, or, with --compare, if
+the import got slower than the baseline by more than --max-regression.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# modules that importing payments_redsys must not load
+LAZY_MODULES = (
+    "requests",
+    "httpx",
+    "pyDes",
+    "cryptography",
+    "payments.forms",
+    "payments_redsys.forms",
+    "payments_redsys.rest",
+)
+
+STATEMENT = "import django.http, payments.core; import payments_redsys"
+
+
+def import_times(statement=STATEMENT):
+    """Runs statement in a new interpreter, returning {module: (self, cumulative)}"""
+    env = {**os.environ}
+    env.setdefault("DJANGO_SETTINGS_MODULE", "sample.settings")
+    # measure imports from cached bytecode, as in a deployment
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run(runs):
+    import_times()  # writes the bytecode caches
+    cumulative = []
+    lazy_imported = set()
+    for _ in range(runs):
+        times = import_times()
+        cumulative.append(times["payments_redsys"][1])
+        lazy_imported.update(module for module in LAZY_MODULES if module in times)
+    return {
+        "runs": runs,
+        "min_ms": min(cumulative) / 1000,
+        "median_ms": statistics.median(cumulative) / 1000,
+        "lazy_imported": sorted(lazy_imported),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results file to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    result = run(args.runs)
+    line = (
+        f"import payments_redsys: min {result['min_ms']:.1f}ms"
+        f" median {result['median_ms']:.1f}ms ({result['runs']} runs)"
+    )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        change = result["median_ms"] / baseline["median_ms"] - 1
+        line += f" {change:+.1%}"
+    print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    status = 0
+    if result["lazy_imported"]:
+        print(f"Imported eagerly: {', '.join(result['lazy_imported'])}")
+        status = 1
+    if baseline and result["median_ms"] > baseline["median_ms"] * (
+        1 + args.max_regression
+    ):
+        print(f"Regression over {args.max_regression:.0%}")
+        status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+Benchmarks for the signing and verification hot paths of payments_redsys.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_redsys
+    python -m benchmarks.bench_redsys --filter compute_signature
+    python -m benchmarks.bench_redsys --json results.json
+    python -m benchmarks.bench_redsys --compare results.json --max-regression 0.25
+
+With --compare, the exit status is 1 if any benchmark got slower than the
+baseline by more than --max-regression (as a fraction of ops/sec), so it can
+be used in CI on a stable runner.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sample.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from decimal import Decimal  # noqa: E402
+
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from payments import get_payment_model  # noqa: E402
+
+from payments_redsys import (  # noqa: E402
+    RedsysProvider,
+    compare_signatures,
+    compute_signature,
+)
+from payments_redsys.breaker import percentile  # noqa: E402
+from payments_redsys.ciphers import CIPHER_BACKENDS, OrderKeyCache  # noqa: E402
+from payments_redsys.test_redsys import (  # noqa: E402
+    DEFAULT_CONFIG,
+    encode_response,
+    redsys_response_factory,
+    signed_notification,
+)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a setup function returning the callable to be measured"""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def make_compute_signature_benchmark(backend):
+    def setup(context):
+        payload = encode_response(redsys_response_factory())
+        secret = DEFAULT_CONFIG["shared_secret"]
+        return lambda: compute_signature("SMPL000001", payload, secret, backend)
+
+    return setup
+
+
+for backend in sorted(CIPHER_BACKENDS):
+    benchmark(f"compute_signature[{backend}]")(
+        make_compute_signature_benchmark(backend)
+    )
+
+
+@benchmark("compute_signature[order_key_cache]")
+def bench_compute_signature_cached(context):
+    payload = encode_response(redsys_response_factory())
+    secret = DEFAULT_CONFIG["shared_secret"]
+    cache = OrderKeyCache()
+    return lambda: compute_signature("SMPL000001", payload, secret, key_cache=cache)
+
+
+@benchmark("compare_signatures")
+def bench_compare_signatures(context):
+    signature = "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8="
+    urlsafe = signature.replace("+", "-").replace("/", "_")
+    return lambda: compare_signatures(signature, urlsafe)
+
+
+def legacy_compare_signatures(sig1, sig2):
+    # regex based implementation used before constant-time comparison
+    alphanumeric_characters = re.compile("[^a-zA-Z0-9]")
+    sig1safe = re.sub(alphanumeric_characters, "", sig1)
+    sig2safe = re.sub(alphanumeric_characters, "", sig2)
+    return sig1safe == sig2safe
+
+
+@benchmark("compare_signatures[legacy_regex]")
+def bench_legacy_compare_signatures(context):
+    signature = "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8="
+    urlsafe = signature.replace("+", "-").replace("/", "_")
+    return lambda: legacy_compare_signatures(signature, urlsafe)
+
+
+@benchmark("encode_redsys_request")
+def bench_encode_redsys_request(context):
+    redsys = RedsysProvider(**DEFAULT_CONFIG)
+    merchant_data = {
+        "DS_MERCHANT_AMOUNT": "1000",
+        "DS_MERCHANT_ORDER": "SMPL000001",
+        "DS_MERCHANT_MERCHANTCODE": DEFAULT_CONFIG["merchant_code"],
+        "DS_MERCHANT_CURRENCY": "978",
+        "DS_MERCHANT_TRANSACTIONTYPE": "0",
+        "DS_MERCHANT_TERMINAL": DEFAULT_CONFIG["terminal"],
+    }
+    return lambda: redsys.encode_redsys_request("SMPL000001", merchant_data)
+
+
+@benchmark("validate_and_parse_response")
+def bench_validate_and_parse_response(context):
+    redsys = RedsysProvider(**DEFAULT_CONFIG)
+    response = signed_notification(redsys, "SMPL000001")
+    return lambda: redsys.validate_and_parse_response(response, "SMPL000001")
+
+
+@benchmark("validate_and_parse_response[previous_secret]")
+def bench_validate_and_parse_response_rotated(context):
+    # a response signed with the previous secret, after the first one matched
+    old_secret = "Mk9m98IfEblmPfrpsawt7BmxObt98Jev"
+    old = RedsysProvider(**{**DEFAULT_CONFIG, "shared_secret": old_secret})
+    redsys = RedsysProvider(**DEFAULT_CONFIG, previous_shared_secrets=[old_secret])
+    response = signed_notification(old, "SMPL000001")
+    return lambda: redsys.validate_and_parse_response(response, "SMPL000001")
+
+
+@benchmark("get_form")
+def bench_get_form(context):
+    redsys = RedsysProvider(**DEFAULT_CONFIG)
+    return lambda: redsys.get_form(context["payment"])
+
+
+@benchmark("get_form[form_cache]")
+def bench_get_form_cached(context):
+    redsys = RedsysProvider(**DEFAULT_CONFIG, form_cache_size=16)
+    return lambda: redsys.get_form(context["payment"])
+
+
+def make_process_data_benchmark(**options):
+    def setup(context):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, **options)
+        payment = context["payment"]
+        data = signed_notification(redsys, redsys.get_order_number(payment))
+        request = RequestFactory().post("/", data)
+        return lambda: redsys.process_data(payment, request)
+
+    return setup
+
+
+benchmark("process_data")(make_process_data_benchmark())
+benchmark("process_data[fast_notifications]")(
+    make_process_data_benchmark(fast_notifications=True)
+)
+benchmark("process_data[notification_store]")(
+    make_process_data_benchmark(notification_store="memory")
+)
+
+
+def measure(func, iterations, warmup):
+    for _ in range(warmup):
+        func()
+    clock = time.perf_counter_ns
+    timings = []
+    for _ in range(iterations):
+        start = clock()
+        func()
+        timings.append(clock() - start)
+    timings.sort()
+    total = sum(timings)
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations * 1e9 / total,
+        "mean_us": total / iterations / 1000,
+        "p50_us": percentile(timings, 0.50) / 1000,
+        "p95_us": percentile(timings, 0.95) / 1000,
+        "p99_us": percentile(timings, 0.99) / 1000,
+    }
+
+
+def run(names, iterations, warmup):
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        payment = get_payment_model().objects.create(
+            total=Decimal("10.0"),
+            currency="EUR",
+            variant="redsys",
+            captured_amount=Decimal("5.0"),
+        )
+        context = {"payment": payment}
+        return {
+            name: measure(BENCHMARKS[name](context), iterations, warmup)
+            for name in names
+        }
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], 0)
+
+
+def print_results(results, baseline=None):
+    header = (
+        f"{'benchmark':<46} {'ops/sec':>12} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}"
+    )
+    if baseline:
+        header += f" {'change':>8}"
+    print(header)
+    for name, result in results.items():
+        line = (
+            f"{name:<46} {result['ops_per_sec']:>12.0f} {result['p50_us']:>9.1f}"
+            f" {result['p95_us']:>9.1f} {result['p99_us']:>9.1f}"
+        )
+        if baseline and name in baseline:
+            change = result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+            line += f" {change:>+8.1%}"
+        print(line)
+
+
+def find_regressions(results, baseline, max_regression):
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline
+        and result["ops_per_sec"] < baseline[name]["ops_per_sec"] * (1 - max_regression)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--filter", help="only run benchmarks containing this text")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results file to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    # measure the code, not the log handlers
+    logging.getLogger("payments_redsys").setLevel(logging.WARNING)
+
+    names = [name for name in BENCHMARKS if not args.filter or args.filter in name]
+    results = run(names, args.iterations, args.warmup)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.max_regression)
+        if regressions:
+            print(
+                f"Regressions over {args.max_regression:.0%}: {', '.join(regressions)}"
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
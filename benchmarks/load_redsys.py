@@ -0,0 +1,92 @@
+"""
+End-to-end load test of the sample app against the Redsys simulator.
+
+Start the simulator and the sample app pointing at it, then run the load:
+
+    just simulator --port 8001
+    REDSYS_ENVIRONMENT=http://127.0.0.1:8001 just sample-app
+    REDSYS_ENVIRONMENT=http://127.0.0.1:8001 just load --payments 1000
+
+Each payment is created, its form posted to the simulator, which notifies
+the sample app (process_data) before redirecting, so the measured latency
+covers the whole notification round trip.
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sample.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import requests  # noqa: E402
+from payments import get_payment_model  # noqa: E402
+from payments.core import provider_factory  # noqa: E402
+
+from payments_redsys.breaker import percentile  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--variant", default="redsys")
+    parser.add_argument("--payments", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    provider = provider_factory(args.variant)
+    Payment = get_payment_model()
+    payments = [
+        Payment.objects.create(
+            total=Decimal("10.00"), currency="EUR", variant=args.variant
+        )
+        for _ in range(args.payments)
+    ]
+    forms = [provider.get_form(payment) for payment in payments]
+
+    session = requests.Session()
+    session.mount(
+        "http://",
+        requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency),
+    )
+
+    def pay(form):
+        data = {name: field.initial for name, field in form.fields.items()}
+        start = time.perf_counter()
+        try:
+            response = session.post(form.action, data=data, allow_redirects=False)
+        except requests.RequestException:
+            return "error", time.perf_counter() - start
+        return response.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(pay, forms))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = Counter(
+        Payment.objects.filter(pk__in=[payment.pk for payment in payments])
+        .values_list("status", flat=True)
+        .iterator()
+    )
+    print(f"payments:   {len(payments)} in {elapsed:.1f}s")
+    print(f"throughput: {len(payments) / elapsed * 60:.0f} payments/min")
+    print(
+        f"latency:    p50 {percentile(latencies, 0.50) * 1000:.1f}ms"
+        f" p95 {percentile(latencies, 0.95) * 1000:.1f}ms"
+        f" p99 {percentile(latencies, 0.99) * 1000:.1f}ms"
+    )
+    print(f"responses:  {dict(Counter(status for status, _ in results))}")
+    print(f"statuses:   {dict(statuses)}")
+    return 0 if statuses.get("waiting", 0) == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
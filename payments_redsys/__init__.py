@@ -17,20 +17,43 @@
 
 from __future__ import unicode_literals
 
+import asyncio
 import base64
 import hashlib
 import hmac
 import json
 import logging
-import re
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import cached_property, lru_cache
+from typing import Any, NamedTuple, Optional
 
-import pyDes
-import requests
-from django import forms
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponseRedirect
-from payments import PaymentError
+from django.utils import timezone
+from payments import PaymentError, get_payment_model
 from payments.core import BasicProvider, get_base_url, urljoin
-from payments.forms import PaymentForm
+from payments.signals import status_changed
+
+from .allocators import get_order_number_allocator
+from .ciphers import OrderKeyCache, derive_order_key
+from .dedup import get_notification_store
+from .instrumentation import NULL_TIMER, OperationTimer, load_observers
+from .logs import LogSampler, Redacted, log_notification
+from .notification import RedsysNotification
+from .polling import RateLimiter
+from .queue import get_notification_queue
+from .responses import (
+    AUTHORISATION,
+    CANCELLATION,
+    CONFIRMATION,
+    REFUND,
+    SCA_REQUIRED,
+    UNPAID_STATUSES,
+    ResponseDispatcher,
+)
+from .terminals import Terminal, TerminalRouter
 
 logger = logging.getLogger(__name__)
 
@@ -42,34 +65,121 @@ ISO_CURRENCY_LOOKUP = {
 }
 
 
-def compute_signature(salt: str, payload: bytes, key: str):
+def compute_signature(
+    salt: str,
+    payload: bytes,
+    key: str,
+    backend: Optional[str] = None,
+    key_cache: Optional[OrderKeyCache] = None,
+):
     """
     For Redsys:
         salt = order number (Ds_Order or Ds_Merchant_Order)
         payload = Ds_MerchantParameters
         key = shared secret (aka key) from the Redsys Administration Module
               (Merchant Data Query option in the "See Key" section)
+        backend = 3DES implementation, see payments_redsys.ciphers
+        key_cache = optional cache of derived per-order keys
     """
-    bkey = base64.b64decode(key)
-    des3 = pyDes.triple_des(
-        bkey, mode=pyDes.CBC, IV="\0" * 8, pad="\0", padmode=pyDes.PAD_NORMAL
-    )
-    pepper = des3.encrypt(str(salt))
+    if key_cache is not None:
+        pepper = key_cache.derive(key, salt, backend)
+    else:
+        pepper = derive_order_key(key, salt, backend)
     payload_hash = hmac.new(pepper, payload, hashlib.sha256).digest()
     return base64.b64encode(payload_hash)
 
 
+URLSAFE_TO_STANDARD = str.maketrans("-_", "+/")
+
+
+def decode_signature(signature) -> bytes:
+    """
+    Decodes a base64 signature, in either the standard or the URL-safe
+    alphabet (Redsys uses both), with or without padding
+    """
+    if isinstance(signature, bytes):
+        signature = signature.decode("ascii")
+    signature = signature.rstrip("=").translate(URLSAFE_TO_STANDARD)
+    # validate: otherwise characters outside the alphabet are dropped
+    return base64.b64decode(signature + "=" * (-len(signature) % 4), validate=True)
+
+
+def decode_merchant_parameters(merchant_parameters) -> RedsysNotification:
+    """
+    Decodes Ds_MerchantParameters, raising PaymentError if they are not
+    base64-encoded JSON objects
+    """
+    try:
+        return RedsysNotification.from_merchant_parameters(merchant_parameters)
+    except (TypeError, ValueError) as e:
+        raise PaymentError("invalid Ds_MerchantParameters") from e
+
+
 def compare_signatures(sig1, sig2):
-    alphanumeric_characters = re.compile("[^a-zA-Z0-9]")
-    sig1safe = re.sub(alphanumeric_characters, "", sig1)
-    sig2safe = re.sub(alphanumeric_characters, "", sig2)
-    return sig1safe == sig2safe
+    """Compares the digests of two signatures in constant time"""
+    try:
+        return hmac.compare_digest(decode_signature(sig1), decode_signature(sig2))
+    except ValueError:  # not base64
+        return False
+
+
+class OperationResult(NamedTuple):
+    """
+    Outcome of a single refund, capture or release in the bulk operations of
+    RedsysProvider (refund_many, capture_many, release_many)
+    """
+
+    payment: Any
+    amount: Optional[Any]  # amount processed, None if the operation failed
+    response_code: Optional[str]  # Ds_Response
+    error_code: Optional[str]  # errorCode
+    error: Optional[PaymentError]
+
 
+RefundResult = OperationResult
 
-class RedsysResponseForm(forms.Form):
-    Ds_SignatureVersion = forms.CharField(max_length=256)
-    Ds_Signature = forms.CharField(max_length=256)
-    Ds_MerchantParameters = forms.CharField(max_length=2048)
+
+class ChargeResult(NamedTuple):
+    """
+    Outcome of RedsysProvider.charge. When the issuer requires a 3DS
+    challenge the payment is left unchanged and form holds the redirect form
+    the customer must be sent through instead.
+    """
+
+    payment: Any
+    status: str  # payment status after the charge
+    response_code: Optional[str]  # Ds_Response
+    form: Optional[Any]  # PaymentForm for the redirect flow
+
+    @property
+    def challenge_required(self) -> bool:
+        return self.form is not None
+
+
+class QueryResult(NamedTuple):
+    payment: Any
+    status: Optional[str]  # payment status after the query, None if it failed
+    response_code: Optional[str]  # Ds_Response
+    error_code: Optional[str]  # errorCode
+    error: Optional[PaymentError]
+
+
+# fields of a Redsys notification, with their maximum lengths: read directly
+# by the fast notification path and validated by RedsysResponseForm otherwise
+NOTIFICATION_FIELDS = {
+    "Ds_SignatureVersion": 256,
+    "Ds_Signature": 256,
+    "Ds_MerchantParameters": 2048,
+}
+
+
+def __getattr__(name):
+    # the form module pulls in django.forms, so it is only imported when used
+    if name == "RedsysResponseForm":
+        from .forms import RedsysResponseForm
+
+        return RedsysResponseForm
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 REDSYS_ENVIRONMENTS = {
@@ -86,15 +196,102 @@ class RedsysProvider(BasicProvider):
         self.shared_secret = kwargs.pop("shared_secret")
         self.currency = kwargs.pop("currency", "978")
         self.direct_payment = str(kwargs.pop("direct_payment", False)).upper()
-        self.endpoint = REDSYS_ENVIRONMENTS[kwargs.pop("environment", "test")]
+        environment = kwargs.pop("environment", "test")
+        if environment.startswith(("http://", "https://")):
+            # e.g. payments_redsys.simulator
+            self.endpoint = environment.rstrip("/")
+        else:
+            self.endpoint = REDSYS_ENVIRONMENTS[environment]
         self.order_number_prefix = kwargs.pop("order_number_prefix", "0000")
         self.order_number_min_length = kwargs.pop("order_number_min_length", 0)
+        self.order_number_allocator = get_order_number_allocator(
+            kwargs.pop("order_number_allocator", None),
+            **{
+                "min_length": self.order_number_min_length,
+                **kwargs.pop("order_number_allocator_options", {}),
+            },
+        )
+        if self.order_number_allocator is not None and (
+            self.order_number_allocator.overlaps(self.order_number_prefix)
+        ):
+            raise ValueError(
+                "the order number allocator can issue order_number_prefix "
+                f"{self.order_number_prefix!r} followed by a payment pk: give it "
+                "a prefix starting with another digit, or with "
+                "order_number_prefix followed by 0"
+            )
         self.process_on_redirect = kwargs.pop("process_on_redirect", False)
         self.signature_version = kwargs.pop("signature_version", "HMAC_SHA256_V1")
+        self.cipher_backend = kwargs.pop("cipher_backend", None)
+        order_key_cache_size = kwargs.pop("order_key_cache_size", 0)
+        self.order_key_cache = (
+            OrderKeyCache(order_key_cache_size) if order_key_cache_size else None
+        )
+        self.rest_pool_size = kwargs.pop("rest_pool_size", 10)
+        self.rest_connect_timeout = kwargs.pop("rest_connect_timeout", 5.0)
+        self.rest_read_timeout = kwargs.pop("rest_read_timeout", 30.0)
+        self.rest_max_retries = kwargs.pop("rest_max_retries", 2)
+        # options of the REST circuit breakers, None (or False) to disable them
+        rest_circuit_breaker = kwargs.pop("rest_circuit_breaker", {})
+        self.rest_circuit_breaker = (
+            None if rest_circuit_breaker in (None, False) else rest_circuit_breaker
+        )
+        self.query_endpoint = kwargs.pop("query_endpoint", None)
+        self.fast_notifications = kwargs.pop("fast_notifications", False)
+        self.notification_log_sampler = LogSampler(
+            kwargs.pop("notification_log_sample_rate", 1.0)
+        )
+        self.observers = load_observers(kwargs.pop("observers", None))
+        self.response_dispatcher = ResponseDispatcher(
+            kwargs.pop("response_outcomes", None)
+        )
+        form_cache_size = kwargs.pop("form_cache_size", 0)
+        self.form_cache = (
+            lru_cache(maxsize=form_cache_size)(self._encode_form_request)
+            if form_cache_size
+            else None
+        )
+        self.notification_store = get_notification_store(
+            kwargs.pop("notification_store", None),
+            ttl=kwargs.pop("notification_ttl", 3600),
+        )
+        self.notification_queue = get_notification_queue(
+            kwargs.pop("notification_queue", None)
+        )
+        # the merchant_code/terminal/shared_secret above are the default terminal
+        default_terminal = {
+            "merchant_code": self.merchant_code,
+            "terminal": self.terminal,
+            "shared_secret": self.shared_secret,
+            "previous_shared_secrets": kwargs.pop("previous_shared_secrets", ()),
+        }
+        self.terminal_router = TerminalRouter(
+            [
+                self._build_terminal(terminal)
+                for terminal in [default_terminal, *kwargs.pop("terminals", ())]
+            ],
+            attribute=kwargs.pop("terminal_attribute", None),
+        )
         super(RedsysProvider, self).__init__(*args, **kwargs)
 
+    def _build_terminal(self, config):
+        currency = config.get("currency")
+        return Terminal(
+            config["merchant_code"],
+            config["terminal"],
+            config["shared_secret"],
+            currency=ISO_CURRENCY_LOOKUP.get(currency, currency),
+            key=config.get("key"),
+            cipher_backend=self.cipher_backend,
+            previous_secrets=config.get("previous_shared_secrets", ()),
+        )
+
     def get_form(self, payment, data=None):
-        order_number = self.get_order_number(payment)
+        with self._timed("get_form", payment):
+            return self._payment_form(payment)
+
+    def _payment_form(self, payment, extra_merchant_data=None):
+        order_number = self._form_order_number(payment)
 
         amount = str(int(payment.total * 100))  # price is in cents
         # switch to payment.get_total_price() at some point
@@ -102,30 +299,41 @@ class RedsysProvider(BasicProvider):
         # need the gross element of TaxedMoney
         # also switch to amount.quantize(CENTS, rounding=ROUND_HALF_UP)
 
-        data = self.encode_redsys_request(
-            order_number,
-            {
-                "DS_MERCHANT_AMOUNT": amount,
-                "DS_MERCHANT_ORDER": order_number,
-                "DS_MERCHANT_MERCHANTCODE": self.merchant_code,
-                "DS_MERCHANT_DIRECTPAYMENT": self.direct_payment,
-                "DS_MERCHANT_CURRENCY": self.get_currency_code(payment),
-                "DS_MERCHANT_TRANSACTIONTYPE": "0",
-                "DS_MERCHANT_TERMINAL": self.terminal,
-                "DS_MERCHANT_MERCHANTURL": self.get_return_url(payment),
-                "DS_MERCHANT_URLOK": (
-                    self.get_return_url(payment)
-                    if self.process_on_redirect
-                    else self.get_success_url(payment)
-                ),
-                "DS_MERCHANT_URLKO": (
-                    self.get_return_url(payment)
-                    if self.process_on_redirect
-                    else self.get_failure_url(payment)
-                ),
-                "Ds_Merchant_ConsumerLanguage": self.language,
-            },
-        )
+        return_url = self.get_return_url(payment)
+        currency_code = self.get_currency_code(payment)
+        terminal = self.terminal_router.for_payment(payment, currency_code)
+        merchant_data = {
+            "DS_MERCHANT_AMOUNT": amount,
+            "DS_MERCHANT_ORDER": order_number,
+            "DS_MERCHANT_MERCHANTCODE": terminal.merchant_code,
+            "DS_MERCHANT_DIRECTPAYMENT": self.direct_payment,
+            "DS_MERCHANT_CURRENCY": currency_code,
+            "DS_MERCHANT_TRANSACTIONTYPE": "0",
+            "DS_MERCHANT_TERMINAL": terminal.terminal,
+            "DS_MERCHANT_MERCHANTURL": return_url,
+            "DS_MERCHANT_URLOK": (
+                return_url
+                if self.process_on_redirect
+                else self.get_success_url(payment)
+            ),
+            "DS_MERCHANT_URLKO": (
+                return_url
+                if self.process_on_redirect
+                else self.get_failure_url(payment)
+            ),
+            "Ds_Merchant_ConsumerLanguage": self.language,
+            **(extra_merchant_data or {}),
+        }
+
+        if self.form_cache is not None:
+            # any change in the payment data gives a different cache key
+            data = dict(
+                self.form_cache(order_number, tuple(merchant_data.items()), terminal)
+            )
+        else:
+            data = self.encode_redsys_request(order_number, merchant_data, terminal)
+
+        from payments.forms import PaymentForm
 
         return PaymentForm(
             data,
@@ -135,72 +343,280 @@ class RedsysProvider(BasicProvider):
             hidden_inputs=True,
         )
 
-    def process_data(self, payment, request):
-        success = False
-        url_success = urljoin(get_base_url(), payment.get_success_url())
-        url_failure = urljoin(get_base_url(), payment.get_failure_url())
-
-        form = RedsysResponseForm(request.POST or request.GET)
-        logger.info(
-            f"Processing gateway response payment={payment.pk} form={form.data}"
+    def _encode_form_request(self, order_number, merchant_data_items, terminal):
+        return self.encode_redsys_request(
+            order_number, dict(merchant_data_items), terminal
         )
 
-        if form.is_valid():
-            logger.debug(
-                "processing payment gateway response for payment %d" % payment.pk
-            )
-            response_dict = form.cleaned_data
-            order_number = self.get_order_number(payment)
-            merchant_parameters = self.validate_and_parse_response(
-                response_dict, order_number
-            )
-            transaction_type = merchant_parameters["Ds_TransactionType"]
-            response_code = int(merchant_parameters["Ds_Response"])
-
-            # https://pagosonline.redsys.es/desarrolladores-inicio/integrate-con-nosotros/parametros-de-entrada-y-salida/
-            if response_code < 100:
-                # Authorised transaction for payments and preauthorisations
-                if transaction_type == "0":
-                    payment.captured_amount = (
-                        int(merchant_parameters["Ds_Amount"]) / 100
+    def process_data(self, payment, request):
+        with self._timed("process_data", payment) as timer:
+            notification_key = self._notification_key(payment, request)
+            if notification_key:
+                previous = self.notification_store.get(notification_key)
+                if previous is not None:
+                    self.notification_store.record_suppressed()
+                    return self._notification_redirect(payment, previous)
+
+            notification = self._parse_notification(payment, request)
+            success = False
+            if notification is not None:
+                timer.response_code = notification.get("Ds_Response")
+                if self.notification_queue is not None:
+                    success = self._notification_success(notification)
+                    self.notification_queue.put(
+                        payment, self.get_order_number(payment), notification
                     )
-                    payment.transaction_id = merchant_parameters["Ds_AuthorisationCode"]
-                    payment.extra_data = merchant_parameters
-                    payment.change_status("confirmed")
-                    logger.debug("payment %d confirmed" % payment.pk)
-                elif transaction_type == "1":
-                    payment.extra_data = merchant_parameters
-                    payment.change_status("preauth")
-                    logger.debug("payment %d preauthorised" % payment.pk)
                 else:
-                    logger.debug(
-                        "authorised payment response but unrecognised transaction type %s"
-                        % transaction_type
+                    success = self.apply_notification(payment, notification)
+                if notification_key:
+                    self.notification_store.add(notification_key, success)
+            return self._notification_redirect(payment, success)
+
+    async def aprocess_data(self, payment, request):
+        """
+        Async counterpart of process_data for ASGI deployments: the status
+        change (model save and status_changed signal) runs via sync_to_async
+        """
+        with self._timed("aprocess_data", payment) as timer:
+            await self._aorder_numbers([payment])
+            notification_key = self._notification_key(payment, request)
+            if notification_key:
+                previous = await self.notification_store.aget(notification_key)
+                if previous is not None:
+                    self.notification_store.record_suppressed()
+                    return self._notification_redirect(payment, previous)
+
+            if self.order_number_allocator is None:
+                notification = self._parse_notification(payment, request)
+            else:
+                # looks the notification's order number up in the database
+                notification = await sync_to_async(self._parse_notification)(
+                    payment, request
+                )
+            success = False
+            if notification is not None:
+                timer.response_code = notification.get("Ds_Response")
+                if self.notification_queue is not None:
+                    success = self._notification_success(notification)
+                    await self.notification_queue.aput(
+                        payment, self.get_order_number(payment), notification
                     )
-                success = True
-
-            if response_code == 900:
-                # Authorised transaction for refunds and confirmations
-                if transaction_type == "3":
-                    payment.extra_data = merchant_parameters
-                    payment.change_status("refunded")
-                    logger.debug("payment %d automatic refund" % payment.pk)
                 else:
-                    logger.debug(
-                        "authorised refund response but unrecognised transaction type %s"
-                        % transaction_type
-                    )
-                success = True
+                    success = await self.aapply_notification(payment, notification)
+                if notification_key:
+                    await self.notification_store.aadd(notification_key, success)
+            return self._notification_redirect(payment, success)
 
-            if response_code > 100 and response_code != 900:
-                # any of a long list of errors/rejections
-                payment.extra_data = merchant_parameters
-                payment.change_status(
-                    "rejected", message="Ds_Response was %d" % response_code
-                )
-                # perhaps import and raise PaymentError from django-payments
-                logger.debug("rejected: %s" % json.dumps(merchant_parameters))
+    def _notification_key(self, payment, request):
+        """
+        Key identifying a notification in the notification store, or None if
+        deduplication is disabled
+        """
+        if self.notification_store is None:
+            return None
+        signature = (request.POST or request.GET).get("Ds_Signature")
+        if not signature:
+            return None
+        return f"{self.get_order_number(payment)}:{signature}"
+
+    def _parse_notification(self, payment, request):
+        """
+        Validates the Redsys notification in the request and returns it as a
+        RedsysNotification, or None if the form is invalid
+        """
+        data = request.POST or request.GET
+        if self.fast_notifications:
+            response_dict = self._read_notification_fields(data)
+        else:
+            from .forms import RedsysResponseForm
+
+            form = RedsysResponseForm(data)
+            response_dict = form.cleaned_data if form.is_valid() else None
+        if response_dict is None:
+            logger.warning(
+                "payment %s: invalid notification %s",
+                payment.pk,
+                Redacted(data),
+                extra={"redsys_payment": payment.pk, "redsys_fields": Redacted(data)},
+            )
+            return None
+
+        order_number = self._notification_order_number(payment, response_dict)
+        return self.validate_and_parse_response(
+            response_dict, order_number, self.get_terminal(payment)
+        )
 
+    def _notification_order_number(self, payment, response_dict):
+        """
+        The order number to verify a notification for the payment with. With
+        an order number allocator, any of the numbers allocated for the
+        payment: the one in the notification, if it belongs to the payment.
+        """
+        if self.order_number_allocator is None:
+            return self.get_order_number(payment)
+        # not verified yet: the signature is checked with this order number
+        order_number = decode_merchant_parameters(
+            response_dict["Ds_MerchantParameters"]
+        ).order
+        if order_number:
+            if self.order_number_allocator.payment_id(order_number) == payment.pk:
+                return order_number
+            if order_number == self._default_order_number(payment):
+                # paid before the allocator was enabled
+                return order_number
+        raise PaymentError(f"order {order_number} is not an order of the payment")
+
+    def _read_notification_fields(self, data):
+        """
+        Lightweight replacement for RedsysResponseForm, used with
+        fast_notifications: reads the Ds_* fields without form validation
+        """
+        response_dict = {}
+        for field, max_length in NOTIFICATION_FIELDS.items():
+            value = data.get(field)
+            if not value or len(value) > max_length:
+                return None
+            response_dict[field] = value
+        return response_dict
+
+    def apply_notification(self, payment, notification):
+        """
+        Updates the payment with a verified notification, returning whether
+        it was successful
+        """
+        if not self._decides_payment(payment, notification):
+            success = self._notification_success(notification)
+        else:
+            success, status, message = self._notification_outcome(payment, notification)
+            if status:
+                self._apply_status(payment, status, message)
+        if self.order_number_allocator is not None and notification.order:
+            self.order_number_allocator.record_response(
+                payment, notification.order, success
+            )
+        return success
+
+    async def aapply_notification(self, payment, notification):
+        """Async counterpart of apply_notification"""
+        await self._aorder_numbers([payment])
+        if not self._decides_payment(payment, notification):
+            success = self._notification_success(notification)
+        else:
+            success, status, message = self._notification_outcome(payment, notification)
+            if status:
+                await self._aapply_status(payment, status, message)
+        if self.order_number_allocator is not None and notification.order:
+            await sync_to_async(self.order_number_allocator.record_response)(
+                payment, notification.order, success
+            )
+        return success
+
+    def _decides_payment(self, payment, notification):
+        """
+        Whether a notification changes the payment. With an order number
+        allocator, one for an earlier attempt (not the payment's current or
+        paid number) only does while the payment is waiting, or if it
+        authorised a payment not paid otherwise: a late or retried decline
+        must not override a later payment.
+        """
+        if self.order_number_allocator is None or not notification.order:
+            return True
+        if notification.order == self.get_order_number(payment):
+            return True
+        if payment.status == "waiting":
+            return True
+        return payment.status in UNPAID_STATUSES and self._notification_success(
+            notification
+        )
+
+    def _notification_success(self, notification):
+        # the outcome without applying it, for notifications queued for later
+        if notification.response is None:
+            raise PaymentError("missing or invalid Ds_Response")
+        return self.response_dispatcher.resolve(
+            notification.response, notification.transaction_type
+        ).success
+
+    def _apply_status(self, payment, status, message):
+        if self.fast_notifications:
+            self._update_status(payment, status, message)
+        else:
+            payment.change_status(status, message=message)
+
+    async def _aapply_status(self, payment, status, message):
+        if self.fast_notifications:
+            await self._aupdate_status(payment, status, message)
+        else:
+            await sync_to_async(payment.change_status)(status, message=message)
+
+    def _status_update(self, payment, status, message):
+        """
+        Returns the queryset and field values that apply a notification to
+        the payment with a single UPDATE, skipped if the payment already has
+        that status (e.g. a repeated notification)
+        """
+        payment.status = status
+        payment.message = message
+        values = {
+            "status": status,
+            "message": message,
+            "extra_data": payment.extra_data,
+            "modified": timezone.now(),
+        }
+        if status == "confirmed":
+            values["captured_amount"] = payment.captured_amount
+            values["transaction_id"] = payment.transaction_id
+        queryset = (
+            type(payment)._default_manager.filter(pk=payment.pk).exclude(status=status)
+        )
+        return queryset, values
+
+    def _update_status(self, payment, status, message):
+        queryset, values = self._status_update(payment, status, message)
+        if queryset.update(**values):
+            status_changed.send(sender=type(payment), instance=payment)
+        else:
+            logger.debug("payment %s already %s", payment.pk, status)
+
+    async def _aupdate_status(self, payment, status, message):
+        queryset, values = self._status_update(payment, status, message)
+        if await queryset.aupdate(**values):
+            await sync_to_async(status_changed.send)(
+                sender=type(payment), instance=payment
+            )
+        else:
+            logger.debug("payment %s already %s", payment.pk, status)
+
+    def _notification_outcome(self, payment, notification):
+        """
+        Applies the notification data to the payment instance (without saving)
+        and returns a (success, status, message) tuple, where status is the
+        new payment status or None if it should not change
+        """
+        response_code = notification.response
+        if response_code is None:
+            raise PaymentError("missing or invalid Ds_Response")
+
+        outcome = self.response_dispatcher.resolve(
+            response_code, notification.transaction_type
+        )
+        message = ""
+        if outcome.status:
+            payment.extra_data = notification.extra_data
+        if outcome.status == "confirmed" and notification.amount is not None:
+            payment.captured_amount = Decimal(notification.amount) / 100
+            payment.transaction_id = notification.authorisation_code or ""
+        if not outcome.success:
+            message = "Ds_Response was %d: %s" % (response_code, outcome.reason)
+            log_notification(logger, logging.INFO, payment, notification, message)
+        elif logger.isEnabledFor(logging.INFO) and self.notification_log_sampler():
+            # successful notifications are sampled, failures always logged
+            log_notification(
+                logger, logging.INFO, payment, notification, outcome.reason
+            )
+        return outcome.success, outcome.status, message
+
+    def _notification_redirect(self, payment, success):
         if success:
             return HttpResponseRedirect(self.get_success_url(payment))
         else:
@@ -212,6 +628,100 @@ class RedsysProvider(BasicProvider):
     def get_success_url(self, payment):
         return urljoin(get_base_url(), payment.get_success_url())
 
+    def charge(self, payment, reference, merchant_data=None):
+        """
+        Authorises the payment server to server, with a card stored in Redsys
+        (reference being the DS_MERCHANT_IDENTIFIER returned when the card was
+        first used), skipping the browser redirect.
+
+        The response is applied to the payment as process_data does with
+        notifications. If the issuer requires a 3DS challenge the payment is
+        left as it is, and the returned ChargeResult holds the form to send
+        the customer through the redirect flow with the same card.
+
+        merchant_data adds or overrides DS_MERCHANT_* parameters of the
+        request, e.g. DS_MERCHANT_EXCEP_SCA or the DS_MERCHANT_COF_* fields.
+        Requires an order_number_allocator, since every charge needs a new
+        order number (ImproperlyConfigured otherwise).
+        """
+        with self._timed("charge", payment) as timer:
+            order_number, data = self._charge_request(
+                payment, self._new_order_number(payment), reference, merchant_data
+            )
+            content = self.rest_client.post(data)
+            notification = self._parse_rest_response(
+                content, order_number, self.get_terminal(payment)
+            )
+            timer.response_code = notification.get("Ds_Response")
+            if self._challenge_required(notification):
+                return self._challenge_result(payment, reference, notification)
+            self.apply_notification(payment, notification)
+            return ChargeResult(
+                payment, payment.status, notification.get("Ds_Response"), None
+            )
+
+    async def acharge(self, payment, reference, merchant_data=None):
+        """Async counterpart of charge"""
+        with self._timed("acharge", payment) as timer:
+            order_number, data = self._charge_request(
+                payment,
+                await self._anew_order_number(payment),
+                reference,
+                merchant_data,
+            )
+            content = await self.rest_client.apost(data)
+            notification = self._parse_rest_response(
+                content, order_number, self.get_terminal(payment)
+            )
+            timer.response_code = notification.get("Ds_Response")
+            if self._challenge_required(notification):
+                # allocates the form's order number
+                return await sync_to_async(self._challenge_result)(
+                    payment, reference, notification
+                )
+            await self.aapply_notification(payment, notification)
+            return ChargeResult(
+                payment, payment.status, notification.get("Ds_Response"), None
+            )
+
+    def _charge_request(self, payment, order_number, reference, merchant_data=None):
+        currency_code = self.get_currency_code(payment)
+        terminal = self.terminal_router.for_payment(payment, currency_code)
+        data = self.encode_redsys_request(
+            order_number,
+            {
+                "DS_MERCHANT_AMOUNT": str(int(payment.total * 100)),
+                "DS_MERCHANT_CURRENCY": currency_code,
+                "DS_MERCHANT_MERCHANTCODE": terminal.merchant_code,
+                "DS_MERCHANT_ORDER": order_number,
+                "DS_MERCHANT_TERMINAL": terminal.terminal,
+                "DS_MERCHANT_TRANSACTIONTYPE": AUTHORISATION,
+                "DS_MERCHANT_IDENTIFIER": reference,
+                **(merchant_data or {}),
+            },
+            terminal,
+        )
+        return order_number, data
+
+    def _challenge_required(self, notification):
+        # a soft decline asking for SCA, or an EMV3DS challenge request
+        if notification.response == SCA_REQUIRED:
+            return True
+        emv3ds = notification.get("Ds_EMV3DS")
+        return isinstance(emv3ds, dict) and emv3ds.get("threeDSInfo") == (
+            "ChallengeRequest"
+        )
+
+    def _challenge_result(self, payment, reference, notification):
+        logger.info(
+            "payment %s: 3DS challenge required, falling back to the redirect flow",
+            payment.pk,
+        )
+        form = self._payment_form(payment, {"DS_MERCHANT_IDENTIFIER": reference})
+        return ChargeResult(
+            payment, payment.status, notification.get("Ds_Response"), form
+        )
+
     def refund(self, payment, amount=None):
         """
         It requests a refund to Redsys using their Webservices layer
@@ -219,44 +729,336 @@ class RedsysProvider(BasicProvider):
         More information about the process and the error codes at
         https://canales.redsys.es/canales/ayuda/documentacion/Manual%20integracion%20para%20conexion%20por%20Web%20Service.pdf
         """
-        refund_amount = amount or payment.captured_amount
+        return self._operation("refund", payment, REFUND, amount)
+
+    async def arefund(self, payment, amount=None):
+        """
+        Async counterpart of refund. Uses httpx when installed, otherwise runs
+        the blocking request in a worker thread.
+        """
+        return await self._aoperation("arefund", payment, REFUND, amount)
+
+    def capture(self, payment, amount=None):
+        """
+        Confirms a preauthorised payment for amount (the payment total if
+        None). Returns the captured amount; as with refund, the payment is
+        not modified, that is left to Payment.capture.
+        """
+        return self._operation("capture", payment, CONFIRMATION, amount)
+
+    async def acapture(self, payment, amount=None):
+        """Async counterpart of capture"""
+        return await self._aoperation("acapture", payment, CONFIRMATION, amount)
+
+    def release(self, payment):
+        """Cancels a preauthorised payment, releasing the held amount"""
+        self._operation("release", payment, CANCELLATION)
+
+    async def arelease(self, payment):
+        """Async counterpart of release"""
+        await self._aoperation("arelease", payment, CANCELLATION)
+
+    def refund_many(self, payments, amounts=None, concurrency=8):
+        """
+        Refunds many payments concurrently, returning an OperationResult per
+        payment in the same order. Failures are reported in the results
+        rather than raised.
+
+        amounts, if given, is a sequence matching payments; None entries
+        refund the captured amount. Like refund, this does not update the
+        payment instances.
+        """
+        return self._operation_many(payments, REFUND, amounts, concurrency)
+
+    async def arefund_many(self, payments, amounts=None, concurrency=8):
+        """
+        Async counterpart of refund_many, with at most concurrency requests
+        in flight at any time
+        """
+        return await self._aoperation_many(payments, REFUND, amounts, concurrency)
+
+    def capture_many(self, payments, amounts=None, concurrency=8):
+        """
+        Captures many preauthorised payments concurrently, like refund_many.
+        None amounts capture the payment total.
+        """
+        return self._operation_many(payments, CONFIRMATION, amounts, concurrency)
+
+    async def acapture_many(self, payments, amounts=None, concurrency=8):
+        """Async counterpart of capture_many"""
+        return await self._aoperation_many(payments, CONFIRMATION, amounts, concurrency)
+
+    def release_many(self, payments, concurrency=8):
+        """Releases many preauthorised payments concurrently, like refund_many"""
+        return self._operation_many(payments, CANCELLATION, None, concurrency)
+
+    async def arelease_many(self, payments, concurrency=8):
+        """Async counterpart of release_many"""
+        return await self._aoperation_many(payments, CANCELLATION, None, concurrency)
+
+    def _operation(self, operation, payment, transaction_type, amount=None):
+        with self._timed(operation, payment) as timer:
+            amount, order_number, data = self._operation_request(
+                payment, transaction_type, amount
+            )
+            content = self.rest_client.post(data)
+            result = self._operation_result(payment, amount, order_number, content)
+            timer.response_code = result.response_code
+            if result.error:
+                raise result.error
+            return result.amount
+
+    async def _aoperation(self, operation, payment, transaction_type, amount=None):
+        with self._timed(operation, payment) as timer:
+            await self._aorder_numbers([payment])
+            amount, order_number, data = self._operation_request(
+                payment, transaction_type, amount
+            )
+            content = await self.rest_client.apost(data)
+            result = self._operation_result(payment, amount, order_number, content)
+            timer.response_code = result.response_code
+            if result.error:
+                raise result.error
+            return result.amount
+
+    def _operation_many(self, payments, transaction_type, amounts, concurrency):
+        operation_requests = self._operation_requests(
+            payments, transaction_type, amounts
+        )
+
+        def send(item):
+            payment, (amount, order_number, data) = item
+            try:
+                content = self.rest_client.post(data)
+            except PaymentError as e:
+                return OperationResult(payment, None, None, e.code, e)
+            return self._operation_result(payment, amount, order_number, content)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(send, operation_requests))
+
+    async def _aoperation_many(self, payments, transaction_type, amounts, concurrency):
+        payments = list(payments)
+        await self._aorder_numbers(payments)
+        operation_requests = self._operation_requests(
+            payments, transaction_type, amounts
+        )
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(item):
+            payment, (amount, order_number, data) = item
+            async with semaphore:
+                try:
+                    content = await self.rest_client.apost(data)
+                except PaymentError as e:
+                    return OperationResult(payment, None, None, e.code, e)
+            return self._operation_result(payment, amount, order_number, content)
+
+        return list(await asyncio.gather(*(send(item) for item in operation_requests)))
+
+    def _operation_requests(self, payments, transaction_type, amounts=None):
+        # all requests are signed up front, before any is sent
+        payments = list(payments)
+        if self.order_number_allocator is not None:
+            self.order_number_allocator.prefetch(payments)
+        amounts = [None] * len(payments) if amounts is None else list(amounts)
+        if len(amounts) != len(payments):
+            raise ValueError("amounts must have one entry per payment")
+        return [
+            (payment, self._operation_request(payment, transaction_type, amount))
+            for payment, amount in zip(payments, amounts)
+        ]
+
+    def _operation_request(self, payment, transaction_type, amount=None):
+        if transaction_type == REFUND:
+            amount = amount or payment.captured_amount
+        else:
+            # captures and releases of preauthorisations
+            amount = amount or payment.total
         # cents = str(int(
-        #     refund_amount.quantize(CENTS, rounding=ROUND_HALF_UP)) * 100
+        #     amount.quantize(CENTS, rounding=ROUND_HALF_UP)) * 100
         # )
-        cents = str(int(refund_amount * 100))
+        cents = str(int(amount * 100))
         order_number = self.get_order_number(payment)
         currency_code = self.get_currency_code(payment)
+        terminal = self.terminal_router.for_payment(payment, currency_code)
 
         data = self.encode_redsys_request(
             order_number,
             {
                 "DS_MERCHANT_AMOUNT": cents,
                 "DS_MERCHANT_CURRENCY": currency_code,
-                "DS_MERCHANT_MERCHANTCODE": self.merchant_code,
+                "DS_MERCHANT_MERCHANTCODE": terminal.merchant_code,
                 "DS_MERCHANT_ORDER": order_number,
-                "DS_MERCHANT_TERMINAL": self.terminal,
-                "DS_MERCHANT_TRANSACTIONTYPE": "3",
+                "DS_MERCHANT_TERMINAL": terminal.terminal,
+                "DS_MERCHANT_TRANSACTIONTYPE": transaction_type,
             },
+            terminal,
+        )
+        return amount, order_number, data
+
+    def _operation_result(self, payment, amount, order_number, content):
+        try:
+            notification = self._parse_rest_response(
+                content, order_number, self.get_terminal(payment)
+            )
+        except PaymentError as e:
+            return OperationResult(payment, None, None, e.code, e)
+
+        response_code = notification.get("Ds_Response")
+        if response_code in ["0400", "0900"]:
+            return OperationResult(payment, amount, response_code, None, None)
+
+        error = PaymentError(
+            "Redsys error '{}'".format(response_code or "non matched response"),
+            code=response_code,
         )
+        return OperationResult(payment, None, response_code, None, error)
 
-        response = requests.post(self.endpoint_rest, json=data)
-        response_code = None
-        response_dict = json.loads(response.content.decode("utf-8"))
+    def _parse_rest_response(self, content, order_number, terminal=None):
+        try:
+            response_dict = json.loads(content.decode("utf-8"))
+        except ValueError as e:  # e.g. an HTML error page from a proxy
+            raise PaymentError(f"invalid Redsys REST response: {e}") from e
+        if not isinstance(response_dict, dict):
+            raise PaymentError("invalid Redsys REST response: not a JSON object")
 
         if "errorCode" in response_dict:
             raise PaymentError(
-                f"Redsys error {response_dict['errorCode']} '{response_dict['errorCodeDescription']}'"
+                f"Redsys error {response_dict['errorCode']} '{response_dict.get('errorCodeDescription')}'",
+                code=response_dict["errorCode"],
+                gateway_message=response_dict.get("errorCodeDescription"),
             )
 
-        merchant_parameters = self.validate_and_parse_response(
-            response_dict, order_number
+        return self.validate_and_parse_response(response_dict, order_number, terminal)
+
+    def query_status(self, payment):
+        """
+        Asks Redsys for the current state of the payment's order and applies
+        it to the payment as process_data does with notifications, so
+        payments whose notification was lost do not stay waiting.
+
+        Returns the payment status afterwards.
+        """
+        with self._timed("query_status", payment) as timer:
+            order_number, data = self._query_request(payment)
+            content = self.rest_client.post(data, self.endpoint_query)
+            result = self._query_result(payment, order_number, content)
+            timer.response_code = result.response_code
+            if result.error:
+                raise result.error
+            return result.status
+
+    async def aquery_status(self, payment):
+        """Async counterpart of query_status"""
+        with self._timed("aquery_status", payment) as timer:
+            await self._aorder_numbers([payment])
+            order_number, data = self._query_request(payment)
+            content = await self.rest_client.apost(data, self.endpoint_query)
+            result = await self._aquery_result(payment, order_number, content)
+            timer.response_code = result.response_code
+            if result.error:
+                raise result.error
+            return result.status
+
+    def query_statuses(self, payments, concurrency=8, max_rate=None):
+        """
+        Queries the status of many payments concurrently, at most concurrency
+        requests in flight and max_rate requests per second (unlimited if
+        None), returning a QueryResult per payment in the same order.
+        Failures are reported in the results rather than raised.
+
+        Requests run in worker threads; statuses are applied in the calling
+        thread as responses arrive.
+        """
+        limiter = RateLimiter(max_rate) if max_rate else None
+        payments = list(payments)
+        if self.order_number_allocator is not None:
+            self.order_number_allocator.prefetch(payments)
+        query_requests = [
+            (payment, self._query_request(payment)) for payment in payments
+        ]
+
+        def send(item):
+            payment, (order_number, data) = item
+            if limiter:
+                limiter.acquire()
+            try:
+                return self.rest_client.post(data, self.endpoint_query)
+            except PaymentError as e:
+                return e
+
+        results = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for (payment, (order_number, data)), content in zip(
+                query_requests, executor.map(send, query_requests)
+            ):
+                if isinstance(content, PaymentError):
+                    results.append(QueryResult(payment, None, None, None, content))
+                else:
+                    results.append(self._query_result(payment, order_number, content))
+        return results
+
+    async def aquery_statuses(self, payments, concurrency=8, max_rate=None):
+        """Async counterpart of query_statuses"""
+        limiter = RateLimiter(max_rate) if max_rate else None
+        payments = list(payments)
+        await self._aorder_numbers(payments)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(payment):
+            order_number, data = self._query_request(payment)
+            async with semaphore:
+                if limiter:
+                    await limiter.aacquire()
+                try:
+                    content = await self.rest_client.apost(data, self.endpoint_query)
+                except PaymentError as e:
+                    return QueryResult(payment, None, None, None, e)
+            return await self._aquery_result(payment, order_number, content)
+
+        return list(await asyncio.gather(*(send(payment) for payment in payments)))
+
+    def _query_request(self, payment):
+        order_number = self.get_order_number(payment)
+        terminal = self.get_terminal(payment)
+        data = self.encode_redsys_request(
+            order_number,
+            {
+                "DS_MERCHANT_MERCHANTCODE": terminal.merchant_code,
+                "DS_MERCHANT_ORDER": order_number,
+                "DS_MERCHANT_TERMINAL": terminal.terminal,
+            },
+            terminal,
         )
-        response_code = merchant_parameters["Ds_Response"]
-        if response_code in ["0400", "0900"]:
-            return refund_amount
+        return order_number, data
 
-        raise PaymentError(
-            "Redsys error '{}'".format(response_code or "non matched response")
+    def _query_result(self, payment, order_number, content):
+        try:
+            notification = self._parse_rest_response(
+                content, order_number, self.get_terminal(payment)
+            )
+            _, status, message = self._notification_outcome(payment, notification)
+        except PaymentError as e:
+            return QueryResult(payment, None, None, e.code, e)
+        if status:
+            self._apply_status(payment, status, message)
+        return QueryResult(
+            payment, payment.status, notification.get("Ds_Response"), None, None
+        )
+
+    async def _aquery_result(self, payment, order_number, content):
+        try:
+            notification = self._parse_rest_response(
+                content, order_number, self.get_terminal(payment)
+            )
+            _, status, message = self._notification_outcome(payment, notification)
+        except PaymentError as e:
+            return QueryResult(payment, None, None, e.code, e)
+        if status:
+            await self._aapply_status(payment, status, message)
+        return QueryResult(
+            payment, payment.status, notification.get("Ds_Response"), None, None
         )
 
     @property
@@ -267,6 +1069,39 @@ class RedsysProvider(BasicProvider):
     def endpoint_rest(self):
         return "{}/sis/rest/trataPeticionREST".format(self.endpoint)
 
+    @property
+    def endpoint_query(self):
+        return self.query_endpoint or "{}/sis/rest/consultaOperacionREST".format(
+            self.endpoint
+        )
+
+    @cached_property
+    def rest_client(self):
+        # requests (and httpx) are only imported by the first REST operation
+        from .rest import RedsysRestClient
+
+        return RedsysRestClient(
+            self.endpoint_rest,
+            pool_size=self.rest_pool_size,
+            connect_timeout=self.rest_connect_timeout,
+            read_timeout=self.rest_read_timeout,
+            max_retries=self.rest_max_retries,
+            breaker_options=self.rest_circuit_breaker,
+        )
+
+    def rest_available(self, query: bool = False) -> bool:
+        """
+        Whether REST operations (status queries if query) would be attempted
+        now, or fail at once because Redsys is unavailable
+        """
+        return self.rest_client.available(
+            self.endpoint_query if query else self.endpoint_rest
+        )
+
+    def rest_health(self) -> dict:
+        """Circuit breaker state, error rate and latencies of each REST endpoint"""
+        return self.rest_client.health()
+
     def get_currency_code(self, payment):
         currency = payment.currency or self.currency
         # we translate textual currencies to numerical codes used by redsys
@@ -274,39 +1109,203 @@ class RedsysProvider(BasicProvider):
         currency_number = ISO_CURRENCY_LOOKUP.get(currency, currency)
         return currency_number
 
-    def validate_and_parse_response(self, response_dict, order_number):
-        signature = compute_signature(
-            order_number,
-            response_dict["Ds_MerchantParameters"].encode(),
-            self.shared_secret,
+    def validate_and_parse_response(self, response_dict, order_number, terminal=None):
+        """
+        Checks the signature of a Redsys response and returns its merchant
+        parameters as a RedsysNotification.
+
+        The signature is checked with the secret of the given terminal, the
+        payment's terminal. Only if the payment is unknown, without terminal,
+        the terminal named in Ds_MerchantCode and Ds_Terminal is used. The
+        merchant parameters are only decoded once the signature matched.
+        Raises PaymentError for invalid signatures and parameters.
+        """
+        with self._timed("validate_and_parse_response") as timer:
+            merchant_parameters = response_dict.get("Ds_MerchantParameters")
+            signature = response_dict.get("Ds_Signature")
+            if not isinstance(merchant_parameters, str) or not signature:
+                raise PaymentError("Ds_MerchantParameters or Ds_Signature missing")
+            if terminal is None:
+                terminal = self._notification_terminal(merchant_parameters)
+            payload = merchant_parameters.encode()
+            for secret_index in terminal.verification_order():
+                expected = self._compute_signature(
+                    order_number, payload, terminal, secret_index
+                )
+                if compare_signatures(expected.decode(), signature):
+                    break
+            else:
+                logger.warning(
+                    "order %s: signature mismatch for %r %s",
+                    order_number,
+                    terminal,
+                    Redacted(response_dict),
+                    extra={
+                        "redsys_order": order_number,
+                        "redsys_fields": Redacted(response_dict),
+                    },
+                )
+                raise PaymentError("signature mismatch - possible attack")
+
+            terminal.record_match(secret_index)
+            if secret_index:
+                logger.info(
+                    "order %s verified with previous secret %d of %r",
+                    order_number,
+                    secret_index,
+                    terminal,
+                )
+            notification = decode_merchant_parameters(merchant_parameters)
+
+            timer.response_code = notification.get("Ds_Response")
+            return notification
+
+    def _notification_terminal(self, merchant_parameters):
+        # unverified: the signature must still match this terminal's secret
+        notification = decode_merchant_parameters(merchant_parameters)
+        return (
+            self.terminal_router.for_notification(
+                notification.merchant_code, notification.terminal
+            )
+            or self.terminal_router.default
         )
 
-        if not compare_signatures(signature.decode(), response_dict["Ds_Signature"]):
-            raise PaymentError("signature mismatch - possible attack")
+    def _compute_signature(self, order_number, payload, terminal=None, secret_index=0):
+        with self._timed("compute_signature"):
+            terminal = terminal or self.terminal_router.default
+            return terminal.sign(
+                order_number, payload, self.order_key_cache, secret_index
+            )
 
-        binary_merchant_parameters = base64.b64decode(
-            response_dict["Ds_MerchantParameters"]
+    def get_terminal(self, payment):
+        """Returns the Terminal used for the payment"""
+        return self.terminal_router.for_payment(
+            payment, self.get_currency_code(payment)
         )
 
-        merchant_parameters = json.loads(binary_merchant_parameters.decode())
-        return merchant_parameters
+    def add_observer(self, observer):
+        """Registers a callable to receive an OperationEvent per operation"""
+        self.observers.append(observer)
+
+    def _timed(self, operation, payment=None):
+        if not self.observers:
+            return NULL_TIMER
+        return OperationTimer(self, operation, payment)
 
     def get_order_number(self, payment):
+        """
+        The payment's current order number. With an order number allocator,
+        the one it was paid with or else the last one allocated for it;
+        otherwise its order_number attribute or order_number_prefix followed
+        by its pk.
+        """
+        if self.order_number_allocator is not None:
+            if order_number := self.order_number_allocator.current(payment):
+                return order_number
+        return self._default_order_number(payment)
+
+    def _default_order_number(self, payment):
+        # not padded to order_number_min_length, which only applies to
+        # allocated numbers: existing payments must keep their order numbers
         if order_number := getattr(payment, "order_number", None):
             return order_number
         return f"{self.order_number_prefix}{payment.pk}"
 
-    def encode_redsys_request(self, order_number, merchant_data):
-        json_data = json.dumps(merchant_data)
-        logger.debug(json_data)
-        b64_params = base64.b64encode(json_data.encode())
-        signature = compute_signature(
-            str(order_number),
-            b64_params,
-            self.shared_secret,
+    def _form_order_number(self, payment):
+        # a form rendered again keeps its number until Redsys answered for it
+        if self.order_number_allocator is None:
+            return self.get_order_number(payment)
+        return self.order_number_allocator.attempt(payment)
+
+    def _new_order_number(self, payment):
+        # server to server requests are sent at once: always a new number
+        self._check_order_number_allocator()
+        return self.order_number_allocator.allocate(payment, used=True)
+
+    async def _anew_order_number(self, payment):
+        self._check_order_number_allocator()
+        return await sync_to_async(self.order_number_allocator.allocate)(
+            payment, used=True
         )
+
+    def _check_order_number_allocator(self):
+        # the number derived from the pk would be reused by every charge, and
+        # by the redirect form a 3DS challenge falls back to
+        if self.order_number_allocator is None:
+            raise ImproperlyConfigured(
+                "charge requires an order_number_allocator, to send Redsys a "
+                "new order number for every attempt"
+            )
+
+    async def _aorder_numbers(self, payments):
+        # loads the order numbers from the database before signing requests
+        if self.order_number_allocator is not None:
+            await sync_to_async(self.order_number_allocator.prefetch)(payments)
+
+    def parse_order_number(self, order_number):
+        """
+        Returns the payment pk an order number most likely refers to, or None.
+
+        Order numbers generated from order_number_prefix are parsed exactly;
+        for custom order_number properties the trailing digits are used, so
+        callers must check the order number of the payment they load.
+        """
+        if order_number.startswith(self.order_number_prefix):
+            pk = order_number[len(self.order_number_prefix) :]
+        else:
+            pk = order_number[len(order_number.rstrip("0123456789")) :]
+        return int(pk) if pk.isdigit() else None
+
+    def get_payments_by_order_number(self, order_numbers):
+        """
+        Returns a dict of order number to payment for the given order numbers,
+        with a single query
+        """
+        order_numbers = set(order_numbers)
+        Payment = get_payment_model()
+        found = {}
+        if self.order_number_allocator is not None:
+            payment_ids = self.order_number_allocator.payment_ids(order_numbers)
+            payments = Payment._default_manager.in_bulk(set(payment_ids.values()))
+            found = {
+                order_number: payments[pk]
+                for order_number, pk in payment_ids.items()
+                if pk in payments
+            }
+            # the rest may predate the allocator
+            order_numbers -= found.keys()
+            if not order_numbers:
+                return found
+        if any(f.name == "order_number" for f in Payment._meta.concrete_fields):
+            payments = Payment._default_manager.filter(order_number__in=order_numbers)
+        else:
+            pks = {
+                self.parse_order_number(order_number) for order_number in order_numbers
+            }
+            pks.discard(None)
+            if not pks:
+                return found
+            payments = Payment._default_manager.filter(pk__in=pks)
         return {
-            "Ds_SignatureVersion": self.signature_version,
-            "Ds_MerchantParameters": b64_params.decode(),
-            "Ds_Signature": signature.decode(),
+            **found,
+            **{
+                order_number: payment
+                for payment in payments
+                if (order_number := self._default_order_number(payment))
+                in order_numbers
+            },
         }
+
+    def encode_redsys_request(self, order_number, merchant_data, terminal=None):
+        with self._timed("encode_redsys_request"):
+            json_data = json.dumps(merchant_data)
+            logger.debug(
+                "request for order %s: %s", order_number, Redacted(merchant_data)
+            )
+            b64_params = base64.b64encode(json_data.encode())
+            signature = self._compute_signature(str(order_number), b64_params, terminal)
+            return {
+                "Ds_SignatureVersion": self.signature_version,
+                "Ds_MerchantParameters": b64_params.decode(),
+                "Ds_Signature": signature.decode(),
+            }
@@ -0,0 +1,289 @@
+"""
+Allocators of Redsys order numbers (Ds_Merchant_Order).
+
+Redsys requires order numbers of 4 to 12 characters starting with 4 digits,
+never used before by the merchant, so a payment needs a new one every time
+it is attempted again. By default RedsysProvider derives the order number
+from the payment pk; with an allocator every attempt (get_form or charge)
+gets a new number, recorded against its payment so a Ds_Order can be mapped
+back to the payment with a single indexed lookup. Forms rendered again
+before Redsys answered (a page refresh) reuse the number, and the number a
+payment was paid with is kept for its refunds and status queries.
+
+DatabaseOrderNumberAllocator reserves numbers in blocks, with one
+transaction per block rather than per payment, and hands them out from
+memory.
+"""
+
+import threading
+from typing import Dict, Iterable, Optional
+
+from django.db import IntegrityError, router, transaction
+
+# attribute caching the current order number on payment instances
+CACHE_ATTRIBUTE = "_redsys_order_number"
+
+ORDER_NUMBER_MAX_LENGTH = 12
+
+
+def is_valid_order_number(order_number: str) -> bool:
+    """Checks Redsys' rules: 4 to 12 alphanumeric characters, 4 digits first"""
+    return (
+        4 <= len(order_number) <= ORDER_NUMBER_MAX_LENGTH
+        and order_number[:4].isdigit()
+        and order_number.isalnum()
+        and order_number.isascii()
+    )
+
+
+class OrderNumberAllocator:
+    """
+    Base class for order number allocators. allocate must record the number
+    against the payment before returning it, so payment_ids can find it as
+    soon as Redsys may send it back.
+    """
+
+    def allocate(self, payment, used: bool = False) -> str:
+        """
+        Returns a new order number for another attempt at the payment; used
+        if it is sent to Redsys right away (server to server)
+        """
+        raise NotImplementedError
+
+    def reusable(self, payment) -> Optional[str]:
+        """
+        The last order number allocated for the payment if Redsys never
+        answered for it, so a form rendered again can keep it
+        """
+        return None
+
+    def record_response(self, payment, order_number: str, paid: bool):
+        """
+        Records that Redsys answered for the order number, paid if the
+        payment was authorised with it
+        """
+
+    def attempt(self, payment) -> str:
+        """The order number for a form: reused if possible, otherwise new"""
+        return self.reusable(payment) or self.allocate(payment)
+
+    def payment_ids(self, order_numbers: Iterable[str]) -> Dict[str, object]:
+        """Maps the order numbers allocated by this allocator to payment pks"""
+        raise NotImplementedError
+
+    def latest(self, payments) -> Dict[object, str]:
+        """
+        Maps payment pks to their current order number: the one they were
+        paid with, otherwise the last one allocated for them
+        """
+        raise NotImplementedError
+
+    def overlaps(self, prefix: str) -> bool:
+        """
+        Whether allocated numbers can be prefix followed by a payment pk,
+        the order numbers used without an allocator
+        """
+        return False
+
+    def payment_id(self, order_number: str):
+        return self.payment_ids([order_number]).get(order_number)
+
+    def current(self, payment) -> Optional[str]:
+        """
+        The order number the payment was paid with, or the last one
+        allocated for it, "" if it never had one. Cached on the payment
+        instance.
+        """
+        order_number = getattr(payment, CACHE_ATTRIBUTE, None)
+        if order_number is None:
+            self.prefetch([payment])
+            order_number = getattr(payment, CACHE_ATTRIBUTE, None)
+        return order_number
+
+    def prefetch(self, payments):
+        """Caches the current order number of many payments, in one go"""
+        payments = [
+            payment
+            for payment in payments
+            if getattr(payment, CACHE_ATTRIBUTE, None) is None
+        ]
+        if not payments:
+            return
+        latest = self.latest(payments)
+        for payment in payments:
+            setattr(payment, CACHE_ATTRIBUTE, latest.get(payment.pk, ""))
+
+
+class DatabaseOrderNumberAllocator(OrderNumberAllocator):
+    """
+    Allocates consecutive numbers from a counter in the database
+    (payments_redsys.models.OrderNumberSequence), reserving block_size of
+    them at a time, and records them in payments_redsys.models.OrderNumber.
+    Requires payments_redsys in INSTALLED_APPS.
+
+    Numbers are prefix followed by the counter, zero-padded to min_length
+    (and at least 4 digits). prefix must be digits, and can't make numbers
+    that are RedsysProvider's order_number_prefix followed by a pk: start
+    it with another digit, or with order_number_prefix and a 0. Use
+    different prefixes or sequences for environments sharing a merchant
+    code. Numbers reserved
+    but not handed out when the process exits are skipped.
+
+    Blocks are reserved in a transaction of their own, committed at once,
+    which can't run inside another transaction: with ATOMIC_REQUESTS (or
+    when allocating inside atomic()), set database to a DATABASES alias for
+    the same database that isn't used for requests.
+    """
+
+    # attempts at recording a number before giving up
+    MAX_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        prefix: str = "",
+        min_length: int = 0,
+        block_size: int = 100,
+        sequence: str = "default",
+        database: Optional[str] = None,
+    ):
+        if prefix and not prefix.isdigit():
+            raise ValueError("the order number prefix must be digits")
+        if block_size < 1:
+            raise ValueError("block_size must be a positive integer")
+        self.prefix = prefix
+        self.width = max(min_length, 4) - len(prefix)
+        self.block_size = block_size
+        self.sequence = sequence
+        self.database = database
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    @property
+    def sequence_model(self):
+        # imported late: the provider is loaded before the app registry
+        from .models import OrderNumberSequence
+
+        return OrderNumberSequence
+
+    @property
+    def model(self):
+        from .models import OrderNumber
+
+        return OrderNumber
+
+    def overlaps(self, prefix):
+        if not (prefix.isdigit() and prefix.isascii()) and prefix:
+            return False
+        if self.prefix.startswith(prefix):
+            # pks don't start with 0
+            return not self.prefix[len(prefix) :].startswith("0")
+        return prefix.startswith(self.prefix)
+
+    def reserve_block(self):
+        """Reserves the next block_size numbers, returning (first, end)"""
+        using = self.database or router.db_for_write(self.sequence_model)
+        # durable: raises RuntimeError inside a transaction, whose rollback
+        # would hand the block out again
+        with transaction.atomic(using=using, durable=True):
+            manager = self.sequence_model._default_manager.db_manager(using)
+            sequence, _ = manager.select_for_update().get_or_create(name=self.sequence)
+            first = sequence.next_value
+            sequence.next_value = first + self.block_size
+            sequence.save(update_fields=["next_value"])
+        return first, first + self.block_size
+
+    def next_number(self) -> str:
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self.reserve_block()
+            value = self._next
+            self._next += 1
+        order_number = f"{self.prefix}{value:0{max(self.width, 0)}d}"
+        if not is_valid_order_number(order_number):
+            raise ValueError(f"order numbers of sequence {self.sequence!r} exhausted")
+        return order_number
+
+    def discard_block(self):
+        with self._lock:
+            self._next = self._end = 0
+
+    def allocate(self, payment, used=False):
+        for attempt in range(self.MAX_ATTEMPTS):
+            order_number = self.next_number()
+            try:
+                with transaction.atomic(using=router.db_for_write(self.model)):
+                    self.model._default_manager.create(
+                        order_number=order_number, payment=payment, used=used
+                    )
+            except IntegrityError:
+                # already handed out: the counter went back (e.g. restored)
+                self.discard_block()
+                if attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+            else:
+                setattr(payment, CACHE_ATTRIBUTE, order_number)
+                return order_number
+
+    def reusable(self, payment):
+        last = (
+            self.model._default_manager.filter(payment=payment.pk)
+            .order_by("-pk")
+            .values_list("order_number", "used")
+            .first()
+        )
+        if last is None or last[1]:
+            return None
+        setattr(payment, CACHE_ATTRIBUTE, last[0])
+        return last[0]
+
+    def record_response(self, payment, order_number, paid):
+        changes = {"used": True, "paid": True} if paid else {"used": True}
+        self.model._default_manager.filter(
+            order_number=order_number, payment=payment.pk
+        ).update(**changes)
+        if paid:
+            # reloaded on next use: an earlier attempt may not be the latest paid
+            setattr(payment, CACHE_ATTRIBUTE, None)
+
+    def payment_ids(self, order_numbers):
+        return dict(
+            self.model._default_manager.filter(
+                order_number__in=set(order_numbers)
+            ).values_list("order_number", "payment_id")
+        )
+
+    def latest(self, payments):
+        latest = {}
+        rows = (
+            self.model._default_manager.filter(
+                payment__in=[payment.pk for payment in payments]
+            )
+            # the paid numbers last, so they win
+            .order_by("payment_id", "paid", "pk").values_list(
+                "payment_id", "order_number"
+            )
+        )
+        for payment_id, order_number in rows:
+            latest[payment_id] = order_number
+        return latest
+
+
+ORDER_NUMBER_ALLOCATORS = {
+    "database": DatabaseOrderNumberAllocator,
+}
+
+
+def get_order_number_allocator(allocator, **options):
+    """
+    Builds an allocator from an ORDER_NUMBER_ALLOCATORS name, with options,
+    or returns it as is
+    """
+    if allocator is None or isinstance(allocator, OrderNumberAllocator):
+        return allocator
+    try:
+        return ORDER_NUMBER_ALLOCATORS[allocator](**options)
+    except KeyError:
+        raise ValueError(
+            f"Unknown order number allocator {allocator!r}, "
+            f"available: {', '.join(sorted(ORDER_NUMBER_ALLOCATORS))}"
+        )
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class PaymentsRedsysConfig(AppConfig):
+    name = "payments_redsys"
+    verbose_name = "Redsys payments"
+    default_auto_field = "django.db.models.BigAutoField"
@@ -0,0 +1,214 @@
+"""
+Circuit breaker for the Redsys REST endpoints.
+
+RedsysRestClient keeps a CircuitBreaker per endpoint, tracking the outcome
+and latency of the last calls. When too many of them fail (network errors
+and HTTP error statuses; Redsys errorCode responses are answers, not
+failures) or are too slow, the circuit opens and calls fail at once with
+CircuitOpenError instead of tying up a worker until they time out. After
+open_seconds a few probe calls are let through (half-open): if they succeed
+the circuit closes again, otherwise it stays open for another period.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional, Tuple
+
+from payments import PaymentError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(PaymentError):
+    """Raised without calling Redsys while the endpoint's circuit is open"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(
+            f"Redsys REST endpoint {endpoint} unavailable, "
+            f"retry in {retry_after:.0f}s",
+            code="circuit_open",
+        )
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """
+    Opens when, out of the last window_size calls made within window_seconds
+    (and at least min_calls of them), the fraction that failed reaches
+    failure_rate or the fraction slower than slow_call_duration seconds
+    reaches slow_call_rate.
+
+    Call before_call() before every request, which raises CircuitOpenError
+    if it must not be made, and pass what it returns to record() with the
+    outcome once the request finished.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        failure_rate: float = 0.5,
+        slow_call_duration: Optional[float] = 10.0,
+        slow_call_rate: float = 0.5,
+        min_calls: int = 20,
+        window_size: int = 100,
+        window_seconds: float = 60.0,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if min_calls < 1 or window_size < min_calls:
+            raise ValueError(
+                "window_size must be at least min_calls, and both positive"
+            )
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.times_opened = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0  # half-open calls in flight
+        self._probe_successes = 0
+        self._samples = deque()  # (finished at, duration, failed, slow)
+        self._failures = 0
+        self._slow_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(self.clock())
+
+    @property
+    def available(self) -> bool:
+        """Whether a call would be attempted now (closed or due for a probe)"""
+        return self.state != OPEN
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            return HALF_OPEN
+        return self._state
+
+    def before_call(self) -> Tuple[float, bool]:
+        """Returns a (start time, whether the call is a probe) token"""
+        with self._lock:
+            now = self.clock()
+            state = self._current_state(now)
+            if state == OPEN:
+                raise CircuitOpenError(
+                    self.name, self._opened_at + self.open_seconds - now
+                )
+            if state == HALF_OPEN:
+                if self._state == OPEN:
+                    self._state = HALF_OPEN
+                    self._probes = self._probe_successes = 0
+                if self._probes >= self.half_open_calls:
+                    # other calls are already probing the endpoint
+                    raise CircuitOpenError(self.name, 0)
+                self._probes += 1
+                return now, True
+            return now, False
+
+    def record(self, token: Tuple[float, bool], failed: bool):
+        started, probe = token
+        with self._lock:
+            now = self.clock()
+            duration = now - started
+            slow = (
+                self.slow_call_duration is not None
+                and duration >= self.slow_call_duration
+            )
+            if probe:
+                if self._state != HALF_OPEN:
+                    return  # reset meanwhile
+                self._probes -= 1
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._close()
+                return
+            self._add_sample((now, duration, failed, slow))
+            if self._state == CLOSED and self._should_open(now):
+                self._open(now)
+
+    def _add_sample(self, sample):
+        if len(self._samples) >= self.window_size:
+            self._forget(self._samples.popleft())
+        self._samples.append(sample)
+        self._failures += sample[2]
+        self._slow_calls += sample[3]
+
+    def _forget(self, sample):
+        self._failures -= sample[2]
+        self._slow_calls -= sample[3]
+
+    def _expire(self, now):
+        samples = self._samples
+        while samples and samples[0][0] < now - self.window_seconds:
+            self._forget(samples.popleft())
+
+    def _should_open(self, now):
+        self._expire(now)
+        calls = len(self._samples)
+        if calls < self.min_calls:
+            return False
+        return (
+            self._failures >= self.failure_rate * calls
+            or self._slow_calls >= self.slow_call_rate * calls
+        )
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self.times_opened += 1
+
+    def _close(self):
+        self._state = CLOSED
+        self._samples.clear()
+        self._failures = self._slow_calls = 0
+
+    def reset(self):
+        with self._lock:
+            self._close()
+
+    def stats(self) -> dict:
+        """State, error rate and latency percentiles (in seconds) of the window"""
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            state = self._current_state(now)
+            calls = len(self._samples)
+            durations = sorted(sample[1] for sample in self._samples)
+            return {
+                "state": state,
+                "calls": calls,
+                "failures": self._failures,
+                "slow_calls": self._slow_calls,
+                "error_rate": self._failures / calls if calls else 0.0,
+                "p50": percentile(durations, 0.50) if durations else None,
+                "p95": percentile(durations, 0.95) if durations else None,
+                "p99": percentile(durations, 0.99) if durations else None,
+                "times_opened": self.times_opened,
+                "retry_after": (
+                    max(self._opened_at + self.open_seconds - now, 0.0)
+                    if state == OPEN
+                    else 0.0
+                ),
+            }
@@ -0,0 +1,168 @@
+"""
+Triple DES backends used to derive Redsys per-order signing keys.
+
+Redsys derives the HMAC-SHA256 key for every request by encrypting the order
+number with 3DES (CBC mode, zero IV, zero padding) using the merchant's shared
+secret. The ``cryptography`` backend is used when that package is installed,
+otherwise we fall back to the pure-Python ``pyDes`` implementation.
+
+Neither library is imported until the first cipher is built, so importing
+this module (and payments_redsys) stays cheap.
+"""
+
+import base64
+import functools
+import hashlib
+import importlib.util
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+BLOCK_SIZE = 8
+ZERO_IV = b"\0" * BLOCK_SIZE
+
+
+class PyDesCipher:
+    name = "pydes"
+
+    def __init__(self, key: bytes):
+        import pyDes
+
+        self._des3 = pyDes.triple_des(
+            key, mode=pyDes.CBC, IV=ZERO_IV, pad="\0", padmode=pyDes.PAD_NORMAL
+        )
+        # pyDes keeps the CBC chaining state on the instance
+        self._lock = threading.Lock()
+
+    def encrypt(self, data: bytes) -> bytes:
+        with self._lock:
+            return self._des3.encrypt(data)
+
+
+class CryptographyCipher:
+    name = "cryptography"
+
+    def __init__(self, key: bytes):
+        try:
+            from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+        except ImportError:  # cryptography < 43
+            from cryptography.hazmat.primitives.ciphers.algorithms import TripleDES
+        from cryptography.hazmat.primitives.ciphers import Cipher, modes
+
+        self._cipher = Cipher(TripleDES(key), modes.CBC(ZERO_IV))
+
+    def encrypt(self, data: bytes) -> bytes:
+        padded = data + b"\0" * (-len(data) % BLOCK_SIZE)
+        encryptor = self._cipher.encryptor()
+        return encryptor.update(padded) + encryptor.finalize()
+
+
+def _has_cryptography() -> bool:
+    # checked without importing it, which takes longer than the check
+    try:
+        return importlib.util.find_spec("cryptography") is not None
+    except ValueError:
+        return False
+
+
+CIPHER_BACKENDS = {PyDesCipher.name: PyDesCipher}
+if _has_cryptography():
+    CIPHER_BACKENDS[CryptographyCipher.name] = CryptographyCipher
+
+DEFAULT_CIPHER_BACKEND = (
+    CryptographyCipher.name
+    if CryptographyCipher.name in CIPHER_BACKENDS
+    else PyDesCipher.name
+)
+
+
+@functools.lru_cache(maxsize=32)
+def get_cipher(key: str, backend: Optional[str] = None):
+    """
+    Returns a ready-to-use 3DES cipher for a base64 encoded shared secret.
+
+    Ciphers are cached per (key, backend) so the base64 decoding and the key
+    schedule are only computed once per secret.
+    """
+    backend = backend or DEFAULT_CIPHER_BACKEND
+    try:
+        cipher_class = CIPHER_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f"Unknown cipher backend {backend!r}, "
+            f"available: {', '.join(sorted(CIPHER_BACKENDS))}"
+        )
+    return cipher_class(base64.b64decode(key))
+
+
+def derive_order_key(key: str, order_number: str, backend: Optional[str] = None):
+    """
+    Derives the HMAC key for an order: the order number encrypted with 3DES
+    under the shared secret.
+    """
+    return get_cipher(key, backend).encrypt(str(order_number).encode("ascii"))
+
+
+@functools.lru_cache(maxsize=32)
+def secret_fingerprint(key: str) -> str:
+    # lets caches tell secrets apart without holding on to them
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class OrderKeyCache:
+    """
+    Thread-safe, size-bounded LRU cache of derived per-order keys.
+
+    Redsys notifies the same order several times (MERCHANTURL retries and the
+    URLOK/URLKO redirect), each needing the same derived key. Entries are keyed
+    by (secret fingerprint, order number) so one cache can be shared between
+    secrets.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        if maxsize < 1:
+            raise ValueError("maxsize must be a positive integer")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def derive(self, key: str, order_number: str, backend: Optional[str] = None):
+        cache_key = (secret_fingerprint(key), str(order_number))
+        with self._lock:
+            derived = self._keys.get(cache_key)
+            if derived is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return derived
+            self.misses += 1
+
+        derived = derive_order_key(key, order_number, backend)
+
+        with self._lock:
+            self._keys[cache_key] = derived
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+        return derived
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._keys),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
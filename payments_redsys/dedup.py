@@ -0,0 +1,132 @@
+"""
+Stores of already processed Redsys notifications.
+
+Redsys retries MERCHANTURL notifications, and with process_on_redirect the same
+result also arrives through the browser redirect. A notification store lets
+RedsysProvider recognise those repeats by (order number, Ds_Signature) and
+answer them without verifying or saving anything again.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from django.core.cache import caches
+
+
+class NotificationStore:
+    """
+    Base class for notification stores. Subclasses implement get and add;
+    the stored value is whether the notification was successful.
+    """
+
+    def __init__(self, ttl: int = 3600):
+        self.ttl = ttl
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bool]:
+        raise NotImplementedError
+
+    def add(self, key: str, success: bool):
+        raise NotImplementedError
+
+    async def aget(self, key: str) -> Optional[bool]:
+        return self.get(key)
+
+    async def aadd(self, key: str, success: bool):
+        self.add(key, success)
+
+    def record_suppressed(self):
+        with self._lock:
+            self.suppressed += 1
+
+    def stats(self) -> dict:
+        return {"suppressed": self.suppressed}
+
+
+class InMemoryNotificationStore(NotificationStore):
+    """Per-process LRU of processed notifications, bounded by maxsize"""
+
+    def __init__(self, ttl: int = 3600, maxsize: int = 10000):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, success = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return success
+
+    def add(self, key, success):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, success)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {**super().stats(), "size": len(self._entries)}
+
+
+class CacheNotificationStore(NotificationStore):
+    """
+    Stores processed notifications in a Django cache, so they are shared
+    between processes. Use a DatabaseCache alias to keep them in a table.
+    """
+
+    def __init__(
+        self,
+        ttl: int = 3600,
+        cache_alias: str = "default",
+        key_prefix: str = "redsys-notification",
+    ):
+        super().__init__(ttl)
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, key):
+        return f"{self.key_prefix}:{key}"
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def add(self, key, success):
+        self.cache.set(self.make_key(key), success, self.ttl)
+
+    async def aget(self, key):
+        return await self.cache.aget(self.make_key(key))
+
+    async def aadd(self, key, success):
+        await self.cache.aset(self.make_key(key), success, self.ttl)
+
+
+NOTIFICATION_STORES = {
+    "memory": InMemoryNotificationStore,
+    "cache": CacheNotificationStore,
+}
+
+
+def get_notification_store(store, ttl: int = 3600):
+    """Builds a store from a NOTIFICATION_STORES name, or returns it as is"""
+    if store is None or isinstance(store, NotificationStore):
+        return store
+    try:
+        return NOTIFICATION_STORES[store](ttl=ttl)
+    except KeyError:
+        raise ValueError(
+            f"Unknown notification store {store!r}, "
+            f"available: {', '.join(sorted(NOTIFICATION_STORES))}"
+        )
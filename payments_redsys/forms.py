@@ -0,0 +1,19 @@
+"""
+Forms used by RedsysProvider. Imported on first use, as django.forms and
+payments.forms are not needed to verify notifications with
+fast_notifications.
+"""
+
+from django import forms
+
+from . import NOTIFICATION_FIELDS
+
+
+class RedsysResponseForm(forms.Form):
+    Ds_SignatureVersion = forms.CharField(
+        max_length=NOTIFICATION_FIELDS["Ds_SignatureVersion"]
+    )
+    Ds_Signature = forms.CharField(max_length=NOTIFICATION_FIELDS["Ds_Signature"])
+    Ds_MerchantParameters = forms.CharField(
+        max_length=NOTIFICATION_FIELDS["Ds_MerchantParameters"]
+    )
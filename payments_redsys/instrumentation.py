@@ -0,0 +1,129 @@
+"""
+Timing hooks for RedsysProvider operations.
+
+Observers are callables receiving an OperationEvent after each timed
+operation (get_form, encode_redsys_request, compute_signature,
+validate_and_parse_response, process_data, refund and their async
+counterparts). They are configured with the provider's "observers" option,
+either as callables or as dotted paths to them.
+"""
+
+import logging
+import time
+from typing import Any, NamedTuple, Optional
+
+from django.utils.module_loading import import_string
+
+from .signals import operation_finished
+
+logger = logging.getLogger(__name__)
+
+
+class OperationEvent(NamedTuple):
+    operation: str
+    duration: float  # seconds
+    provider: Any
+    payment: Optional[Any] = None
+    response_code: Optional[str] = None  # Ds_Response, when there is one
+    error: Optional[BaseException] = None
+
+
+class OperationTimer:
+    __slots__ = ("provider", "operation", "payment", "response_code", "start")
+
+    def __init__(self, provider, operation, payment=None):
+        self.provider = provider
+        self.operation = operation
+        self.payment = payment
+        self.response_code = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        event = OperationEvent(
+            self.operation,
+            time.perf_counter() - self.start,
+            self.provider,
+            self.payment,
+            self.response_code,
+            exc,
+        )
+        for observer in self.provider.observers:
+            try:
+                observer(event)
+            except Exception:
+                logger.exception("observer %r failed for %s", observer, self.operation)
+        return False
+
+
+class NullTimer:
+    """Stand-in for OperationTimer when there are no observers"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def load_observers(observers):
+    return [
+        import_string(observer) if isinstance(observer, str) else observer
+        for observer in observers or ()
+    ]
+
+
+def signal_observer(event: OperationEvent):
+    """Re-sends every event as the operation_finished Django signal"""
+    operation_finished.send(sender=type(event.provider), event=event)
+
+
+def logging_observer(event: OperationEvent):
+    logger.info(
+        "redsys %s took %.2fms response_code=%s error=%r",
+        event.operation,
+        event.duration * 1000,
+        event.response_code,
+        event.error,
+    )
+
+
+class OpenTelemetryObserver:
+    """
+    Records every event as an OpenTelemetry span. Spans are created once the
+    operation has finished, so nested operations are not linked as children.
+    """
+
+    def __init__(self, tracer_name: str = "payments_redsys"):
+        from opentelemetry import trace
+
+        self.tracer = trace.get_tracer(tracer_name)
+
+    def __call__(self, event: OperationEvent):
+        from opentelemetry.trace import Status, StatusCode
+
+        end_time = time.time_ns()
+        attributes = {"redsys.merchant_code": event.provider.merchant_code}
+        if event.payment is not None:
+            attributes["redsys.payment_id"] = str(event.payment.pk)
+        if event.response_code is not None:
+            attributes["redsys.response_code"] = str(event.response_code)
+        span = self.tracer.start_span(
+            f"redsys.{event.operation}",
+            start_time=end_time - int(event.duration * 1e9),
+            attributes=attributes,
+        )
+        if event.error is not None:
+            span.record_exception(event.error)
+            span.set_status(Status(StatusCode.ERROR))
+        span.end(end_time=end_time)
@@ -0,0 +1,121 @@
+"""
+Logging helpers for the notification and request paths.
+
+Redsys parameters carry card numbers, card tokens and signatures, which must
+not reach the logs: Redacted wraps them so they are masked, and only when a
+record is actually emitted, never while building it. Notification records
+carry their fields as redsys_* attributes for structured log formatters.
+
+Successful notifications can be sampled with LogSampler to cut log volume at
+peak; failures are always logged.
+"""
+
+import json
+import logging
+import random
+from collections.abc import Mapping
+
+# upper-cased names of the parameters that are masked in logs, Redsys
+# parameter names being case insensitive
+CARD_FIELDS = frozenset(
+    (
+        "DS_MERCHANT_PAN",
+        "DS_CARD_NUMBER",
+    )
+)
+SECRET_FIELDS = frozenset(
+    (
+        "DS_SIGNATURE",
+        "DS_MERCHANT_CVV2",
+        "DS_MERCHANT_EXPIRYDATE",
+        "DS_EXPIRYDATE",
+        "DS_MERCHANT_IDENTIFIER",
+        "DS_MERCHANT_IDENTIFIER_RESPONSE",
+    )
+)
+
+# base64 encoded parameters, which may contain any of the above
+ENCODED_FIELDS = frozenset(("DS_MERCHANTPARAMETERS",))
+
+REDACTED = "[redacted]"
+
+
+def mask_card_number(value) -> str:
+    # keep the last four digits, as printed on receipts
+    value = str(value)
+    return "*" * max(len(value) - 4, 0) + value[-4:]
+
+
+def redact(data: Mapping) -> dict:
+    """Returns a copy of data with card and signature fields masked"""
+    redacted = {}
+    for key, value in data.items():
+        name = str(key).upper()
+        if name in CARD_FIELDS and value:
+            value = mask_card_number(value)
+        elif name in SECRET_FIELDS and value:
+            value = REDACTED
+        elif name in ENCODED_FIELDS and value:
+            value = f"[{len(value)} characters]"
+        redacted[key] = value
+    return redacted
+
+
+class Redacted:
+    """
+    Log argument for a mapping of Redsys parameters, masked with redact()
+    when the record is formatted
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: Mapping):
+        self.data = data
+
+    def as_dict(self) -> dict:
+        return redact(self.data)
+
+    def __str__(self):
+        return json.dumps(self.as_dict(), default=str)
+
+    __repr__ = __str__
+
+
+class LogSampler:
+    """Decides which records to log, for a rate between 0 (none) and 1 (all)"""
+
+    __slots__ = ("rate",)
+
+    def __init__(self, rate: float = 1.0):
+        if not 0 <= rate <= 1:
+            raise ValueError("the sample rate must be between 0 and 1")
+        self.rate = rate
+
+    def __call__(self) -> bool:
+        if self.rate >= 1:
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+
+def log_notification(
+    logger: logging.Logger, level: int, payment, notification, reason: str
+):
+    """Logs a verified notification with its (redacted) fields"""
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(
+        level,
+        "payment %s order %s Ds_Response=%s Ds_TransactionType=%s: %s",
+        payment.pk,
+        notification.order,
+        notification.response,
+        notification.transaction_type,
+        reason,
+        extra={
+            "redsys_payment": payment.pk,
+            "redsys_order": notification.order,
+            "redsys_response": notification.response,
+            "redsys_transaction_type": notification.transaction_type,
+            "redsys_fields": Redacted(notification),
+        },
+    )
@@ -0,0 +1,53 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from payments.core import provider_factory
+
+from payments_redsys.polling import poll_waiting_payments
+
+
+class Command(BaseCommand):
+    help = (
+        "Asks Redsys for the status of waiting payments that never received a "
+        "notification, and updates them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--variant", default="redsys")
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            default=30,
+            metavar="MINUTES",
+            help="only poll payments waiting for longer than this",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument(
+            "--max-rate", type=float, help="maximum requests per second to Redsys"
+        )
+        parser.add_argument("--limit", type=int, help="poll at most this many")
+
+    def handle(self, *args, **options):
+        provider = provider_factory(options["variant"])
+        counts = Counter()
+        for result in poll_waiting_payments(
+            provider,
+            options["variant"],
+            older_than=timedelta(minutes=options["older_than"]),
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            max_rate=options["max_rate"],
+            limit=options["limit"],
+        ):
+            if result.error:
+                counts["error"] += 1
+                self.stderr.write(f"payment {result.payment.pk}: {result.error}")
+            else:
+                counts[result.status] += 1
+
+        summary = ", ".join(
+            f"{status}={count}" for status, count in sorted(counts.items())
+        )
+        self.stdout.write(f"Polled: {summary or 'none'}")
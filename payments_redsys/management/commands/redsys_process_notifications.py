@@ -0,0 +1,56 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from payments.core import provider_factory
+
+from payments_redsys.queue import apply_queued_notification
+
+
+class Command(BaseCommand):
+    help = (
+        "Applies the Redsys notifications queued by providers with a "
+        "notification_queue to their payments"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--variant", default="redsys")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--loop", action="store_true", help="keep polling the queue"
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="seconds to wait when the queue is empty, with --loop",
+        )
+        parser.add_argument(
+            "--purge-days",
+            type=int,
+            help="delete notifications processed more than this many days ago",
+        )
+
+    def handle(self, *args, **options):
+        queue = provider_factory(options["variant"]).notification_queue
+        if queue is None:
+            raise CommandError(
+                f"variant {options['variant']!r} has no notification_queue"
+            )
+
+        if options["purge_days"] is not None:
+            before = timezone.now() - timedelta(days=options["purge_days"])
+            deleted = queue.delete_processed(before)
+            self.stdout.write(f"Deleted {deleted} processed notifications")
+
+        total = 0
+        while True:
+            taken = queue.drain(apply_queued_notification, options["batch_size"])
+            total += taken
+            if taken:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+        self.stdout.write(f"Processed {total} notifications")
@@ -0,0 +1,51 @@
+import csv
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from payments.core import provider_factory
+
+from payments_redsys.reconciliation import read_report, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares payments with an operations report exported from the Redsys "
+        "administration module, writing every mismatch as a CSV line"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("report", help="path to the exported CSV report")
+        parser.add_argument("--variant", default="redsys")
+        parser.add_argument("--delimiter", default=";")
+        parser.add_argument("--encoding", default="utf-8")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--column",
+            action="append",
+            default=[],
+            metavar="FIELD=HEADER",
+            help="report header to use for order, amount, currency, response "
+            "or transaction_type",
+        )
+
+    def handle(self, *args, **options):
+        provider = provider_factory(options["variant"])
+        try:
+            columns = dict(column.split("=", 1) for column in options["column"])
+        except ValueError:
+            raise CommandError("--column must be given as FIELD=HEADER")
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(["line", "order", "kind", "redsys", "payment"])
+        counts = Counter()
+        with open(options["report"], encoding=options["encoding"], newline="") as f:
+            try:
+                rows = read_report(f, options["delimiter"], columns)
+                for mismatch in reconcile(provider, rows, options["chunk_size"]):
+                    counts[mismatch.kind] += 1
+                    writer.writerow(mismatch)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        summary = ", ".join(f"{kind}={count}" for kind, count in sorted(counts.items()))
+        self.stderr.write(f"Mismatches: {summary or 'none'}")
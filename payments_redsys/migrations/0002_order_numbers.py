@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments_redsys", "0001_initial"),
+        migrations.swappable_dependency(settings.PAYMENT_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderNumberSequence",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=32, primary_key=True, serialize=False),
+                ),
+                ("next_value", models.PositiveBigIntegerField(default=1)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="OrderNumber",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("order_number", models.CharField(max_length=12, unique=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("used", models.BooleanField(default=False)),
+                ("paid", models.BooleanField(default=False)),
+                (
+                    "payment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.PAYMENT_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["pk"],
+            },
+        ),
+    ]
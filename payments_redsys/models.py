@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db import models
+
+from .notification import RedsysNotification
+
+
+class QueuedNotification(models.Model):
+    """
+    A verified Redsys notification waiting to be applied to its payment, see
+    payments_redsys.queue.DatabaseNotificationQueue
+    """
+
+    payment = models.ForeignKey(
+        settings.PAYMENT_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    order_number = models.CharField(max_length=12)
+    merchant_parameters = models.TextField()  # decoded Ds_MerchantParameters
+    created = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    retry_at = models.DateTimeField(null=True, blank=True)  # after a failure
+
+    class Meta:
+        ordering = ["pk"]
+
+    def __str__(self):
+        return f"{self.order_number} ({self.created})"
+
+    @property
+    def notification(self) -> RedsysNotification:
+        return RedsysNotification.from_bytes(self.merchant_parameters.encode())
+
+
+class OrderNumberSequence(models.Model):
+    """
+    Counter of the order numbers handed out by
+    payments_redsys.allocators.DatabaseOrderNumberAllocator
+    """
+
+    name = models.CharField(max_length=32, primary_key=True)
+    next_value = models.PositiveBigIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+
+class OrderNumber(models.Model):
+    """An order number allocated for an attempt at a payment"""
+
+    order_number = models.CharField(max_length=12, unique=True)
+    payment = models.ForeignKey(
+        settings.PAYMENT_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    used = models.BooleanField(default=False)  # Redsys answered for it
+    paid = models.BooleanField(default=False)  # authorised with it
+
+    class Meta:
+        ordering = ["pk"]
+
+    def __str__(self):
+        return self.order_number
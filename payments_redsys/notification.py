@@ -0,0 +1,109 @@
+"""
+Decoded Redsys merchant parameters (Ds_MerchantParameters).
+"""
+
+import base64
+import json
+from collections.abc import Mapping
+from typing import Optional, Union
+from urllib.parse import unquote_plus
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def _int_or_none(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _unquoted_or_none(value) -> Optional[str]:
+    return unquote_plus(value) if value is not None else None
+
+
+class RedsysNotification(Mapping):
+    """
+    Merchant parameters sent by Redsys in notifications and REST responses,
+    with typed attributes for the commonly used fields.
+
+    It is also a read-only mapping of the raw Ds_* fields, so it can be used
+    where a dict of merchant parameters is expected.
+    """
+
+    __slots__ = (
+        "response",
+        "amount",
+        "currency",
+        "order",
+        "transaction_type",
+        "authorisation_code",
+        "merchant_code",
+        "terminal",
+        "date",
+        "hour",
+        "raw",
+        "source",
+    )
+
+    def __init__(self, raw: dict, source: Optional[bytes] = None):
+        self.raw = raw
+        self.source = source  # the JSON document raw was parsed from
+        self.response = _int_or_none(raw.get("Ds_Response"))  # e.g. "0000" -> 0
+        self.amount = _int_or_none(raw.get("Ds_Amount"))  # in cents
+        self.currency = raw.get("Ds_Currency")
+        self.order = _unquoted_or_none(raw.get("Ds_Order"))
+        self.transaction_type = raw.get("Ds_TransactionType")
+        self.authorisation_code = raw.get("Ds_AuthorisationCode")
+        self.merchant_code = raw.get("Ds_MerchantCode")
+        self.terminal = raw.get("Ds_Terminal")
+        self.date = _unquoted_or_none(raw.get("Ds_Date"))
+        self.hour = _unquoted_or_none(raw.get("Ds_Hour"))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RedsysNotification":
+        """
+        Builds a notification from the base64-decoded merchant parameters.
+        Raises ValueError if they are not a JSON object.
+        """
+        raw = json_loads(data)
+        if not isinstance(raw, dict):
+            raise ValueError("the merchant parameters are not a JSON object")
+        return cls(raw, data)
+
+    @classmethod
+    def from_merchant_parameters(
+        cls, merchant_parameters: Union[str, bytes]
+    ) -> "RedsysNotification":
+        """
+        Builds a notification from the base64 Ds_MerchantParameters. Raises
+        ValueError if they can't be decoded.
+        """
+        return cls.from_bytes(base64.b64decode(merchant_parameters))
+
+    @property
+    def extra_data(self) -> str:
+        """JSON text suitable for Payment.extra_data, as sent by Redsys"""
+        if self.source is None:
+            return json.dumps(self.raw)
+        return self.source.decode()
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __repr__(self):
+        return (
+            f"<RedsysNotification order={self.order!r} response={self.response!r}"
+            f" transaction_type={self.transaction_type!r}>"
+        )
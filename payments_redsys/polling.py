@@ -0,0 +1,84 @@
+"""
+Sweeping of payments that never received a Redsys notification.
+
+Notifications to MERCHANTURL can be lost, leaving payments waiting forever.
+poll_waiting_payments finds stale waiting payments in batches and asks Redsys
+for their status with RedsysProvider.query_statuses.
+"""
+
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from typing import Iterator, Optional
+
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+
+
+class RateLimiter:
+    """Spaces out calls to at most rate per second, across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Books the next free slot and returns how long to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            return slot - now
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def stale_payments(variant: str, older_than: timedelta = timedelta(minutes=30)):
+    """Waiting payments of a variant not modified in the last older_than"""
+    return get_payment_model()._default_manager.filter(
+        variant=variant,
+        status=PaymentStatus.WAITING,
+        modified__lt=timezone.now() - older_than,
+    )
+
+
+def poll_waiting_payments(
+    provider,
+    variant: str,
+    older_than: timedelta = timedelta(minutes=30),
+    batch_size: int = 500,
+    concurrency: int = 8,
+    max_rate: Optional[float] = None,
+    limit: Optional[int] = None,
+) -> Iterator:
+    """
+    Queries the status of stale waiting payments, batch_size at a time, and
+    yields a QueryResult per payment.
+
+    Batches are read by ascending pk, so payments updated by a batch do not
+    shift the following ones.
+    """
+    queryset = stale_payments(variant, older_than).order_by("pk")
+    last_pk = None
+    polled = 0
+    while limit is None or polled < limit:
+        batch_queryset = (
+            queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        )
+        size = batch_size if limit is None else min(batch_size, limit - polled)
+        batch = list(batch_queryset[:size])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        polled += len(batch)
+        yield from provider.query_statuses(batch, concurrency, max_rate)
@@ -0,0 +1,177 @@
+"""
+Queues for deferred processing of Redsys notifications.
+
+With a notification queue, RedsysProvider.process_data only verifies the
+notification and enqueues it before answering Redsys; the status change,
+and the status_changed receivers it triggers, run later in a worker (see the
+redsys_process_notifications management command).
+"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Callable
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from payments import get_payment_model
+from payments.core import provider_factory
+
+from .notification import RedsysNotification
+
+logger = logging.getLogger(__name__)
+
+# handler(payment, notification) applies a notification to its payment
+Handler = Callable[[object, RedsysNotification], object]
+
+
+class NotificationQueue:
+    """
+    Base class for notification queues. put must persist the notification
+    before returning. Pull-based queues implement drain; push-based ones
+    (e.g. sending a task to a broker) can have their consumer call
+    RedsysProvider.apply_notification instead.
+    """
+
+    def put(self, payment, order_number: str, notification: RedsysNotification):
+        raise NotImplementedError
+
+    async def aput(self, payment, order_number: str, notification: RedsysNotification):
+        await sync_to_async(self.put)(payment, order_number, notification)
+
+    def drain(self, handler: Handler, batch_size: int = 100) -> int:
+        """
+        Passes up to batch_size queued notifications to handler, in the order
+        they were received, and returns how many were taken
+        """
+        raise NotImplementedError
+
+
+class DatabaseNotificationQueue(NotificationQueue):
+    """
+    Outbox table of notifications (payments_redsys.models.QueuedNotification),
+    written in the same database as payments. Requires payments_redsys in
+    INSTALLED_APPS.
+
+    A batch is claimed in a short transaction, for claim_timeout seconds,
+    and each notification is then applied and marked as processed in a
+    transaction of its own, so status_changed receivers run after the ones
+    before have been committed. Notifications of a worker that died are
+    taken again once the claim expires.
+
+    Notifications whose handler raises are retried in later batches, up to
+    max_attempts times, waiting retry_delay seconds after the first failure
+    and twice as long after each of the next ones. Concurrent workers skip
+    the rows being claimed by others where the database supports it.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        retry_delay: float = 60.0,
+        claim_timeout: float = 300.0,
+    ):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+
+    @property
+    def model(self):
+        # imported late: the provider is loaded before the app registry
+        from .models import QueuedNotification
+
+        return QueuedNotification
+
+    def put(self, payment, order_number, notification):
+        self.model._default_manager.create(
+            payment=payment,
+            order_number=order_number,
+            merchant_parameters=notification.extra_data,
+        )
+
+    async def aput(self, payment, order_number, notification):
+        await self.model._default_manager.acreate(
+            payment=payment,
+            order_number=order_number,
+            merchant_parameters=notification.extra_data,
+        )
+
+    def pending(self):
+        """Notifications to apply now: not processed and not waiting to retry"""
+        return self.model._default_manager.filter(
+            Q(retry_at=None) | Q(retry_at__lte=timezone.now()),
+            processed_at=None,
+            attempts__lt=self.max_attempts,
+        )
+
+    def claim(self, batch_size=100):
+        """
+        Takes up to batch_size pending notifications, counting an attempt
+        and hiding them from other workers for claim_timeout seconds
+        """
+        with transaction.atomic():
+            batch = list(
+                self.pending()
+                .select_for_update(skip_locked=True)
+                .order_by("pk")[:batch_size]
+            )
+            self.model._default_manager.filter(
+                pk__in=[item.pk for item in batch]
+            ).update(
+                attempts=F("attempts") + 1,
+                retry_at=timezone.now() + timedelta(seconds=self.claim_timeout),
+            )
+        for item in batch:
+            item.attempts += 1
+        return batch
+
+    def drain(self, handler, batch_size=100):
+        batch = self.claim(batch_size)
+        payments = get_payment_model()._default_manager.in_bulk(
+            {item.payment_id for item in batch}
+        )
+        for item in batch:
+            try:
+                with transaction.atomic():
+                    handler(payments[item.payment_id], item.notification)
+                    self.model._default_manager.filter(pk=item.pk).update(
+                        processed_at=timezone.now(), retry_at=None
+                    )
+            except Exception as e:
+                logger.exception("queued notification %d failed", item.pk)
+                item.last_error = repr(e)
+                item.retry_at = timezone.now() + timedelta(
+                    seconds=self.retry_delay * 2 ** (item.attempts - 1)
+                )
+                item.save(update_fields=["last_error", "retry_at"])
+        return len(batch)
+
+    def delete_processed(self, before: datetime) -> int:
+        deleted, _ = self.model._default_manager.filter(
+            processed_at__lt=before
+        ).delete()
+        return deleted
+
+
+def apply_queued_notification(payment, notification: RedsysNotification):
+    """Handler applying a notification with the provider of the payment's variant"""
+    return provider_factory(payment.variant).apply_notification(payment, notification)
+
+
+NOTIFICATION_QUEUES = {
+    "database": DatabaseNotificationQueue,
+}
+
+
+def get_notification_queue(queue):
+    """Builds a queue from a NOTIFICATION_QUEUES name, or returns it as is"""
+    if queue is None or isinstance(queue, NotificationQueue):
+        return queue
+    try:
+        return NOTIFICATION_QUEUES[queue]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown notification queue {queue!r}, "
+            f"available: {', '.join(sorted(NOTIFICATION_QUEUES))}"
+        )
@@ -0,0 +1,208 @@
+"""
+Reconciliation of payments against operation reports exported from the Redsys
+administration module.
+
+Reports are read as a stream of rows and checked in chunks, with one query per
+chunk, so memory use does not grow with the size of the report.
+"""
+
+import csv
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from . import ISO_CURRENCY_LOOKUP
+from .responses import (
+    AUTHORISATION,
+    CANCELLATION,
+    CONFIRMATION,
+    PREAUTHORISATION,
+    REFUND,
+)
+
+# report headers recognised for each field, in the order they are tried
+DEFAULT_COLUMNS = {
+    "order": ("Número de pedido", "Pedido", "Order", "Order number", "Ds_Order"),
+    "amount": ("Importe", "Amount"),
+    "currency": ("Moneda", "Currency", "Ds_Currency"),
+    "response": (
+        "Código de respuesta",
+        "Código respuesta",
+        "Response code",
+        "Ds_Response",
+    ),
+    "transaction_type": (
+        "Tipo operación",
+        "Tipo de operación",
+        "Transaction type",
+        "Ds_TransactionType",
+    ),
+}
+
+TRANSACTION_TYPE_NAMES = {
+    "autorización": AUTHORISATION,
+    "authorisation": AUTHORISATION,
+    "authorization": AUTHORISATION,
+    "preautorización": PREAUTHORISATION,
+    "preauthorisation": PREAUTHORISATION,
+    "preauthorization": PREAUTHORISATION,
+    "confirmación": CONFIRMATION,
+    "confirmation": CONFIRMATION,
+    "devolución": REFUND,
+    "refund": REFUND,
+    "anulación": CANCELLATION,
+    "cancellation": CANCELLATION,
+}
+
+
+class ReportRow(NamedTuple):
+    line: int
+    order: str
+    amount: Optional[Decimal]
+    currency: Optional[str]  # ISO 4217 numeric code
+    response: Optional[int]
+    transaction_type: Optional[str]
+
+
+class Mismatch(NamedTuple):
+    line: int
+    order: str
+    kind: str  # "missing", "amount", "currency" or "status"
+    expected: Optional[str]  # according to Redsys
+    actual: Optional[str]  # according to our payment
+
+
+def parse_amount(value: str) -> Optional[Decimal]:
+    """Parses amounts as "1.234,56" (Redsys' Spanish format) or "1234.56" """
+    value = value.strip().replace(" ", "")
+    if "," in value:
+        value = value.replace(".", "").replace(",", ".")
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
+
+
+def parse_response(value: str) -> Optional[int]:
+    # e.g. "0000" or "0190 Denegada"
+    code = value.strip().split(" ", 1)[0]
+    return int(code) if code.isdigit() else None
+
+
+def parse_transaction_type(value: str) -> Optional[str]:
+    value = value.strip()
+    return TRANSACTION_TYPE_NAMES.get(value.lower(), value or None)
+
+
+def resolve_columns(header: Iterable[str], columns: Optional[dict] = None) -> dict:
+    """Maps each field to its index in the header, None if not present"""
+    header = [name.strip() for name in header]
+    candidates = {**DEFAULT_COLUMNS}
+    for field, name in (columns or {}).items():
+        candidates[field] = (name,)
+    indexes = {}
+    for field, names in candidates.items():
+        indexes[field] = next(
+            (header.index(name) for name in names if name in header), None
+        )
+    if indexes["order"] is None:
+        raise ValueError("the report has no order number column")
+    return indexes
+
+
+def read_report(
+    lines: Iterable[str], delimiter: str = ";", columns: Optional[dict] = None
+) -> Iterator[ReportRow]:
+    """Yields the rows of a Redsys operations report, one at a time"""
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("empty report")
+    indexes = resolve_columns(header, columns)
+
+    def field(row, name):
+        index = indexes[name]
+        return row[index] if index is not None and index < len(row) else None
+
+    for row in reader:
+        order = field(row, "order")
+        if not order:
+            continue
+        amount = field(row, "amount")
+        currency = field(row, "currency")
+        response = field(row, "response")
+        transaction_type = field(row, "transaction_type")
+        yield ReportRow(
+            reader.line_num,
+            order.strip(),
+            parse_amount(amount) if amount else None,
+            (
+                ISO_CURRENCY_LOOKUP.get(currency.strip(), currency.strip())
+                if currency
+                else None
+            ),
+            parse_response(response) if response else None,
+            parse_transaction_type(transaction_type) if transaction_type else None,
+        )
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def reconcile(provider, rows: Iterable[ReportRow], chunk_size: int = 1000):
+    """
+    Compares report rows with our payments, yielding a Mismatch for every
+    difference found
+    """
+    for chunk in chunked(rows, chunk_size):
+        payments = provider.get_payments_by_order_number(row.order for row in chunk)
+        for row in chunk:
+            payment = payments.get(row.order)
+            if payment is None:
+                yield Mismatch(row.line, row.order, "missing", row.order, None)
+                continue
+            yield from check_row(provider, row, payment)
+
+
+# statuses a payment can move on to after each status reported by Redsys,
+# e.g. a confirmed payment may have been refunded since
+LATER_STATUSES = {
+    "preauth": ("confirmed", "refunded"),
+    "confirmed": ("refunded",),
+}
+
+
+def reachable_statuses(status):
+    return (status, *LATER_STATUSES.get(status, ()))
+
+
+def check_row(provider, row: ReportRow, payment):
+    if row.currency is not None:
+        currency = provider.get_currency_code(payment)
+        if currency != row.currency:
+            yield Mismatch(row.line, row.order, "currency", row.currency, currency)
+
+    outcome = None
+    if row.response is not None:
+        outcome = provider.response_dispatcher.resolve(
+            row.response, row.transaction_type or AUTHORISATION
+        )
+        if outcome.status and payment.status not in reachable_statuses(outcome.status):
+            yield Mismatch(
+                row.line, row.order, "status", outcome.status, payment.status
+            )
+
+    # authorisations should be for the full payment amount
+    authorisation = row.transaction_type in (None, AUTHORISATION)
+    if (
+        row.amount is not None
+        and authorisation
+        and (outcome is None or outcome.success)
+    ):
+        if Decimal(payment.total) != row.amount:
+            yield Mismatch(
+                row.line, row.order, "amount", str(row.amount), str(payment.total)
+            )
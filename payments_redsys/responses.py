@@ -0,0 +1,211 @@
+"""
+Redsys response codes (Ds_Response) and what they mean for a payment.
+
+The dispatch table maps every (Ds_Response, Ds_TransactionType) pair in the
+catalogue to a ResponseOutcome, so resolving a notification is a single dict
+lookup. Deployments can override entries with the provider's
+"response_outcomes" option.
+
+https://pagosonline.redsys.es/desarrolladores-inicio/integrate-con-nosotros/parametros-de-entrada-y-salida/
+"""
+
+from typing import NamedTuple, Optional
+
+
+class ResponseOutcome(NamedTuple):
+    success: bool
+    status: Optional[str]  # new payment status, None to leave it unchanged
+    reason: str
+
+
+# Ds_Response codes and their meaning
+RESPONSE_DESCRIPTIONS = {
+    **{code: "Authorised transaction" for code in range(100)},
+    400: "Cancellation authorised",
+    900: "Refund or confirmation authorised",
+    101: "Expired card",
+    102: "Card temporarily blocked or under suspicion of fraud",
+    104: "Operation not allowed for this card or terminal",
+    106: "PIN attempts exceeded",
+    107: "Contact the card issuer",
+    109: "Invalid merchant or terminal",
+    110: "Invalid amount",
+    114: "Card not allowed for this operation",
+    116: "Insufficient funds",
+    118: "Card not registered",
+    125: "Card not effective",
+    129: "Incorrect security code (CVV2/CVC2)",
+    167: "Contact the card issuer: suspected fraud",
+    172: "Denied, do not retry",
+    173: "Denied, do not retry without updating card details",
+    174: "Denied, do not retry before 72 hours",
+    180: "Card not supported by the service",
+    181: "Card with debit or credit restrictions",
+    182: "Card with debit or credit restrictions",
+    184: "Cardholder authentication error",
+    190: "Denied without a specific reason",
+    191: "Wrong expiry date",
+    195: "Requires SCA authentication",
+    202: "Card temporarily blocked or under suspicion of fraud",
+    904: "Merchant not registered in FUC",
+    909: "System error",
+    912: "Issuer not available",
+    913: "Duplicate order",
+    944: "Incorrect session",
+    950: "Refund not allowed",
+    9064: "Incorrect number of card digits",
+    9078: "Operation type not allowed for this card",
+    9093: "Card does not exist",
+    9094: "Rejected by international servers",
+    9104: "Secure merchant and cardholder without secure purchase key",
+    9218: "Merchant does not allow secure operations by entry",
+    9253: "Card does not pass the check-digit",
+    9256: "Merchant cannot perform preauthorisations",
+    9257: "Card does not allow preauthorisations",
+    9261: "Operation stopped for exceeding the SIS restriction control",
+    9912: "Issuer not available",
+    9913: "Error in the merchant confirmation",
+    9914: "KO confirmation from the merchant",
+    9915: "Payment cancelled by the user",
+    9928: "Deferred authorisation cancelled by the SIS",
+    9929: "Deferred authorisation cancelled by the merchant",
+    9997: "Another transaction with the same card is being processed",
+    9998: "Operation in card data request process",
+    9999: "Operation redirected to the issuer for authentication",
+}
+
+# errorCode values returned by the REST endpoint, for reporting
+SIS_ERROR_DESCRIPTIONS = {
+    "SIS0007": "Error disassembling the input data",
+    "SIS0008": "Missing Ds_Merchant_MerchantCode",
+    "SIS0010": "Missing Ds_Merchant_Terminal",
+    "SIS0015": "Missing Ds_Merchant_Currency",
+    "SIS0018": "Missing Ds_Merchant_Amount",
+    "SIS0019": "Missing Ds_Merchant_Order",
+    "SIS0026": "Merchant or terminal does not exist",
+    "SIS0027": "Currency not supported by the terminal",
+    "SIS0041": "Error calculating the signature",
+    "SIS0042": "Signature mismatch",
+    "SIS0051": "Duplicate order number",
+    "SIS0054": "No operation to refund",
+    "SIS0055": "More than one payment with this order number",
+    "SIS0056": "Operation not authorised, cannot be refunded",
+    "SIS0057": "Refund amount exceeds the original amount",
+    "SIS0058": "Inconsistent data in the confirmation",
+    "SIS0059": "No operation to confirm",
+    "SIS0060": "Confirmation for this preauthorisation already exists",
+    "SIS0062": "Confirmation amount exceeds the preauthorised amount",
+    "SIS0063": "Card number not available",
+    "SIS0074": "Missing Ds_Merchant_Order",
+    "SIS0075": "Ds_Merchant_Order has the wrong length",
+    "SIS0076": "Ds_Merchant_Order does not start with four digits",
+    "SIS0078": "Payment method not available",
+    "SIS0093": "Card not found",
+    "SIS0094": "Card not authenticated as 3D Secure",
+    "SIS0112": "Transaction type not allowed",
+    "SIS0218": "Operations must be sent through the web service",
+    "SIS0252": "Merchant does not allow card data to be sent",
+    "SIS0253": "Card does not pass the check-digit",
+    "SIS0256": "Merchant cannot perform preauthorisations",
+    "SIS0257": "Card does not allow preauthorisations",
+    "SIS0261": "Operation exceeds the SIS restriction control",
+    "SIS0274": "Unknown or unsupported transaction type",
+    "SIS0298": "Merchant does not allow card-on-file operations",
+    "SIS0319": "Merchant does not belong to the group",
+    "SIS0429": "Error in the signature version",
+    "SIS0432": "Error in the terminal code",
+}
+
+# Ds_Response of authorisations declined until the cardholder authenticates
+SCA_REQUIRED = 195
+
+# Ds_TransactionType values
+AUTHORISATION = "0"
+PREAUTHORISATION = "1"
+CONFIRMATION = "2"
+REFUND = "3"
+CANCELLATION = "9"
+
+TRANSACTION_TYPES = (
+    AUTHORISATION,
+    PREAUTHORISATION,
+    CONFIRMATION,
+    REFUND,
+    CANCELLATION,
+)
+
+# payment status after an authorised (0000-0099) response, per transaction type
+AUTHORISED_STATUSES = {
+    AUTHORISATION: "confirmed",
+    PREAUTHORISATION: "preauth",
+    CONFIRMATION: "confirmed",
+}
+
+# payment status after a 0400/0900 response, per transaction type
+COMPLETED_STATUSES = {
+    CONFIRMATION: "confirmed",
+    REFUND: "refunded",
+    # django-payments marks released preauthorisations as refunded
+    CANCELLATION: "refunded",
+}
+
+
+# payment statuses in which no attempt has been paid
+UNPAID_STATUSES = frozenset(("waiting", "input", "rejected", "error"))
+
+# operations on an authorised payment, whose failure leaves it as it was
+OPERATION_TYPES = frozenset((CONFIRMATION, REFUND, CANCELLATION))
+
+
+def describe(response_code: int) -> str:
+    return RESPONSE_DESCRIPTIONS.get(response_code, "Unknown response code")
+
+
+def default_outcome(response_code: int, transaction_type: str) -> ResponseOutcome:
+    reason = describe(response_code)
+    if response_code < 100:
+        return ResponseOutcome(True, AUTHORISED_STATUSES.get(transaction_type), reason)
+    if response_code in (400, 900):
+        return ResponseOutcome(True, COMPLETED_STATUSES.get(transaction_type), reason)
+    if transaction_type in OPERATION_TYPES:
+        return ResponseOutcome(False, None, reason)
+    return ResponseOutcome(False, "rejected", reason)
+
+
+class ResponseDispatcher:
+    """
+    Resolves (Ds_Response, Ds_TransactionType) pairs to outcomes using a
+    table precomputed for the whole catalogue.
+
+    overrides maps either a response code or a (response code, transaction
+    type) pair to a ResponseOutcome (or a (success, status, reason) tuple);
+    pairs take precedence over codes.
+    """
+
+    def __init__(self, overrides: Optional[dict] = None):
+        overrides = {
+            key: ResponseOutcome(*outcome) for key, outcome in (overrides or {}).items()
+        }
+        self.code_overrides = {
+            key: outcome for key, outcome in overrides.items() if isinstance(key, int)
+        }
+        self.table = {
+            (code, transaction_type): self.code_overrides.get(code)
+            or default_outcome(code, transaction_type)
+            for code in RESPONSE_DESCRIPTIONS
+            for transaction_type in TRANSACTION_TYPES
+        }
+        self.table.update(
+            (key, outcome)
+            for key, outcome in overrides.items()
+            if isinstance(key, tuple)
+        )
+
+    def resolve(self, response_code: int, transaction_type: str) -> ResponseOutcome:
+        outcome = self.table.get((response_code, transaction_type))
+        if outcome is None:
+            # unknown code or transaction type
+            outcome = self.code_overrides.get(response_code) or default_outcome(
+                response_code, transaction_type
+            )
+        return outcome
@@ -0,0 +1,199 @@
+"""
+HTTP client for the Redsys REST endpoints (trataPeticionREST and the query
+service).
+
+A single client is owned by each RedsysProvider and shared by all its REST
+operations, so TLS connections to Redsys are pooled and reused. Only
+connection errors are retried: a request that reached Redsys is never resent.
+
+Each endpoint is guarded by a circuit breaker (see breaker.py), unless
+breaker_options is None: while Redsys keeps failing, calls raise
+CircuitOpenError at once.
+"""
+
+import asyncio
+import threading
+from typing import Optional
+
+import requests
+from asgiref.sync import sync_to_async
+from payments import PaymentError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .breaker import CircuitBreaker
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class RedsysRestClient:
+    def __init__(
+        self,
+        endpoint: str,
+        pool_size: int = 10,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        max_retries: int = 2,
+        backoff_factor: float = 0.2,
+        breaker_options: Optional[dict] = None,
+    ):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+        self._async_client = None
+        self._async_loop = None
+        self.breaker_options = breaker_options
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def _build_session(self):
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=0,
+            other=0,
+            allowed_methods=None,  # POST is safe to retry if it never connected
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _get_async_client(self):
+        # httpx connections are bound to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._async_client is None or self._async_loop is not loop:
+                self._close_stale(self._async_client, self._async_loop)
+                limits = httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                )
+                self._async_client = httpx.AsyncClient(
+                    transport=httpx.AsyncHTTPTransport(
+                        retries=self.max_retries, limits=limits
+                    ),
+                    timeout=httpx.Timeout(
+                        self.read_timeout, connect=self.connect_timeout
+                    ),
+                )
+                self._async_loop = loop
+            return self._async_client
+
+    @staticmethod
+    def _close_stale(client, loop):
+        """
+        Closes a client of another event loop, on that loop if it is still
+        running. Otherwise (e.g. a loop of async_to_sync, already finished)
+        it can't be awaited anymore and is just dropped, its connections
+        going with their loop.
+        """
+        if client is None:
+            return
+        if loop is not None and loop.is_running() and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    def breaker_for(self, endpoint: Optional[str] = None):
+        """The endpoint's CircuitBreaker, None if breakers are disabled"""
+        if self.breaker_options is None:
+            return None
+        endpoint = endpoint or self.endpoint
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(endpoint)
+                if breaker is None:
+                    breaker = CircuitBreaker(endpoint, **self.breaker_options)
+                    self.breakers[endpoint] = breaker
+        return breaker
+
+    def health(self) -> dict:
+        """Breaker stats of every endpoint called so far"""
+        return {
+            endpoint: breaker.stats() for endpoint, breaker in self.breakers.items()
+        }
+
+    def available(self, endpoint: Optional[str] = None) -> bool:
+        breaker = self.breaker_for(endpoint)
+        return breaker is None or breaker.available
+
+    def post(self, data: dict, endpoint: Optional[str] = None) -> bytes:
+        endpoint = endpoint or self.endpoint
+        breaker = self.breaker_for(endpoint)
+        token = breaker.before_call() if breaker else None
+        failed = True
+        try:
+            response = self.session.post(endpoint, json=data, timeout=self.timeout)
+            failed = not response.ok
+        except requests.RequestException as e:
+            raise PaymentError(f"Redsys REST request failed: {e}") from e
+        finally:
+            if breaker:
+                breaker.record(token, failed)
+        return response.content
+
+    async def apost(self, data: dict, endpoint: Optional[str] = None) -> bytes:
+        if httpx is None:
+            return await sync_to_async(self.post, thread_sensitive=False)(
+                data, endpoint
+            )
+        endpoint = endpoint or self.endpoint
+        breaker = self.breaker_for(endpoint)
+        token = breaker.before_call() if breaker else None
+        failed = True
+        try:
+            response = await self._get_async_client().post(endpoint, json=data)
+            failed = response.is_error
+        except httpx.HTTPError as e:
+            raise PaymentError(f"Redsys REST request failed: {e}") from e
+        finally:
+            if breaker:
+                breaker.record(token, failed)
+        return response.content
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            self._close_stale(self._async_client, self._async_loop)
+            self._async_client = self._async_loop = None
+
+    async def aclose(self):
+        """Closes the httpx client, from the event loop it was used in"""
+        with self._lock:
+            client, loop = self._async_client, self._async_loop
+            self._async_client = self._async_loop = None
+        if client is None:
+            return
+        if loop is asyncio.get_running_loop():
+            await client.aclose()
+        else:
+            self._close_stale(client, loop)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by payments_redsys.instrumentation.signal_observer after each timed
+# RedsysProvider operation, with the OperationEvent as "event"
+operation_finished = Signal()
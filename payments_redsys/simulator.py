@@ -0,0 +1,375 @@
+"""
+Offline stand-in for the Redsys SIS, for development and load testing.
+
+RedsysSimulator is a WSGI application that implements the parts of Redsys
+used by RedsysProvider:
+
+- /sis/realizarPago: the payment form. The payment is authorised (or
+  declined, see decline_rate) at once, the notification is posted to
+  DS_MERCHANT_MERCHANTURL and the browser is redirected to URLOK or URLKO.
+- /sis/rest/trataPeticionREST: refunds, captures and releases.
+- /sis/rest/consultaOperacionREST: status queries.
+- /stats: counters, as JSON.
+
+Requests are verified and responses signed with compute_signature, so the
+provider runs its real signing and verification code. Run it with
+
+    DJANGO_SETTINGS_MODULE=sample.settings python -m payments_redsys.simulator
+
+and point a provider to it with environment="http://127.0.0.1:8001".
+"""
+
+import argparse
+import base64
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from socketserver import ThreadingMixIn
+from typing import Optional, Tuple, Union
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import requests
+
+from . import compare_signatures, compute_signature
+from .responses import (
+    AUTHORISATION,
+    CANCELLATION,
+    CONFIRMATION,
+    PREAUTHORISATION,
+    REFUND,
+)
+
+logger = logging.getLogger(__name__)
+
+# shared secret of the Redsys test environment
+TEST_SHARED_SECRET = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+# Ds_Response of successful REST operations, per transaction type
+REST_RESPONSES = {
+    AUTHORISATION: "0000",
+    PREAUTHORISATION: "0000",
+    CONFIRMATION: "0900",
+    REFUND: "0900",
+    CANCELLATION: "0400",
+}
+
+# errorCode when there is no previous operation for a REST operation
+MISSING_OPERATION_ERRORS = {
+    CONFIRMATION: "SIS0059",
+    REFUND: "SIS0054",
+    CANCELLATION: "SIS0059",
+}
+
+# Ds_Response of payments declined with decline_rate
+DECLINED_RESPONSE = "0190"
+
+
+class RedsysSimulator:
+    """
+    latency is a number of seconds, or a (min, max) range, added to every
+    request. error_rate is the fraction of REST requests answered with an
+    HTTP 503, and decline_rate the fraction of payments declined.
+    """
+
+    def __init__(
+        self,
+        shared_secret: str = TEST_SHARED_SECRET,
+        latency: Union[float, Tuple[float, float]] = 0.0,
+        error_rate: float = 0.0,
+        decline_rate: float = 0.0,
+        notify: bool = True,
+        notification_timeout: float = 10.0,
+        seed: Optional[int] = None,
+    ):
+        self.shared_secret = shared_secret
+        self.latency = latency
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+        self.notify = notify
+        self.notification_timeout = notification_timeout
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        self.orders = {}  # order number -> merchant parameters of the last response
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        routes = {
+            "/sis/realizarPago": self.pay,
+            "/sis/rest/trataPeticionREST": self.operation,
+            "/sis/rest/consultaOperacionREST": self.query,
+            "/stats": self.get_stats,
+        }
+        handler = routes.get(environ.get("PATH_INFO", ""))
+        if handler is None:
+            return self.respond(start_response, "404 Not Found", b"Not found")
+        self.sleep()
+        return handler(environ, start_response)
+
+    def sleep(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self.random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def respond(self, start_response, status, body, headers=()):
+        start_response(
+            status,
+            [("Content-Length", str(len(body))), *headers],
+        )
+        return [body]
+
+    def respond_json(self, start_response, data, status="200 OK"):
+        body = json.dumps(data).encode()
+        return self.respond(
+            start_response, status, body, [("Content-Type", "application/json")]
+        )
+
+    def read_body(self, environ) -> bytes:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        return environ["wsgi.input"].read(length)
+
+    def read_json(self, environ) -> Optional[dict]:
+        """Returns the JSON object of a request body, None if it isn't one"""
+        try:
+            request = json.loads(self.read_body(environ) or b"{}")
+        except ValueError:
+            return None
+        return request if isinstance(request, dict) else None
+
+    def verify(self, request) -> Optional[dict]:
+        """Returns the merchant parameters of a signed request, None if invalid"""
+        try:
+            merchant_parameters = request["Ds_MerchantParameters"]
+            params = json.loads(base64.b64decode(merchant_parameters))
+            # Redsys parameter names are case insensitive
+            params = {key.upper(): value for key, value in params.items()}
+            signature = compute_signature(
+                params["DS_MERCHANT_ORDER"],
+                merchant_parameters.encode(),
+                self.shared_secret,
+            )
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # not an object, or without an order
+            return None
+        if not compare_signatures(signature, request.get("Ds_Signature", "")):
+            return None
+        return params
+
+    def sign(self, order, response) -> dict:
+        merchant_parameters = base64.b64encode(json.dumps(response).encode())
+        signature = compute_signature(order, merchant_parameters, self.shared_secret)
+        return {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": merchant_parameters.decode(),
+            "Ds_Signature": signature.decode(),
+        }
+
+    def response_parameters(self, params, response_code):
+        now = time.localtime()
+        return {
+            "Ds_Date": time.strftime("%d/%m/%Y", now),
+            "Ds_Hour": time.strftime("%H:%M", now),
+            "Ds_SecurePayment": "1",
+            "Ds_Amount": params.get("DS_MERCHANT_AMOUNT", "0"),
+            "Ds_Currency": params.get("DS_MERCHANT_CURRENCY", "978"),
+            "Ds_Order": params["DS_MERCHANT_ORDER"],
+            "Ds_MerchantCode": params.get("DS_MERCHANT_MERCHANTCODE", ""),
+            "Ds_Terminal": params.get("DS_MERCHANT_TERMINAL", ""),
+            "Ds_Response": response_code,
+            "Ds_TransactionType": params.get(
+                "DS_MERCHANT_TRANSACTIONTYPE", AUTHORISATION
+            ),
+            "Ds_AuthorisationCode": f"{self.random.randrange(1000000):06d}",
+            "Ds_Card_Number": "454881******0003",
+            "Ds_Card_Country": "724",
+            "Ds_Card_Brand": "1",
+        }
+
+    def pay(self, environ, start_response):
+        form = {
+            key: values[0]
+            for key, values in parse_qs(self.read_body(environ).decode()).items()
+        }
+        params = self.verify(form)
+        if params is None:
+            self.count("invalid_signature")
+            return self.respond(start_response, "200 OK", b"SIS0042 Signature mismatch")
+
+        declined = self.random.random() < self.decline_rate
+        response = self.response_parameters(
+            params, DECLINED_RESPONSE if declined else "0000"
+        )
+        with self._lock:
+            self.orders[response["Ds_Order"]] = response
+            self.stats["declined" if declined else "authorised"] += 1
+
+        notification_url = params.get("DS_MERCHANT_MERCHANTURL")
+        if self.notify and notification_url:
+            self.send_notification(notification_url, response)
+
+        redirect_url = params.get(
+            "DS_MERCHANT_URLKO" if declined else "DS_MERCHANT_URLOK"
+        )
+        if not redirect_url:
+            return self.respond(
+                start_response, "200 OK", response["Ds_Response"].encode()
+            )
+        return self.respond(
+            start_response, "302 Found", b"", [("Location", redirect_url)]
+        )
+
+    def send_notification(self, url, response):
+        start = time.perf_counter()
+        try:
+            self.session.post(
+                url,
+                data=self.sign(response["Ds_Order"], response),
+                timeout=self.notification_timeout,
+                allow_redirects=False,
+            )
+        except requests.RequestException as e:
+            logger.warning("notification to %s failed: %s", url, e)
+            self.count("notification_errors")
+        else:
+            self.count("notifications")
+        with self._lock:
+            self.stats["notification_ms"] += round((time.perf_counter() - start) * 1000)
+
+    def operation(self, environ, start_response):
+        if self.random.random() < self.error_rate:
+            self.count("errors")
+            return self.respond_json(
+                start_response,
+                {"errorCode": "SIS9999", "errorCodeDescription": "Simulated error"},
+                "503 Service Unavailable",
+            )
+        request = self.read_json(environ)
+        if request is None:
+            self.count("invalid_request")
+            return self.respond_json(start_response, {"errorCode": "SIS0007"})
+        params = self.verify(request)
+        if params is None:
+            self.count("invalid_signature")
+            return self.respond_json(start_response, {"errorCode": "SIS0042"})
+
+        order = params["DS_MERCHANT_ORDER"]
+        transaction_type = params.get("DS_MERCHANT_TRANSACTIONTYPE", AUTHORISATION)
+        if transaction_type not in REST_RESPONSES:
+            return self.respond_json(start_response, {"errorCode": "SIS0274"})
+        with self._lock:
+            if (
+                transaction_type in MISSING_OPERATION_ERRORS
+                and order not in self.orders
+            ):
+                self.stats["missing_operation"] += 1
+                return self.respond_json(
+                    start_response,
+                    {"errorCode": MISSING_OPERATION_ERRORS[transaction_type]},
+                )
+            response = self.response_parameters(
+                params, REST_RESPONSES[transaction_type]
+            )
+            self.orders[order] = response
+            self.stats[f"transaction_type_{transaction_type}"] += 1
+        return self.respond_json(start_response, self.sign(order, response))
+
+    def query(self, environ, start_response):
+        if self.random.random() < self.error_rate:
+            self.count("errors")
+            return self.respond_json(
+                start_response,
+                {"errorCode": "SIS9999", "errorCodeDescription": "Simulated error"},
+                "503 Service Unavailable",
+            )
+        request = self.read_json(environ)
+        if request is None:
+            self.count("invalid_request")
+            return self.respond_json(start_response, {"errorCode": "SIS0007"})
+        params = self.verify(request)
+        if params is None:
+            self.count("invalid_signature")
+            return self.respond_json(start_response, {"errorCode": "SIS0042"})
+
+        order = params["DS_MERCHANT_ORDER"]
+        with self._lock:
+            response = self.orders.get(order)
+            self.stats["queries"] += 1
+        if response is None:
+            return self.respond_json(start_response, {"errorCode": "SIS0054"})
+        return self.respond_json(start_response, self.sign(order, response))
+
+    def get_stats(self, environ, start_response):
+        with self._lock:
+            stats = {**self.stats, "orders": len(self.orders)}
+        return self.respond_json(start_response, stats)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def make_simulator_server(host, port, simulator: RedsysSimulator):
+    return make_server(
+        host,
+        port,
+        simulator,
+        server_class=ThreadingWSGIServer,
+        handler_class=QuietRequestHandler,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--shared-secret", default=TEST_SHARED_SECRET)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        nargs="+",
+        default=[0.0],
+        metavar="SECONDS",
+        help="fixed latency, or min and max of a random latency",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--no-notify", action="store_true")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    simulator = RedsysSimulator(
+        shared_secret=args.shared_secret,
+        latency=args.latency[0] if len(args.latency) == 1 else tuple(args.latency[:2]),
+        error_rate=args.error_rate,
+        decline_rate=args.decline_rate,
+        notify=not args.no_notify,
+        seed=args.seed,
+    )
+    server = make_simulator_server(args.host, args.port, simulator)
+    print(f"Redsys simulator listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(simulator.stats)))
+
+
+if __name__ == "__main__":
+    main()
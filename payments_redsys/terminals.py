@@ -0,0 +1,161 @@
+"""
+Redsys terminals (merchant code, terminal number and shared secret) and the
+routing of payments and notifications between them.
+
+A RedsysProvider can serve several terminals, e.g. one per storefront or
+currency. Each Terminal builds its 3DES cipher when the provider is created,
+so signing never has to look it up, and TerminalRouter resolves the terminal
+for a payment or a notification with a dict lookup.
+
+To rotate a shared secret, configure the new one as shared_secret and keep
+the old ones in previous_secrets: requests are signed with the new secret,
+and responses are verified trying the secret that matched last first, so
+only the responses signed with a different secret pay for extra HMACs.
+"""
+
+import base64
+import hashlib
+import hmac
+from typing import Iterable, Iterator, Optional
+
+from .ciphers import OrderKeyCache, get_cipher
+
+
+def normalise_terminal(terminal) -> str:
+    # Redsys sends Ds_Terminal without the leading zeros ("1" for "001")
+    return str(terminal).lstrip("0") or "0"
+
+
+class Terminal:
+    """
+    A merchant_code/terminal/shared_secret combination with its signing
+    context. currency (an ISO 4217 numeric code) and key are used by
+    TerminalRouter to pick the terminal for a payment.
+
+    Secrets are referred to by their index in secrets: 0 is shared_secret,
+    the others previous_secrets in order. matches counts the responses
+    verified with each.
+    """
+
+    __slots__ = (
+        "merchant_code",
+        "terminal",
+        "shared_secret",
+        "previous_secrets",
+        "secrets",
+        "currency",
+        "key",
+        "cipher_backend",
+        "ciphers",
+        "matches",
+        "_preferred",
+    )
+
+    def __init__(
+        self,
+        merchant_code: str,
+        terminal: str,
+        shared_secret: str,
+        currency: Optional[str] = None,
+        key: Optional[str] = None,
+        cipher_backend: Optional[str] = None,
+        previous_secrets: Iterable[str] = (),
+    ):
+        self.merchant_code = merchant_code
+        self.terminal = terminal
+        self.shared_secret = shared_secret
+        self.previous_secrets = tuple(previous_secrets)
+        self.secrets = (shared_secret, *self.previous_secrets)
+        self.currency = currency
+        self.key = key
+        self.cipher_backend = cipher_backend
+        self.ciphers = tuple(
+            get_cipher(secret, cipher_backend) for secret in self.secrets
+        )
+        self.matches = [0] * len(self.secrets)
+        self._preferred = 0
+
+    def order_key(
+        self,
+        order_number: str,
+        key_cache: Optional[OrderKeyCache] = None,
+        secret_index: int = 0,
+    ):
+        if key_cache is not None:
+            return key_cache.derive(
+                self.secrets[secret_index], order_number, self.cipher_backend
+            )
+        return self.ciphers[secret_index].encrypt(str(order_number).encode("ascii"))
+
+    def sign(
+        self,
+        order_number: str,
+        payload: bytes,
+        key_cache: Optional[OrderKeyCache] = None,
+        secret_index: int = 0,
+    ) -> bytes:
+        """Same as compute_signature, with one of this terminal's secrets"""
+        digest = hmac.new(
+            self.order_key(order_number, key_cache, secret_index),
+            payload,
+            hashlib.sha256,
+        ).digest()
+        return base64.b64encode(digest)
+
+    def verification_order(self) -> Iterator[int]:
+        """Indexes of the secrets to verify responses with, most likely first"""
+        preferred = self._preferred
+        yield preferred
+        for secret_index in range(len(self.secrets)):
+            if secret_index != preferred:
+                yield secret_index
+
+    def record_match(self, secret_index: int):
+        # counters are not locked: they are statistics, not accounting
+        self.matches[secret_index] += 1
+        self._preferred = secret_index
+
+    def __repr__(self):
+        return f"<Terminal {self.merchant_code}/{self.terminal}>"
+
+
+class TerminalRouter:
+    """
+    Picks the terminal for payments, by the value of a payment attribute
+    (matched against Terminal.key) or else by currency, falling back to the
+    first terminal; and for notifications, by Ds_MerchantCode and Ds_Terminal.
+    """
+
+    def __init__(self, terminals: Iterable[Terminal], attribute: Optional[str] = None):
+        self.terminals = list(terminals)
+        if not self.terminals:
+            raise ValueError("at least one terminal is required")
+        self.default = self.terminals[0]
+        self.attribute = attribute
+        self.by_key = {}
+        self.by_currency = {}
+        self.by_code = {}
+        for terminal in self.terminals:
+            if terminal.key is not None:
+                self.by_key.setdefault(terminal.key, terminal)
+            if terminal.currency is not None:
+                self.by_currency.setdefault(terminal.currency, terminal)
+            code = (terminal.merchant_code, normalise_terminal(terminal.terminal))
+            if code in self.by_code:
+                raise ValueError(f"terminal {terminal!r} is configured twice")
+            self.by_code[code] = terminal
+
+    def __len__(self):
+        return len(self.terminals)
+
+    def for_payment(self, payment, currency_code: Optional[str] = None) -> Terminal:
+        if self.attribute is not None:
+            terminal = self.by_key.get(getattr(payment, self.attribute, None))
+            if terminal is not None:
+                return terminal
+        return self.by_currency.get(currency_code, self.default)
+
+    def for_notification(self, merchant_code, terminal) -> Optional[Terminal]:
+        if merchant_code is None or terminal is None:
+            return None
+        return self.by_code.get((str(merchant_code), normalise_terminal(terminal)))
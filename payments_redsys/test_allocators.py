@@ -0,0 +1,305 @@
+import base64
+import json
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+import pytest
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.test import RequestFactory, TestCase
+from payments import PaymentError, get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.allocators import (
+    DatabaseOrderNumberAllocator,
+    is_valid_order_number,
+)
+from payments_redsys.models import OrderNumber, OrderNumberSequence
+from payments_redsys.test_redsys import (
+    DEFAULT_CONFIG,
+    refund_response_content,
+    signed_notification,
+)
+
+
+def form_order_number(form):
+    params = json.loads(base64.b64decode(form.fields["Ds_MerchantParameters"].initial))
+    return params["DS_MERCHANT_ORDER"]
+
+
+@pytest.mark.parametrize(
+    "order_number,valid",
+    [
+        ("0001", True),
+        ("123456789012", True),
+        ("1234AbC", True),
+        ("123", False),
+        ("1234567890123", False),
+        ("SMPL000001", False),
+        ("1234-56", False),
+    ],
+)
+def test_is_valid_order_number(order_number, valid):
+    assert is_valid_order_number(order_number) is valid
+
+
+def test_default_order_number_not_padded():
+    # order_number_min_length was ignored before allocators, and existing
+    # payments must keep their order number
+    redsys = RedsysProvider(**DEFAULT_CONFIG, order_number_min_length=10)
+    payment = Mock(spec=["pk"], pk=42)
+
+    assert redsys.get_order_number(payment) == "000042"
+    assert redsys.parse_order_number("000042") == 42
+
+
+class TestDatabaseOrderNumberAllocator(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Payment = get_payment_model()
+        cls.payments = [
+            Payment.objects.create(
+                total=Decimal("10.0"), currency="EUR", variant="redsys"
+            )
+            for _ in range(3)
+        ]
+
+    def test_allocates_in_blocks(self):
+        allocator = DatabaseOrderNumberAllocator(prefix="7", min_length=8)
+
+        with patch.object(
+            allocator, "reserve_block", wraps=allocator.reserve_block
+        ) as reserve:
+            allocator.block_size = 2
+            numbers = [allocator.allocate(payment) for payment in self.payments]
+
+        assert numbers == ["70000001", "70000002", "70000003"]
+        assert reserve.call_count == 2
+        assert OrderNumberSequence.objects.get(name="default").next_value == 5
+        assert allocator.payment_ids(numbers) == {
+            number: payment.pk for number, payment in zip(numbers, self.payments)
+        }
+
+    def test_allocators_share_the_sequence(self):
+        first = DatabaseOrderNumberAllocator(block_size=10)
+        second = DatabaseOrderNumberAllocator(block_size=10)
+
+        assert first.allocate(self.payments[0]) == "0001"
+        assert second.allocate(self.payments[1]) == "0011"
+
+    def test_refuses_to_reserve_inside_a_transaction(self):
+        allocator = DatabaseOrderNumberAllocator()
+
+        with transaction.atomic(), pytest.raises(RuntimeError):
+            allocator.allocate(self.payments[0])
+
+        assert not OrderNumberSequence.objects.exists()
+
+    def test_numbers_in_use_discard_the_block(self):
+        OrderNumber.objects.create(order_number="0001", payment=self.payments[1])
+        allocator = DatabaseOrderNumberAllocator(block_size=10)
+
+        assert allocator.allocate(self.payments[0]) == "0011"
+
+    def test_overlaps(self):
+        assert DatabaseOrderNumberAllocator().overlaps("0000")
+        assert DatabaseOrderNumberAllocator(prefix="00").overlaps("0000")
+        assert DatabaseOrderNumberAllocator(prefix="00001").overlaps("0000")
+        assert DatabaseOrderNumberAllocator(prefix="1").overlaps("")
+        assert not DatabaseOrderNumberAllocator(prefix="00000").overlaps("0000")
+        assert not DatabaseOrderNumberAllocator(prefix="1").overlaps("0000")
+        assert not DatabaseOrderNumberAllocator(prefix="0").overlaps("")
+        assert not DatabaseOrderNumberAllocator().overlaps("SMPL")
+
+    def test_exhausted(self):
+        OrderNumberSequence.objects.create(name="short", next_value=9999)
+        allocator = DatabaseOrderNumberAllocator(
+            prefix="12345678", sequence="short", block_size=2
+        )
+
+        assert allocator.next_number() == "123456789999"
+        with pytest.raises(ValueError):
+            allocator.next_number()
+
+    def test_current_and_prefetch(self):
+        allocator = DatabaseOrderNumberAllocator()
+        allocator.allocate(self.payments[0])
+        latest = allocator.allocate(self.payments[0])
+        payments = list(
+            get_payment_model()
+            .objects.filter(pk__in=[p.pk for p in self.payments])
+            .order_by("pk")
+        )
+
+        with self.assertNumQueries(1):
+            allocator.prefetch(payments)
+            assert [allocator.current(payment) for payment in payments] == [
+                latest,
+                "",
+                "",
+            ]
+
+
+class TestProviderWithAllocator(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+
+    def setUp(self):
+        self.redsys = RedsysProvider(
+            **DEFAULT_CONFIG,
+            order_number_allocator="database",
+            order_number_allocator_options={"prefix": "9", "block_size": 10},
+        )
+        self.factory = RequestFactory()
+
+    def test_overlapping_prefix_rejected(self):
+        with pytest.raises(ValueError):
+            RedsysProvider(
+                **DEFAULT_CONFIG,
+                order_number_min_length=6,
+                order_number_allocator="database",
+            )
+
+    def attempt(self):
+        # a form, declined by Redsys
+        order_number = form_order_number(self.redsys.get_form(self.payment))
+        request = self.factory.post(
+            "/", signed_notification(self.redsys, order_number, Ds_Response="0190")
+        )
+        self.redsys.process_data(self.payment, request)
+        return order_number
+
+    def test_form_reuses_order_number_until_answered(self):
+        first = form_order_number(self.redsys.get_form(self.payment))
+        refreshed = form_order_number(self.redsys.get_form(self.payment))
+        request = self.factory.post(
+            "/", signed_notification(self.redsys, first, Ds_Response="0190")
+        )
+        self.redsys.process_data(self.payment, request)
+        second = form_order_number(self.redsys.get_form(self.payment))
+
+        assert first == refreshed == "9001"
+        assert second == "9002"
+        assert self.redsys.get_order_number(self.payment) == second
+        assert OrderNumber.objects.filter(payment=self.payment).count() == 2
+
+    def test_form_cache_hit_on_refresh(self):
+        redsys = RedsysProvider(
+            **DEFAULT_CONFIG,
+            order_number_allocator="database",
+            order_number_allocator_options={"prefix": "9"},
+            form_cache_size=8,
+        )
+
+        redsys.get_form(self.payment)
+        redsys.get_form(self.payment)
+
+        assert redsys.form_cache.cache_info().hits == 1
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_uses_the_paid_order_number(self, post):
+        post.return_value.content = refund_response_content("0400")
+        paid = form_order_number(self.redsys.get_form(self.payment))
+        self.redsys.get_form(self.payment)
+        request = self.factory.post("/", signed_notification(self.redsys, paid))
+        self.redsys.process_data(self.payment, request)
+        # a fresh instance, without the order number cached
+        payment = get_payment_model().objects.get(pk=self.payment.pk)
+
+        self.redsys.refund(payment, Decimal("1.0"))
+
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_ORDER"] == paid
+
+    def test_late_notification_of_earlier_attempt_is_paid(self):
+        first = self.attempt()
+        second = form_order_number(self.redsys.get_form(self.payment))
+        # the first attempt was authorised after all
+        request = self.factory.post("/", signed_notification(self.redsys, first))
+        self.redsys.process_data(self.payment, request)
+        payment = get_payment_model().objects.get(pk=self.payment.pk)
+
+        assert first != second
+        assert self.redsys.get_order_number(payment) == first
+
+    def test_retried_decline_of_earlier_attempt_ignored(self):
+        declined = self.attempt()
+        paid = form_order_number(self.redsys.get_form(self.payment))
+        self.redsys.process_data(
+            self.payment, self.factory.post("/", signed_notification(self.redsys, paid))
+        )
+        # Redsys retries the notification of the first attempt
+        request = self.factory.post(
+            "/", signed_notification(self.redsys, declined, Ds_Response="0190")
+        )
+
+        self.redsys.process_data(self.payment, request)
+
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+        assert self.redsys.get_order_number(self.payment) == paid
+
+    def test_process_data_earlier_attempt(self):
+        first = self.attempt()
+        self.redsys.get_form(self.payment)
+        request = self.factory.post("/", signed_notification(self.redsys, first))
+
+        self.redsys.process_data(self.payment, request)
+
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+
+    def test_process_data_order_of_another_payment(self):
+        other = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+        order_number = form_order_number(self.redsys.get_form(other))
+        request = self.factory.post("/", signed_notification(self.redsys, order_number))
+
+        with pytest.raises(PaymentError):
+            self.redsys.process_data(self.payment, request)
+
+    def test_process_data_before_allocator(self):
+        # the sample Payment's own order_number
+        request = self.factory.post(
+            "/", signed_notification(self.redsys, self.payment.order_number)
+        )
+
+        self.redsys.process_data(self.payment, request)
+
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+
+    def test_get_payments_by_order_number(self):
+        first = self.attempt()
+        second = form_order_number(self.redsys.get_form(self.payment))
+
+        with self.assertNumQueries(2):
+            payments = self.redsys.get_payments_by_order_number([first, second])
+
+        assert payments == {first: self.payment, second: self.payment}
+
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_aquery_status(self, post):
+        form = await sync_to_async(self.redsys.get_form)(self.payment)
+        order_number = form_order_number(form)
+        post.return_value.content = json.dumps(
+            signed_notification(self.redsys, order_number)
+        ).encode()
+        # a fresh instance, without the order number cached
+        payment = await get_payment_model().objects.aget(pk=self.payment.pk)
+
+        status = await self.redsys.aquery_status(payment)
+
+        assert status == "confirmed"
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_ORDER"] == order_number
@@ -0,0 +1,173 @@
+from decimal import Decimal
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+import requests
+from django.test import TestCase
+from payments import PaymentError, get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+from payments_redsys.test_redsys import DEFAULT_CONFIG, refund_response_content
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_breaker(**options):
+    clock = FakeClock()
+    options = {"min_calls": 4, "window_size": 10, "open_seconds": 30, **options}
+    return CircuitBreaker("test", clock=clock, **options), clock
+
+
+def call(breaker, clock, failed=False, duration=0.1):
+    token = breaker.before_call()
+    clock.now += duration
+    breaker.record(token, failed)
+
+
+def test_opens_on_error_rate():
+    breaker, clock = make_breaker()
+    call(breaker, clock)
+    call(breaker, clock, failed=True)
+    call(breaker, clock)
+    assert breaker.state == CLOSED
+
+    call(breaker, clock, failed=True)
+
+    assert breaker.state == OPEN
+    assert not breaker.available
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert excinfo.value.code == "circuit_open"
+    assert 29 < excinfo.value.retry_after <= 30
+    assert isinstance(excinfo.value, PaymentError)
+
+
+def test_opens_on_slow_calls():
+    breaker, clock = make_breaker(slow_call_duration=2, slow_call_rate=0.75)
+    for _ in range(3):
+        call(breaker, clock, duration=3)
+    call(breaker, clock)
+
+    assert breaker.state == OPEN
+    stats = breaker.stats()
+    assert stats["slow_calls"] == 3
+    assert stats["p50"] == 3
+    assert stats["error_rate"] == 0
+
+
+def test_old_calls_expire():
+    breaker, clock = make_breaker(window_seconds=60)
+    for _ in range(3):
+        call(breaker, clock, failed=True)
+    clock.now += 120
+
+    call(breaker, clock, failed=True)
+
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 1
+
+
+def test_half_open_probe_closes():
+    breaker, clock = make_breaker()
+    for _ in range(4):
+        call(breaker, clock, failed=True)
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+
+    token = breaker.before_call()
+    # a single probe at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record(token, failed=False)
+
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 0
+
+
+def test_half_open_probe_reopens():
+    breaker, clock = make_breaker()
+    for _ in range(4):
+        call(breaker, clock, failed=True)
+    clock.now += 30
+
+    call(breaker, clock, failed=True)
+
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+
+
+def test_calls_started_before_opening_are_not_probes():
+    breaker, clock = make_breaker()
+    token = breaker.before_call()
+    for _ in range(4):
+        call(breaker, clock, failed=True)
+    clock.now += 30
+    probe = breaker.before_call()
+
+    breaker.record(token, failed=False)
+    assert breaker.state == HALF_OPEN
+    breaker.record(probe, failed=False)
+    assert breaker.state == CLOSED
+
+
+class TestRestCircuitBreaker(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_open_circuit_fails_fast(self, post: MagicMock):
+        post.side_effect = requests.ConnectionError("connection refused")
+        redsys = RedsysProvider(**DEFAULT_CONFIG, rest_circuit_breaker={"min_calls": 2})
+
+        for _ in range(2):
+            with pytest.raises(PaymentError):
+                redsys.refund(self.payment, Decimal("1.0"))
+        assert not redsys.rest_available()
+        assert redsys.rest_available(query=True)
+
+        with pytest.raises(CircuitOpenError):
+            redsys.refund(self.payment, Decimal("1.0"))
+        assert post.call_count == 2
+        health = redsys.rest_health()[redsys.endpoint_rest]
+        assert health["state"] == OPEN
+        assert health["error_rate"] == 1
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_http_errors_count_as_failures(self, post: MagicMock):
+        post.return_value.ok = False
+        post.return_value.content = refund_response_content("0400")
+        redsys = RedsysProvider(**DEFAULT_CONFIG, rest_circuit_breaker={"min_calls": 1})
+
+        with patch("payments_redsys.compare_signatures", Mock(return_value=True)):
+            redsys.refund(self.payment, Decimal("1.0"))
+
+        assert not redsys.rest_available()
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_disabled(self, post: MagicMock):
+        post.side_effect = requests.ConnectionError("connection refused")
+        redsys = RedsysProvider(**DEFAULT_CONFIG, rest_circuit_breaker=None)
+
+        for _ in range(30):
+            with pytest.raises(PaymentError):
+                redsys.refund(self.payment, Decimal("1.0"))
+
+        assert post.call_count == 30
+        assert redsys.rest_available()
+        assert redsys.rest_health() == {}
@@ -0,0 +1,144 @@
+import base64
+
+import pyDes
+import pytest
+
+from payments_redsys import compute_signature
+from payments_redsys.ciphers import (
+    CIPHER_BACKENDS,
+    CryptographyCipher,
+    OrderKeyCache,
+    PyDesCipher,
+    derive_order_key,
+    get_cipher,
+)
+
+SHARED_SECRET = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+requires_cryptography = pytest.mark.skipif(
+    CryptographyCipher.name not in CIPHER_BACKENDS,
+    reason="cryptography is not installed",
+)
+
+
+def reference_encrypt(key: str, data: bytes) -> bytes:
+    # the original, uncached pyDes setup used by compute_signature
+    des3 = pyDes.triple_des(
+        base64.b64decode(key),
+        mode=pyDes.CBC,
+        IV="\0" * 8,
+        pad="\0",
+        padmode=pyDes.PAD_NORMAL,
+    )
+    return des3.encrypt(data)
+
+
+SALTS = [
+    "1",
+    "0000",
+    "SMPL0001",  # exactly one block
+    "SMPL000001",
+    "TEST12345678",
+    "A" * 16,  # exactly two blocks
+    "REDSYS=TEST%3A000066",
+]
+
+
+@pytest.mark.parametrize("backend", sorted(CIPHER_BACKENDS))
+@pytest.mark.parametrize("salt", SALTS)
+def test_cipher_matches_pydes(backend, salt):
+    cipher = get_cipher(SHARED_SECRET, backend)
+
+    assert cipher.encrypt(salt.encode()) == reference_encrypt(
+        SHARED_SECRET, salt.encode()
+    )
+
+
+@pytest.mark.parametrize("backend", sorted(CIPHER_BACKENDS))
+def test_cipher_is_reusable(backend):
+    cipher = get_cipher(SHARED_SECRET, backend)
+
+    first = cipher.encrypt(b"SMPL000001")
+    cipher.encrypt(b"SOMETHING ELSE")
+
+    assert cipher.encrypt(b"SMPL000001") == first
+
+
+@pytest.mark.parametrize("backend", sorted(CIPHER_BACKENDS))
+def test_compute_signature_backends(backend):
+    signature = compute_signature(
+        "salt",
+        b"payload",
+        SHARED_SECRET,
+        backend,
+    )
+    assert signature == b"s7tHdh2bWNAW9FM63CTWPJiHzAeJ2VEw9WL+ivAzEb0="
+
+
+def test_get_cipher_is_cached():
+    assert get_cipher(SHARED_SECRET, "pydes") is get_cipher(SHARED_SECRET, "pydes")
+    assert isinstance(get_cipher(SHARED_SECRET, "pydes"), PyDesCipher)
+
+
+@requires_cryptography
+def test_get_cipher_default_backend():
+    assert isinstance(get_cipher(SHARED_SECRET), CryptographyCipher)
+
+
+def test_get_cipher_unknown_backend():
+    with pytest.raises(ValueError):
+        get_cipher(SHARED_SECRET, "rot13")
+
+
+def test_order_key_cache_hits_and_misses():
+    cache = OrderKeyCache(maxsize=8)
+
+    first = cache.derive(SHARED_SECRET, "SMPL000001")
+    second = cache.derive(SHARED_SECRET, "SMPL000001")
+
+    assert first == second == derive_order_key(SHARED_SECRET, "SMPL000001")
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 8,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+def test_order_key_cache_evicts_least_recently_used():
+    cache = OrderKeyCache(maxsize=2)
+
+    cache.derive(SHARED_SECRET, "0001")
+    cache.derive(SHARED_SECRET, "0002")
+    cache.derive(SHARED_SECRET, "0001")  # 0002 is now the oldest
+    cache.derive(SHARED_SECRET, "0003")
+    cache.derive(SHARED_SECRET, "0001")
+
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 2
+
+
+def test_order_key_cache_separates_secrets():
+    other_secret = base64.b64encode(b"another 24 byte secret!!").decode()
+    cache = OrderKeyCache()
+
+    derived = cache.derive(SHARED_SECRET, "SMPL000001")
+    other = cache.derive(other_secret, "SMPL000001")
+
+    assert derived != other
+    assert len(cache) == 2
+
+
+def test_compute_signature_with_key_cache():
+    cache = OrderKeyCache()
+
+    signatures = [
+        compute_signature("salt", b"payload", SHARED_SECRET, key_cache=cache)
+        for _ in range(3)
+    ]
+
+    assert signatures == [b"s7tHdh2bWNAW9FM63CTWPJiHzAeJ2VEw9WL+ivAzEb0="] * 3
+    assert cache.hits == 2
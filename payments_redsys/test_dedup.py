@@ -0,0 +1,63 @@
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+
+from payments_redsys.dedup import (
+    CacheNotificationStore,
+    InMemoryNotificationStore,
+    get_notification_store,
+)
+
+
+def test_in_memory_store():
+    store = InMemoryNotificationStore()
+
+    assert store.get("0001:abc") is None
+    store.add("0001:abc", True)
+    store.add("0002:def", False)
+
+    assert store.get("0001:abc") is True
+    assert store.get("0002:def") is False
+
+
+def test_in_memory_store_expires_entries():
+    store = InMemoryNotificationStore(ttl=60)
+
+    with patch("payments_redsys.dedup.time.monotonic", return_value=1000):
+        store.add("0001:abc", True)
+    with patch("payments_redsys.dedup.time.monotonic", return_value=1061):
+        assert store.get("0001:abc") is None
+    assert store.stats()["size"] == 0
+
+
+def test_in_memory_store_is_bounded():
+    store = InMemoryNotificationStore(maxsize=2)
+
+    store.add("0001:abc", True)
+    store.add("0002:def", True)
+    store.get("0001:abc")
+    store.add("0003:ghi", True)
+
+    assert store.get("0001:abc") is True
+    assert store.get("0002:def") is None
+
+
+def test_cache_store():
+    store = CacheNotificationStore(ttl=60)
+    store.add("0001:abc", True)
+
+    assert store.get("0001:abc") is True
+    assert cache.get("redsys-notification:0001:abc") is True
+    assert store.get("0002:def") is None
+
+
+def test_get_notification_store():
+    store = InMemoryNotificationStore()
+
+    assert get_notification_store(None) is None
+    assert get_notification_store(store) is store
+    assert isinstance(get_notification_store("cache", ttl=5), CacheNotificationStore)
+    assert get_notification_store("memory", ttl=5).ttl == 5
+    with pytest.raises(ValueError):
+        get_notification_store("redis")
@@ -0,0 +1,115 @@
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+from django.test import RequestFactory, TestCase
+from payments import get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.instrumentation import (
+    NULL_TIMER,
+    OperationEvent,
+    signal_observer,
+)
+from payments_redsys.signals import operation_finished
+from payments_redsys.test_redsys import (
+    DEFAULT_CONFIG,
+    encode_response,
+    redsys_response_factory,
+    refund_response_content,
+)
+
+ExamplePayment = get_payment_model()
+
+
+class TestInstrumentation(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = ExamplePayment.objects.create(
+            pk=1,
+            total=Decimal("10.0"),
+            currency="EUR",
+            variant="redsys",
+            captured_amount=Decimal("5.0"),
+        )
+
+    def test_no_observers(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+
+        assert redsys._timed("get_form") is NULL_TIMER
+
+    def test_get_form_events(self):
+        events = []
+        redsys = RedsysProvider(**DEFAULT_CONFIG, observers=[events.append])
+
+        redsys.get_form(self.payment)
+
+        assert [event.operation for event in events] == [
+            "compute_signature",
+            "encode_redsys_request",
+            "get_form",
+        ]
+        assert events[-1].payment == self.payment
+        assert all(event.duration > 0 for event in events)
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    def test_process_data_event(self):
+        events = []
+        redsys = RedsysProvider(**DEFAULT_CONFIG, observers=[events.append])
+        request = RequestFactory().post(
+            "/",
+            data={
+                "Ds_SignatureVersion": "HMAC_SHA256_V1",
+                "Ds_MerchantParameters": encode_response(
+                    redsys_response_factory()
+                ).decode(),
+                "Ds_Signature": "...",
+            },
+        )
+
+        redsys.process_data(self.payment, request)
+
+        assert events[-1].operation == "process_data"
+        assert events[-1].response_code == "0000"
+        assert events[-2].operation == "validate_and_parse_response"
+        assert events[-2].response_code == "0000"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_event_with_error(self, post):
+        post.return_value.content = refund_response_content("0190")
+        observer = Mock()
+        redsys = RedsysProvider(
+            **DEFAULT_CONFIG,
+            observers=["payments_redsys.instrumentation.logging_observer"],
+        )
+        redsys.add_observer(observer)
+
+        with self.assertRaises(Exception):
+            redsys.refund(self.payment, Decimal("1.0"))
+
+        event = observer.call_args_list[-1].args[0]
+        assert event.operation == "refund"
+        assert event.response_code == "0190"
+        assert event.error is not None
+
+    def test_failing_observer_is_ignored(self):
+        redsys = RedsysProvider(
+            **DEFAULT_CONFIG, observers=[Mock(side_effect=KeyError)]
+        )
+
+        redsys.get_form(self.payment)
+
+
+def test_signal_observer():
+    receiver = Mock()
+    operation_finished.connect(receiver)
+    event = OperationEvent("get_form", 0.1, RedsysProvider(**DEFAULT_CONFIG))
+
+    try:
+        signal_observer(event)
+    finally:
+        operation_finished.disconnect(receiver)
+
+    assert receiver.call_args.kwargs["event"] is event
+    assert receiver.call_args.kwargs["sender"] is RedsysProvider
@@ -0,0 +1,126 @@
+import json
+import logging
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+import pytest
+from django.test import RequestFactory, TestCase
+from payments import get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.logs import LogSampler, Redacted, redact
+from payments_redsys.test_redsys import signed_notification
+from payments_redsys.test_redsys import DEFAULT_CONFIG
+
+
+def test_redact():
+    data = {
+        "DS_MERCHANT_ORDER": "SMPL000001",
+        "DS_MERCHANT_PAN": "4548812049400004",
+        "Ds_Merchant_Cvv2": "123",
+        "Ds_Card_Number": "454881******0003",
+        "Ds_Signature": "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8=",
+        "Ds_MerchantParameters": "eyJEc19PcmRlciI6ICJTTVBMMDAwMDAxIn0=",
+    }
+
+    assert redact(data) == {
+        "DS_MERCHANT_ORDER": "SMPL000001",
+        "DS_MERCHANT_PAN": "************0004",
+        "Ds_Merchant_Cvv2": "[redacted]",
+        "Ds_Card_Number": "************0003",
+        "Ds_Signature": "[redacted]",
+        "Ds_MerchantParameters": "[36 characters]",
+    }
+    assert data["DS_MERCHANT_PAN"] == "4548812049400004"
+
+
+def test_redacted_is_formatted_lazily():
+    data = Mock(wraps={"Ds_Signature": "abc"})
+    logger = logging.getLogger("payments_redsys.test")
+    logger.setLevel(logging.WARNING)
+
+    logger.info("%s", Redacted(data))
+    data.items.assert_not_called()
+
+    assert json.loads(str(Redacted(data))) == {"Ds_Signature": "[redacted]"}
+
+
+def test_log_sampler():
+    assert LogSampler(1)() is True
+    assert LogSampler(0)() is False
+    with patch("payments_redsys.logs.random.random", return_value=0.3):
+        assert LogSampler(0.5)() is True
+        assert LogSampler(0.2)() is False
+    with pytest.raises(ValueError):
+        LogSampler(1.5)
+
+
+class TestNotificationLogging(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+
+    def process(self, redsys, data):
+        return redsys.process_data(self.payment, RequestFactory().post("/", data))
+
+    def test_success_logged_redacted(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+        data = signed_notification(redsys, redsys.get_order_number(self.payment))
+
+        with self.assertLogs("payments_redsys", logging.INFO) as logs:
+            self.process(redsys, data)
+
+        [record] = logs.records
+        assert record.redsys_payment == self.payment.pk
+        assert record.redsys_response == 0
+        assert "454881******0003" not in record.getMessage()
+        assert record.redsys_fields.as_dict()["Ds_Card_Number"] == "************0003"
+
+    def test_success_sampled_out(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, notification_log_sample_rate=0)
+        data = signed_notification(redsys, redsys.get_order_number(self.payment))
+
+        with self.assertNoLogs("payments_redsys", logging.INFO):
+            self.process(redsys, data)
+
+    def test_failure_always_logged(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, notification_log_sample_rate=0)
+        data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), Ds_Response="0190"
+        )
+
+        with self.assertLogs("payments_redsys", logging.INFO) as logs:
+            self.process(redsys, data)
+
+        [record] = logs.records
+        assert record.redsys_response == 190
+        assert "Ds_Response was 190" in record.getMessage()
+
+    def test_invalid_notification_logged_redacted(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+        data = {"Ds_Signature": "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8="}
+
+        with self.assertLogs("payments_redsys", logging.WARNING) as logs:
+            self.process(redsys, data)
+
+        assert logs.records[0].getMessage() == (
+            f"payment {self.payment.pk}: invalid notification"
+            ' {"Ds_Signature": "[redacted]"}'
+        )
+
+    def test_request_debug_log_redacted(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+
+        with self.assertLogs("payments_redsys", logging.DEBUG) as logs:
+            redsys.encode_redsys_request(
+                "SMPL000001",
+                {
+                    "DS_MERCHANT_ORDER": "SMPL000001",
+                    "DS_MERCHANT_PAN": "4548812049400004",
+                },
+            )
+
+        assert "4548812049400004" not in logs.output[0]
+        assert "************0004" in logs.output[0]
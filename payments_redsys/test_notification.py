@@ -0,0 +1,61 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from payments_redsys.notification import RedsysNotification
+from payments_redsys.test_redsys import encode_response, redsys_response_factory
+
+
+@pytest.fixture
+def notification():
+    return RedsysNotification.from_merchant_parameters(
+        encode_response(redsys_response_factory())
+    )
+
+
+def test_typed_fields(notification):
+    assert notification.response == 0
+    assert notification.amount == 500
+    assert notification.currency == "978"
+    assert notification.order == "REDSYS=TEST:000066"
+    assert notification.transaction_type == "0"
+    assert notification.authorisation_code == "123337"
+    assert notification.merchant_code == "999008881"
+    assert notification.terminal == "001"
+    assert notification.date == "20/04/2025"
+    assert notification.hour == "13:55"
+
+
+def test_mapping_of_raw_fields(notification):
+    assert notification["Ds_Response"] == "0000"
+    assert notification.get("Ds_Card_Brand") == "1"
+    assert notification.get("Ds_Missing") is None
+    assert dict(notification) == redsys_response_factory()
+
+
+def test_extra_data_is_the_original_json(notification):
+    assert json.loads(notification.extra_data) == redsys_response_factory()
+    assert notification.extra_data == json.dumps(redsys_response_factory())
+
+
+def test_missing_and_invalid_fields():
+    notification = RedsysNotification({"Ds_Response": "abc"})
+
+    assert notification.response is None
+    assert notification.amount is None
+    assert notification.date is None
+    assert json.loads(notification.extra_data) == {"Ds_Response": "abc"}
+
+
+def test_without_orjson():
+    with patch("payments_redsys.notification.json_loads", json.loads):
+        notification = RedsysNotification.from_merchant_parameters(
+            encode_response(redsys_response_factory())
+        )
+
+    assert notification.response == 0
+
+
+def test_has_no_instance_dict(notification):
+    assert not hasattr(notification, "__dict__")
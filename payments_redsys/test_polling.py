@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import Mock
+
+from django.test import TestCase
+from django.utils import timezone
+from payments import get_payment_model
+
+from payments_redsys import QueryResult
+from payments_redsys.polling import RateLimiter, poll_waiting_payments
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(200)
+
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+
+    # the first call goes through at once, the others wait 5ms each
+    assert time.monotonic() - start >= 0.02
+
+
+class TestPollWaitingPayments(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Payment = get_payment_model()
+        cls.payments = [
+            Payment.objects.create(total=Decimal("10.0"), variant="redsys")
+            for _ in range(5)
+        ]
+        Payment.objects.create(total=Decimal("10.0"), variant="other")
+        Payment.objects.create(
+            total=Decimal("10.0"), variant="redsys", status="confirmed"
+        )
+        Payment.objects.filter(pk__lt=cls.payments[-1].pk).update(
+            modified=timezone.now() - timedelta(hours=1)
+        )
+
+    def test_poll_waiting_payments(self):
+        provider = Mock()
+        provider.query_statuses.side_effect = lambda batch, *args: [
+            QueryResult(payment, "confirmed", "0000", None, None) for payment in batch
+        ]
+
+        results = list(poll_waiting_payments(provider, "redsys", batch_size=3))
+
+        # the last payment is not stale yet
+        assert [result.payment for result in results] == self.payments[:4]
+        assert [
+            len(call.args[0]) for call in provider.query_statuses.call_args_list
+        ] == [
+            3,
+            1,
+        ]
+
+    def test_poll_waiting_payments_limit(self):
+        provider = Mock()
+        provider.query_statuses.side_effect = lambda batch, *args: [
+            QueryResult(payment, "confirmed", "0000", None, None) for payment in batch
+        ]
+
+        results = list(poll_waiting_payments(provider, "redsys", batch_size=3, limit=2))
+
+        assert len(results) == 2
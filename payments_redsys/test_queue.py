@@ -0,0 +1,143 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+from payments import get_payment_model
+from payments.signals import status_changed
+
+from payments_redsys import RedsysProvider
+from payments_redsys.models import QueuedNotification
+from payments_redsys.queue import DatabaseNotificationQueue
+from payments_redsys.test_redsys import (
+    DEFAULT_CONFIG,
+    signed_notification,
+)
+
+
+class TestNotificationQueue(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+
+    def setUp(self):
+        self.redsys = RedsysProvider(**DEFAULT_CONFIG, notification_queue="database")
+        self.factory = RequestFactory()
+        receiver = Mock()
+        status_changed.connect(receiver)
+        self.addCleanup(status_changed.disconnect, receiver)
+        self.status_changed = receiver
+
+    def process(self, **fields):
+        data = signed_notification(
+            self.redsys, self.redsys.get_order_number(self.payment), **fields
+        )
+        return self.redsys.process_data(self.payment, self.factory.post("/", data))
+
+    def drain(self):
+        return self.redsys.notification_queue.drain(self.redsys.apply_notification)
+
+    def test_process_data_enqueues(self):
+        with self.assertNumQueries(1):
+            result = self.process()
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/success"
+        self.status_changed.assert_not_called()
+        self.payment.refresh_from_db()
+        assert self.payment.status == "waiting"
+        queued = QueuedNotification.objects.get()
+        assert queued.order_number == "SMPL000001"
+        assert queued.notification.response == 0
+
+        assert self.drain() == 1
+
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+        self.status_changed.assert_called_once()
+        queued.refresh_from_db()
+        assert queued.processed_at is not None
+        assert self.drain() == 0
+
+    def test_rejected_notification(self):
+        result = self.process(Ds_Response="0190")
+        self.drain()
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/failure"
+        self.payment.refresh_from_db()
+        assert self.payment.status == "rejected"
+
+    async def test_aprocess_data_enqueues(self):
+        data = signed_notification(
+            self.redsys, self.redsys.get_order_number(self.payment)
+        )
+
+        await self.redsys.aprocess_data(self.payment, self.factory.post("/", data))
+
+        assert await QueuedNotification.objects.filter(
+            payment_id=self.payment.pk
+        ).aexists()
+
+    def test_failed_notifications_are_retried(self):
+        queue = DatabaseNotificationQueue(max_attempts=2, retry_delay=60)
+        self.process()
+        handler = Mock(side_effect=ValueError("boom"))
+        now = timezone.now()
+
+        assert queue.drain(handler) == 1
+        # not retried before the delay
+        assert queue.drain(handler) == 0
+        with patch(
+            "django.utils.timezone.now", return_value=now + timedelta(minutes=2)
+        ):
+            assert queue.drain(handler) == 1
+        with patch("django.utils.timezone.now", return_value=now + timedelta(days=1)):
+            assert queue.drain(handler) == 0
+
+        queued = QueuedNotification.objects.get()
+        assert queued.attempts == 2
+        assert queued.processed_at is None
+        assert "boom" in queued.last_error
+
+    def test_claimed_notifications_are_skipped(self):
+        queue = DatabaseNotificationQueue(claim_timeout=300)
+        self.process()
+        now = timezone.now()
+
+        # a worker that died after claiming the notification
+        assert len(queue.claim()) == 1
+        assert queue.drain(Mock()) == 0
+        handler = Mock()
+        with patch(
+            "django.utils.timezone.now", return_value=now + timedelta(minutes=10)
+        ):
+            assert queue.drain(handler) == 1
+
+        handler.assert_called_once()
+        queued = QueuedNotification.objects.get()
+        assert queued.attempts == 2
+        assert queued.processed_at is not None
+
+    def test_command(self):
+        self.process()
+        self.process(Ds_Response="0190")
+
+        with (
+            patch(
+                "payments_redsys.management.commands.redsys_process_notifications"
+                ".provider_factory",
+                return_value=self.redsys,
+            ),
+            patch("payments_redsys.queue.provider_factory", return_value=self.redsys),
+        ):
+            call_command(
+                "redsys_process_notifications", "--batch-size=1", stdout=Mock()
+            )
+
+        assert not QueuedNotification.objects.filter(processed_at=None).exists()
+        self.payment.refresh_from_db()
+        # notifications are applied in the order they arrived
+        assert self.payment.status == "rejected"
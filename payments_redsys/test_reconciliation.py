@@ -0,0 +1,139 @@
+import io
+import os
+import tempfile
+from decimal import Decimal
+
+import pytest
+from django.core.management import call_command
+from django.test import TestCase
+from payments import get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.reconciliation import (
+    Mismatch,
+    parse_amount,
+    parse_response,
+    read_report,
+    reconcile,
+)
+from payments_redsys.test_redsys import DEFAULT_CONFIG
+
+REPORT = """Fecha;Número de pedido;Tipo operación;Importe;Moneda;Código de respuesta
+20/04/2025 13:55;SMPL000001;Autorización;10,00;EUR;0000
+20/04/2025 13:56;SMPL000002;Autorización;12,00;EUR;0000
+20/04/2025 13:57;SMPL000003;Autorización;7,50;EUR;0190 Denegada
+20/04/2025 13:58;SMPL000004;Autorización;5,00;USD;0000
+20/04/2025 13:59;SMPL000099;Autorización;1,00;EUR;0000
+21/04/2025 10:00;SMPL000005;Autorización;20,00;EUR;0000
+21/04/2025 10:01;SMPL000005;Devolución;20,00;EUR;0900
+"""
+
+
+@pytest.mark.parametrize(
+    "value,amount",
+    [
+        ("10,00", Decimal("10.00")),
+        ("1.234,56", Decimal("1234.56")),
+        ("1234.56", Decimal("1234.56")),
+        ("n/a", None),
+    ],
+)
+def test_parse_amount(value, amount):
+    assert parse_amount(value) == amount
+
+
+def test_parse_response():
+    assert parse_response("0000") == 0
+    assert parse_response("0190 Denegada") == 190
+    assert parse_response("") is None
+
+
+def test_read_report():
+    rows = list(read_report(io.StringIO(REPORT)))
+
+    assert len(rows) == 7
+    assert rows[0].line == 2
+    assert rows[0].order == "SMPL000001"
+    assert rows[0].amount == Decimal("10.00")
+    assert rows[0].currency == "978"
+    assert rows[0].response == 0
+    assert rows[0].transaction_type == "0"
+    assert rows[6].transaction_type == "3"
+
+
+def test_read_report_custom_columns():
+    report = "Ref,Total\nSMPL000001,10.00\n"
+
+    rows = list(
+        read_report(io.StringIO(report), ",", {"order": "Ref", "amount": "Total"})
+    )
+
+    assert rows[0].order == "SMPL000001"
+    assert rows[0].amount == Decimal("10.00")
+    assert rows[0].response is None
+
+
+def test_read_report_without_order_column():
+    with pytest.raises(ValueError):
+        list(read_report(io.StringIO("Fecha;Importe\n")))
+
+
+def test_read_empty_report():
+    with pytest.raises(ValueError, match="empty report"):
+        list(read_report(io.StringIO("")))
+
+
+class TestReconcile(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Payment = get_payment_model()
+        for pk, total, currency, status in [
+            (1, "10.00", "EUR", "confirmed"),
+            (2, "10.00", "EUR", "confirmed"),
+            (3, "7.50", "EUR", "confirmed"),
+            (4, "5.00", "EUR", "confirmed"),
+            (5, "20.00", "EUR", "refunded"),
+        ]:
+            Payment.objects.create(
+                pk=pk,
+                total=Decimal(total),
+                currency=currency,
+                variant="redsys",
+                status=status,
+            )
+        cls.redsys = RedsysProvider(**DEFAULT_CONFIG)
+
+    def test_reconcile(self):
+        rows = read_report(io.StringIO(REPORT))
+
+        with self.assertNumQueries(3):
+            mismatches = list(reconcile(self.redsys, rows, chunk_size=3))
+
+        assert mismatches == [
+            Mismatch(3, "SMPL000002", "amount", "12.00", "10.00"),
+            Mismatch(4, "SMPL000003", "status", "rejected", "confirmed"),
+            Mismatch(5, "SMPL000004", "currency", "840", "978"),
+            Mismatch(6, "SMPL000099", "missing", "SMPL000099", None),
+        ]
+
+    def test_command(self):
+        report = self.write_report(REPORT)
+        out, err = io.StringIO(), io.StringIO()
+
+        call_command(
+            "redsys_reconcile", report, "--chunk-size=2", stdout=out, stderr=err
+        )
+
+        lines = out.getvalue().splitlines()
+        assert lines[0] == "line,order,kind,redsys,payment"
+        assert len(lines) == 5
+        assert "6,SMPL000099,missing,SMPL000099," in lines
+        assert "amount=1, currency=1, missing=1, status=1" in err.getvalue()
+
+    def write_report(self, content):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".csv", delete=False, encoding="utf-8"
+        ) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+        return f.name
@@ -1,12 +1,20 @@
+import asyncio
 import base64
 import json
+import os
+import subprocess
+import sys
+import threading
 from decimal import Decimal
-from unittest.mock import MagicMock, Mock, patch
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
 import pytest
+import requests
+from django.core.exceptions import ImproperlyConfigured
 from django.test import RequestFactory, TestCase
 from hamcrest import assert_that, has_entries
-from payments import get_payment_model
+from payments import PaymentError, get_payment_model
+from payments.signals import status_changed
 
 from payments_redsys import RedsysProvider, compare_signatures, compute_signature
 from sample.models import Payment
@@ -60,6 +68,50 @@ def encode_response(redsys_response):
     return base64.b64encode(json.dumps(redsys_response).encode())
 
 
+def signed_notification(redsys, order_number, redsys_response=None, **fields):
+    """
+    POST data of a notification for order_number signed with redsys' secret,
+    by default a successful authorisation updated with fields
+    """
+    if redsys_response is None:
+        redsys_response = {
+            **redsys_response_factory(),
+            "Ds_Order": order_number,
+            **fields,
+        }
+    merchant_params = encode_response(redsys_response)
+    signature = compute_signature(order_number, merchant_params, redsys.shared_secret)
+    return {
+        "Ds_SignatureVersion": "HMAC_SHA256_V1",
+        "Ds_MerchantParameters": merchant_params.decode(),
+        "Ds_Signature": signature.decode(),
+    }
+
+
+def refund_response_content(response_code):
+    return json.dumps(
+        {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": encode_response(
+                {"Ds_Response": response_code}
+            ).decode(),
+            "Ds_Signature": "...",
+        }
+    ).encode("utf-8")
+
+
+def authorisation_response_content(response_code):
+    return json.dumps(
+        {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": encode_response(
+                {**redsys_response_factory(), "Ds_Response": response_code}
+            ).decode(),
+            "Ds_Signature": "...",
+        }
+    ).encode("utf-8")
+
+
 ExamplePayment = get_payment_model()
 
 
@@ -77,6 +129,14 @@ class TestRedsysProvider(TestCase):
             captured_amount=Decimal("5.0"),
         )
 
+    def setUp(self):
+        # charges need a new order number every time
+        self.charging_redsys = RedsysProvider(
+            **redsys_config(process_on_redirect=True),
+            order_number_allocator="database",
+            order_number_allocator_options={"prefix": "9"},
+        )
+
     def test_get_form(self):
         form = self.redsys.get_form(self.payment)
 
@@ -130,6 +190,24 @@ class TestRedsysProvider(TestCase):
             ),
         )
 
+    def test_get_form_cache(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, form_cache_size=8)
+
+        first = redsys.get_form(self.payment)
+        with patch("payments_redsys.Terminal.sign") as sign:
+            second = redsys.get_form(self.payment)
+        sign.assert_not_called()
+        self.payment.total = Decimal("12.0")
+        third = redsys.get_form(self.payment)
+
+        assert (
+            first.fields["Ds_Signature"].initial
+            == second.fields["Ds_Signature"].initial
+            != third.fields["Ds_Signature"].initial
+        )
+        assert redsys.form_cache.cache_info().hits == 1
+        assert redsys.form_cache.cache_info().misses == 2
+
     def test_process_data_success_get(self):
         self._process_data_success("get")
 
@@ -162,6 +240,152 @@ class TestRedsysProvider(TestCase):
         self.payment.refresh_from_db()
         assert self.payment.status == "confirmed"
 
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    async def test_aprocess_data_success(self):
+        redsys_response = redsys_response_factory()
+        merchant_params = encode_response(redsys_response)
+        request = self.factory.post(
+            "/",
+            data={
+                "Ds_SignatureVersion": "HMAC_SHA256_V1",
+                "Ds_MerchantParameters": merchant_params.decode(),
+                "Ds_Signature": "...",
+            },
+        )
+
+        result = await self.redsys.aprocess_data(self.payment, request)
+
+        assert result.status_code == 302
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/success"
+        await self.payment.arefresh_from_db()
+        assert self.payment.status == "confirmed"
+
+    def test_process_data_fast_notifications(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, fast_notifications=True)
+        data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), redsys_response_factory()
+        )
+        receiver = Mock()
+        status_changed.connect(receiver)
+        self.addCleanup(status_changed.disconnect, receiver)
+
+        with self.assertNumQueries(1):
+            result = redsys.process_data(self.payment, self.factory.post("/", data))
+        # a repeated notification does not change anything
+        payment = ExamplePayment.objects.get(pk=self.payment.pk)
+        with self.assertNumQueries(1):
+            redsys.process_data(payment, self.factory.post("/", data))
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/success"
+        receiver.assert_called_once()
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+        assert self.payment.captured_amount == Decimal("5.00")
+        assert self.payment.transaction_id == "123337"
+        assert json.loads(self.payment.extra_data)["Ds_Response"] == "0000"
+
+    def test_process_data_suppresses_duplicates(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, notification_store="memory")
+        data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), redsys_response_factory()
+        )
+        redsys.process_data(self.payment, self.factory.post("/", data))
+
+        with (
+            patch("payments_redsys.Terminal.sign") as sign,
+            patch.object(ExamplePayment, "change_status") as change_status,
+            self.assertNumQueries(0),
+        ):
+            result = redsys.process_data(self.payment, self.factory.get("/", data))
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/success"
+        sign.assert_not_called()
+        change_status.assert_not_called()
+        assert redsys.notification_store.stats()["suppressed"] == 1
+
+    def test_process_data_does_not_store_invalid_signatures(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, notification_store="memory")
+        data = {
+            **signed_notification(
+                redsys, redsys.get_order_number(self.payment), redsys_response_factory()
+            ),
+            "Ds_Signature": "forged",
+        }
+
+        with pytest.raises(PaymentError):
+            redsys.process_data(self.payment, self.factory.post("/", data))
+
+        assert redsys.notification_store.stats() == {"suppressed": 0, "size": 0}
+
+    def test_process_data_junk_merchant_parameters(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+        for merchant_parameters in ["abc", "bm90IGpzb24=", "WzEsMl0="]:
+            data = {
+                "Ds_SignatureVersion": "HMAC_SHA256_V1",
+                "Ds_MerchantParameters": merchant_parameters,
+                "Ds_Signature": "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8=",
+            }
+
+            with pytest.raises(PaymentError, match="signature mismatch"):
+                redsys.process_data(self.payment, self.factory.post("/", data))
+
+    def test_process_data_signed_junk_merchant_parameters(self):
+        # a JSON list, correctly signed
+        data = signed_notification(
+            RedsysProvider(**DEFAULT_CONFIG),
+            RedsysProvider(**DEFAULT_CONFIG).get_order_number(self.payment),
+            [1, 2],
+        )
+
+        with pytest.raises(PaymentError, match="invalid Ds_MerchantParameters"):
+            self.redsys.process_data(self.payment, self.factory.post("/", data))
+
+    async def test_aprocess_data_fast_notifications_rejected(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, fast_notifications=True)
+        redsys_response = redsys_response_factory()
+        redsys_response["Ds_Response"] = "0190"
+        data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), redsys_response
+        )
+
+        result = await redsys.aprocess_data(self.payment, self.factory.post("/", data))
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/failure"
+        await self.payment.arefresh_from_db()
+        assert self.payment.status == "rejected"
+        assert (
+            self.payment.message
+            == "Ds_Response was 190: Denied without a specific reason"
+        )
+
+    def test_process_data_fast_notifications_missing_fields(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, fast_notifications=True)
+
+        with self.assertNumQueries(0):
+            result = redsys.process_data(
+                self.payment, self.factory.post("/", {"Ds_Signature": "..."})
+            )
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/failure"
+
+    def test_process_data_response_outcomes(self):
+        redsys = RedsysProvider(
+            **DEFAULT_CONFIG,
+            response_outcomes={9915: (False, "cancelled", "Cancelled by user")},
+        )
+        redsys_response = redsys_response_factory()
+        redsys_response["Ds_Response"] = "9915"
+        data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), redsys_response
+        )
+
+        result = redsys.process_data(self.payment, self.factory.post("/", data))
+
+        assert result.url == f"http://localhost:8000/{self.payment.pk}/failure"
+        self.payment.refresh_from_db()
+        assert self.payment.status == "cancelled"
+        assert self.payment.message == "Ds_Response was 9915: Cancelled by user"
+
     @patch("payments_redsys.compare_signatures", Mock(return_value=True))
     def test_process_data_rejected(self):
         redsys_response = redsys_response_factory()
@@ -190,7 +414,7 @@ class TestRedsysProvider(TestCase):
         assert self.payment.status == "rejected"
 
     @patch("payments_redsys.compare_signatures", Mock(return_value=True))
-    @patch("payments_redsys.requests.post")
+    @patch("payments_redsys.rest.requests.Session.post")
     def test_refund_mock(self, post: MagicMock):
         post.return_value.content = json.dumps(
             {
@@ -213,8 +437,485 @@ class TestRedsysProvider(TestCase):
                 "Ds_MerchantParameters": "eyJEU19NRVJDSEFOVF9BTU9VTlQiOiAiNTAwIiwgIkRTX01FUkNIQU5UX0NVUlJFTkNZIjogIjk3OCIsICJEU19NRVJDSEFOVF9NRVJDSEFOVENPREUiOiAiOTk5MDA4ODgxIiwgIkRTX01FUkNIQU5UX09SREVSIjogIlNNUEwwMDAwMDEiLCAiRFNfTUVSQ0hBTlRfVEVSTUlOQUwiOiAiMDAxIiwgIkRTX01FUkNIQU5UX1RSQU5TQUNUSU9OVFlQRSI6ICIzIn0=",
                 "Ds_Signature": "audTCtmyZ758ilFlz8JfbNywKXE1hoHTs420jbhaScU=",
             },
+            timeout=(5.0, 30.0),
+        )
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_reuses_session(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0400")
+        redsys = RedsysProvider(**DEFAULT_CONFIG, rest_read_timeout=10)
+        session = redsys.rest_client.session
+
+        with patch("payments_redsys.compare_signatures", Mock(return_value=True)):
+            redsys.refund(self.payment, Decimal("1.0"))
+            redsys.refund(self.payment, Decimal("2.0"))
+
+        assert redsys.rest_client.session is session
+        assert post.call_count == 2
+        assert post.call_args.kwargs["timeout"] == (5.0, 10)
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_connection_error(self, post: MagicMock):
+        post.side_effect = requests.ConnectionError("connection refused")
+
+        with pytest.raises(PaymentError):
+            self.redsys.refund(self.payment, Decimal("1.0"))
+
+    def test_order_key_cache_shared_by_operations(self):
+        redsys = RedsysProvider(**DEFAULT_CONFIG, order_key_cache_size=16)
+        form = redsys.get_form(self.payment)
+        response = {
+            "Ds_MerchantParameters": form.fields["Ds_MerchantParameters"].initial,
+            "Ds_Signature": form.fields["Ds_Signature"].initial,
+        }
+
+        redsys.validate_and_parse_response(response, "SMPL000001")
+
+        assert redsys.order_key_cache.stats()["misses"] == 1
+        assert redsys.order_key_cache.stats()["hits"] == 1
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.httpx")
+    async def test_arefund_mock(self, httpx: MagicMock):
+        client = httpx.AsyncClient.return_value
+        client.post = AsyncMock()
+        client.post.return_value.content = refund_response_content("0400")
+        refund_amount = Decimal("5.0")
+        redsys = RedsysProvider(**DEFAULT_CONFIG)
+
+        result = await redsys.arefund(self.payment, refund_amount)
+
+        assert result == refund_amount
+        client.post.assert_awaited_once()
+        assert client.post.call_args.args == (
+            "https://sis-t.redsys.es:25443/sis/rest/trataPeticionREST",
         )
 
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_arefund_without_httpx(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0900")
+        refund_amount = Decimal("5.0")
+
+        result = await self.redsys.arefund(self.payment, refund_amount)
+
+        assert result == refund_amount
+        post.assert_called_once()
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_many(self, post: MagicMock):
+        other_payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"),
+            currency="EUR",
+            variant="redsys",
+            captured_amount=Decimal("20.0"),
+        )
+        responses = {
+            "SMPL000001": refund_response_content("0400"),
+            other_payment.order_number: json.dumps(
+                {"errorCode": "SIS0057", "errorCodeDescription": "amount too high"}
+            ).encode(),
+        }
+
+        def redsys_post(url, **kwargs):
+            params = base64.b64decode(kwargs["json"]["Ds_MerchantParameters"])
+            order = json.loads(params)["DS_MERCHANT_ORDER"]
+            return Mock(content=responses[order])
+
+        post.side_effect = redsys_post
+
+        results = self.redsys.refund_many(
+            [self.payment, other_payment], amounts=[Decimal("2.0"), None]
+        )
+
+        assert [result.payment for result in results] == [self.payment, other_payment]
+        assert results[0].amount == Decimal("2.0")
+        assert results[0].response_code == "0400"
+        assert results[0].error is None
+        assert results[1].amount is None
+        assert results[1].error_code == "SIS0057"
+        assert isinstance(results[1].error, PaymentError)
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_arefund_many(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0190")
+
+        results = await self.redsys.arefund_many([self.payment], concurrency=2)
+
+        assert len(results) == 1
+        assert results[0].amount is None
+        assert results[0].response_code == "0190"
+        assert results[0].error.code == "0190"
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_refund_many_malformed_responses(self, post: MagicMock):
+        post.side_effect = [
+            Mock(content=b"<html><body>502 Bad Gateway</body></html>"),
+            Mock(
+                content=json.dumps({"Ds_SignatureVersion": "HMAC_SHA256_V1"}).encode()
+            ),
+        ]
+
+        results = self.redsys.refund_many([self.payment, self.payment], concurrency=1)
+
+        assert len(results) == 2
+        assert all(isinstance(result.error, PaymentError) for result in results)
+        assert all(result.amount is None for result in results)
+
+    def test_refund_many_amounts_mismatch(self):
+        with pytest.raises(ValueError):
+            self.redsys.refund_many([self.payment], amounts=[])
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_capture(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0900")
+
+        amount = self.redsys.capture(self.payment, Decimal("7.5"))
+
+        assert amount == Decimal("7.5")
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_TRANSACTIONTYPE"] == "2"
+        assert params["DS_MERCHANT_AMOUNT"] == "750"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_payment_capture_and_release(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0900")
+        payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys", status="preauth"
+        )
+
+        payment.capture()
+
+        assert payment.status == "confirmed"
+        assert payment.captured_amount == Decimal("20.0")
+
+        post.return_value.content = refund_response_content("0400")
+        payment.status = "preauth"
+        payment.release()
+
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_TRANSACTIONTYPE"] == "9"
+        assert params["DS_MERCHANT_AMOUNT"] == "2000"
+        assert payment.status == "refunded"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_release_error(self, post: MagicMock):
+        post.return_value.content = json.dumps(
+            {"errorCode": "SIS0059", "errorCodeDescription": "no operation"}
+        ).encode()
+
+        with pytest.raises(PaymentError) as excinfo:
+            self.redsys.release(self.payment)
+
+        assert excinfo.value.code == "SIS0059"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_charge(self, post: MagicMock):
+        post.return_value.content = authorisation_response_content("0000")
+        payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys"
+        )
+
+        result = self.charging_redsys.charge(payment, "a1b2c3d4e5f6")
+
+        assert result.status == "confirmed"
+        assert result.response_code == "0000"
+        assert not result.challenge_required
+        payment.refresh_from_db()
+        assert payment.status == "confirmed"
+        assert post.call_args.args[0] == self.charging_redsys.endpoint_rest
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_IDENTIFIER"] == "a1b2c3d4e5f6"
+        assert params["DS_MERCHANT_TRANSACTIONTYPE"] == "0"
+        assert params["DS_MERCHANT_AMOUNT"] == "2000"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_charge_declined(self, post: MagicMock):
+        post.return_value.content = authorisation_response_content("0190")
+        payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys"
+        )
+
+        result = self.charging_redsys.charge(payment, "a1b2c3d4e5f6")
+
+        assert result.status == "rejected"
+        assert payment.message.startswith("Ds_Response was 190")
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_charge_challenge_falls_back_to_redirect(self, post: MagicMock):
+        post.return_value.content = authorisation_response_content("0195")
+        payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys"
+        )
+
+        result = self.charging_redsys.charge(payment, "a1b2c3d4e5f6")
+
+        assert result.challenge_required
+        assert result.status == "waiting"
+        payment.refresh_from_db()
+        assert payment.status == "waiting"
+        assert result.form.action == self.charging_redsys.endpoint_form
+        params = json.loads(
+            base64.b64decode(result.form.fields["Ds_MerchantParameters"].initial)
+        )
+        assert params["DS_MERCHANT_IDENTIFIER"] == "a1b2c3d4e5f6"
+        # the form doesn't reuse the charge's order number
+        charge_params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_ORDER"] != charge_params["DS_MERCHANT_ORDER"]
+
+    def test_charge_requires_an_order_number_allocator(self):
+        with pytest.raises(ImproperlyConfigured):
+            self.redsys.charge(self.payment, "a1b2c3d4e5f6")
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_charge_error(self, post: MagicMock):
+        post.return_value.content = json.dumps({"errorCode": "SIS0093"}).encode()
+        payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys"
+        )
+
+        with pytest.raises(PaymentError) as e:
+            self.charging_redsys.charge(payment, "unknown")
+
+        assert e.value.code == "SIS0093"
+        assert payment.status == "waiting"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_capture_many(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0900")
+        payments = [
+            ExamplePayment.objects.create(
+                total=Decimal(total), currency="EUR", variant="redsys"
+            )
+            for total in ("10.0", "20.0", "30.0")
+        ]
+
+        results = self.redsys.capture_many(
+            payments, amounts=[None, Decimal("15.0"), None], concurrency=2
+        )
+
+        assert [result.amount for result in results] == [
+            Decimal("10.0"),
+            Decimal("15.0"),
+            Decimal("30.0"),
+        ]
+        assert post.call_count == 3
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_arelease_many(self, post: MagicMock):
+        post.return_value.content = refund_response_content("0400")
+
+        results = await self.redsys.arelease_many([self.payment])
+
+        assert results[0].amount == Decimal("10.0")
+        assert results[0].response_code == "0400"
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_TRANSACTIONTYPE"] == "9"
+
+    def test_multiple_terminals(self):
+        redsys = RedsysProvider(
+            **DEFAULT_CONFIG,
+            terminals=[
+                {
+                    "merchant_code": "999008881",
+                    "terminal": "002",
+                    "shared_secret": "Mk9m98IfEblmPfrpsawt7BmxObt98Jev",
+                    "currency": "EUR",
+                }
+            ],
+        )
+        form = redsys.get_form(self.payment)
+        data = json.loads(
+            base64.b64decode(form.fields["Ds_MerchantParameters"].initial)
+        )
+        # notifications are verified with the secret of their Ds_Terminal
+        notification = {**redsys_response_factory(), "Ds_Terminal": "2"}
+        merchant_params = encode_response(notification)
+        signature = compute_signature(
+            "SMPL000001", merchant_params, "Mk9m98IfEblmPfrpsawt7BmxObt98Jev"
+        )
+
+        assert data["DS_MERCHANT_TERMINAL"] == "002"
+        assert (
+            form.fields["Ds_Signature"].initial
+            == compute_signature(
+                "SMPL000001",
+                form.fields["Ds_MerchantParameters"].initial.encode(),
+                "Mk9m98IfEblmPfrpsawt7BmxObt98Jev",
+            ).decode()
+        )
+        assert (
+            redsys.validate_and_parse_response(
+                {
+                    "Ds_MerchantParameters": merchant_params.decode(),
+                    "Ds_Signature": signature.decode(),
+                },
+                "SMPL000001",
+            ).terminal
+            == "2"
+        )
+        with pytest.raises(PaymentError):
+            redsys.validate_and_parse_response(
+                {
+                    "Ds_MerchantParameters": merchant_params.decode(),
+                    "Ds_Signature": compute_signature(
+                        "SMPL000001", merchant_params, DEFAULT_CONFIG["shared_secret"]
+                    ).decode(),
+                },
+                "SMPL000001",
+            )
+
+    def test_previous_shared_secrets(self):
+        old_secret = "Mk9m98IfEblmPfrpsawt7BmxObt98Jev"
+        redsys = RedsysProvider(
+            **{**DEFAULT_CONFIG, "shared_secret": old_secret},
+        )
+        old_data = signed_notification(
+            redsys, redsys.get_order_number(self.payment), redsys_response_factory()
+        )
+        rotated = RedsysProvider(**DEFAULT_CONFIG, previous_shared_secrets=[old_secret])
+        new_data = signed_notification(
+            rotated, rotated.get_order_number(self.payment), redsys_response_factory()
+        )
+        terminal = rotated.terminal_router.default
+
+        with patch("payments_redsys.Terminal.sign", wraps=terminal.sign) as sign:
+            rotated.validate_and_parse_response(new_data, "SMPL000001")
+            assert sign.call_count == 1
+            rotated.validate_and_parse_response(old_data, "SMPL000001")
+            assert sign.call_count == 3
+            # the secret that matched last is tried first
+            rotated.validate_and_parse_response(old_data, "SMPL000001")
+            assert sign.call_count == 4
+
+        assert terminal.matches == [1, 2]
+        with pytest.raises(PaymentError):
+            redsys.validate_and_parse_response(new_data, "SMPL000001")
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_query_status(self, post: MagicMock):
+        data = signed_notification(
+            self.redsys,
+            self.redsys.get_order_number(self.payment),
+            redsys_response_factory(),
+        )
+        post.return_value.content = json.dumps(data).encode()
+
+        status = self.redsys.query_status(self.payment)
+
+        assert status == "confirmed"
+        assert post.call_args.args == (
+            "https://sis-t.redsys.es:25443/sis/rest/consultaOperacionREST",
+        )
+        params = json.loads(
+            base64.b64decode(post.call_args.kwargs["json"]["Ds_MerchantParameters"])
+        )
+        assert params["DS_MERCHANT_ORDER"] == "SMPL000001"
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+        assert self.payment.captured_amount == Decimal("5.00")
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_query_status_error(self, post: MagicMock):
+        post.return_value.content = json.dumps(
+            {"errorCode": "SIS0054", "errorCodeDescription": "no operation"}
+        ).encode()
+
+        with pytest.raises(PaymentError) as excinfo:
+            self.redsys.query_status(self.payment)
+
+        assert excinfo.value.code == "SIS0054"
+        self.payment.refresh_from_db()
+        assert self.payment.status == "waiting"
+
+    @patch("payments_redsys.rest.requests.Session.post")
+    def test_query_statuses(self, post: MagicMock):
+        other_payment = ExamplePayment.objects.create(
+            total=Decimal("20.0"), currency="EUR", variant="redsys"
+        )
+        rejected = {**redsys_response_factory(), "Ds_Response": "0190"}
+        responses = {
+            "SMPL000001": json.dumps(
+                signed_notification(
+                    self.redsys, self.redsys.get_order_number(self.payment), rejected
+                )
+            ).encode(),
+            other_payment.order_number: requests.ConnectionError("refused"),
+        }
+
+        def redsys_post(url, **kwargs):
+            params = base64.b64decode(kwargs["json"]["Ds_MerchantParameters"])
+            response = responses[json.loads(params)["DS_MERCHANT_ORDER"]]
+            if isinstance(response, Exception):
+                raise response
+            return Mock(content=response)
+
+        post.side_effect = redsys_post
+
+        results = self.redsys.query_statuses(
+            [self.payment, other_payment], concurrency=2, max_rate=1000
+        )
+
+        assert [result.payment for result in results] == [self.payment, other_payment]
+        assert results[0].status == "rejected"
+        assert results[0].response_code == "0190"
+        assert results[0].error is None
+        assert results[1].status is None
+        assert isinstance(results[1].error, PaymentError)
+        self.payment.refresh_from_db()
+        assert self.payment.status == "rejected"
+
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_aquery_status(self, post: MagicMock):
+        data = signed_notification(
+            self.redsys,
+            self.redsys.get_order_number(self.payment),
+            redsys_response_factory(),
+        )
+        post.return_value.content = json.dumps(data).encode()
+
+        status = await self.redsys.aquery_status(self.payment)
+
+        assert status == "confirmed"
+        await self.payment.arefresh_from_db()
+        assert self.payment.status == "confirmed"
+
+    @patch("payments_redsys.compare_signatures", Mock(return_value=True))
+    @patch("payments_redsys.rest.httpx", None)
+    @patch("payments_redsys.rest.requests.Session.post")
+    async def test_acharge(self, post: MagicMock):
+        post.return_value.content = authorisation_response_content("0000")
+
+        result = await self.charging_redsys.acharge(self.payment, "a1b2c3d4e5f6")
+
+        assert result.status == "confirmed"
+        await self.payment.arefresh_from_db()
+        assert self.payment.status == "confirmed"
+
     @pytest.mark.skip("Can only test manually with a prior valid order number")
     def test_refund_live(self):
         amount = self.redsys.refund(self.payment, Decimal("5"))
@@ -232,4 +933,74 @@ def test_compute_signature():
 
 
 def test_compare_signature():
-    assert compare_signatures("12+34g-fpfw!!!", "1234gfpfw") is True
+    signature = "wuXHYUdAckv3mxYaIR63CL7bJrY/dx7r+MnxCcSMaP8="
+    urlsafe = "wuXHYUdAckv3mxYaIR63CL7bJrY_dx7r-MnxCcSMaP8"
+
+    assert compare_signatures(signature, signature) is True
+    assert compare_signatures(signature, urlsafe) is True
+    assert compare_signatures(signature.encode(), urlsafe) is True
+    assert compare_signatures(signature, signature.replace("wuX", "wuY")) is False
+    assert compare_signatures(signature, signature[:-8]) is False
+    assert compare_signatures(signature, "not base64!") is False
+    assert compare_signatures(signature, "ñ") is False
+    assert compare_signatures(signature, signature + "!!!") is False
+    assert compare_signatures(signature, signature[:4] + " " + signature[4:]) is False
+
+
+def test_import_is_lazy():
+    # the REST client, the 3DES libraries and the forms load on first use
+    lazy_modules = ["requests", "pyDes", "cryptography", "payments.forms"]
+    code = (
+        "import sys, payments_redsys; "
+        f"print([m for m in {lazy_modules!r} if m in sys.modules])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": "sample.settings"},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    assert output.strip() == "[]"
+
+
+def test_response_form_fields():
+    from payments_redsys import NOTIFICATION_FIELDS, RedsysResponseForm
+
+    assert {
+        name: field.max_length for name, field in RedsysResponseForm.base_fields.items()
+    } == NOTIFICATION_FIELDS
+
+
+def test_async_client_of_another_loop_is_closed():
+    from payments_redsys.rest import RedsysRestClient
+
+    client = RedsysRestClient("https://sis-t.redsys.es:25443")
+
+    async def get_client():
+        return client._get_async_client()
+
+    old_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=old_loop.run_forever)
+    thread.start()
+    try:
+        old = asyncio.run_coroutine_threadsafe(get_client(), old_loop).result()
+
+        async def use_and_close():
+            new = await get_client()
+            await client.aclose()
+            return new
+
+        new = asyncio.run(use_and_close())
+        # the old client is closed on its own loop
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.01), old_loop).result()
+    finally:
+        old_loop.call_soon_threadsafe(old_loop.stop)
+        thread.join()
+        old_loop.close()
+
+    assert old is not new
+    assert old.is_closed
+    assert new.is_closed
+    assert client._async_client is None
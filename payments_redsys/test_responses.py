@@ -0,0 +1,66 @@
+import pytest
+
+from payments_redsys.responses import (
+    RESPONSE_DESCRIPTIONS,
+    ResponseDispatcher,
+    ResponseOutcome,
+    describe,
+)
+
+
+@pytest.mark.parametrize(
+    "response_code,transaction_type,success,status",
+    [
+        (0, "0", True, "confirmed"),
+        (99, "0", True, "confirmed"),
+        (0, "1", True, "preauth"),
+        (0, "2", True, "confirmed"),
+        (900, "2", True, "confirmed"),
+        (900, "3", True, "refunded"),
+        (400, "9", True, "refunded"),
+        (900, "0", True, None),
+        (100, "0", False, "rejected"),
+        (190, "0", False, "rejected"),
+        (9915, "0", False, "rejected"),
+        (4321, "0", False, "rejected"),  # not in the catalogue
+        (190, "1", False, "rejected"),
+        # declined operations leave the payment as it was
+        (950, "3", False, None),
+        (190, "2", False, None),
+        (909, "9", False, None),
+        (4321, "3", False, None),
+        (0, "Z", True, None),  # unknown transaction type
+    ],
+)
+def test_default_outcomes(response_code, transaction_type, success, status):
+    outcome = ResponseDispatcher().resolve(response_code, transaction_type)
+
+    assert outcome.success is success
+    assert outcome.status == status
+
+
+def test_table_covers_catalogue():
+    dispatcher = ResponseDispatcher()
+
+    assert (116, "0") in dispatcher.table
+    assert dispatcher.resolve(116, "0").reason == "Insufficient funds"
+    assert len(dispatcher.table) == len(RESPONSE_DESCRIPTIONS) * 5
+
+
+def test_overrides():
+    dispatcher = ResponseDispatcher(
+        {
+            9915: (False, "cancelled", "Cancelled by the customer"),
+            (0, "1"): ResponseOutcome(True, "confirmed", "Captured on authorisation"),
+        }
+    )
+
+    assert dispatcher.resolve(9915, "0").status == "cancelled"
+    assert dispatcher.resolve(9915, "X").status == "cancelled"
+    assert dispatcher.resolve(0, "1").status == "confirmed"
+    assert dispatcher.resolve(0, "0").status == "confirmed"
+
+
+def test_describe():
+    assert describe(190) == "Denied without a specific reason"
+    assert describe(4321) == "Unknown response code"
@@ -0,0 +1,154 @@
+import io
+import json
+from decimal import Decimal
+from unittest.mock import Mock, patch
+from urllib.parse import urlencode, urlsplit
+
+from django.test import RequestFactory, TestCase
+from payments import get_payment_model
+
+from payments_redsys import RedsysProvider
+from payments_redsys.simulator import RedsysSimulator
+from payments_redsys.test_redsys import DEFAULT_CONFIG
+
+SIMULATOR_URL = "http://simulator.test"
+
+
+def call(app, url, body=b"", content_type="application/json"):
+    """Calls a WSGI app, returning (status, headers, body)"""
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": urlsplit(url).path,
+        "CONTENT_TYPE": content_type,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    content = b"".join(app(environ, start_response))
+    return response["status"], response["headers"], content
+
+
+class TestRedsysSimulator(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.payment = get_payment_model().objects.create(
+            total=Decimal("10.0"), currency="EUR", variant="redsys"
+        )
+
+    def setUp(self):
+        self.simulator = RedsysSimulator(DEFAULT_CONFIG["shared_secret"], seed=1)
+        self.redsys = RedsysProvider(**DEFAULT_CONFIG, environment=SIMULATOR_URL)
+        # REST requests from the provider go to the simulator
+        patcher = patch(
+            "payments_redsys.rest.requests.Session.post", side_effect=self.rest_post
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def rest_post(self, url, **kwargs):
+        body = json.dumps(kwargs["json"]).encode()
+        status, headers, content = call(self.simulator, url, body)
+        return Mock(status_code=int(status[:3]), content=content)
+
+    def pay(self):
+        """Submits the payment form, returning the notification sent back"""
+        form = self.redsys.get_form(self.payment)
+        data = {name: field.initial for name, field in form.fields.items()}
+        self.simulator.session = Mock()
+
+        status, headers, _ = call(
+            self.simulator,
+            form.action,
+            urlencode(data).encode(),
+            "application/x-www-form-urlencoded",
+        )
+
+        assert status == "302 Found"
+        self.simulator.session.post.assert_called_once()
+        url = self.simulator.session.post.call_args.args[0]
+        assert url == self.redsys.get_return_url(self.payment)
+        return headers["Location"], self.simulator.session.post.call_args.kwargs["data"]
+
+    def test_payment(self):
+        location, notification = self.pay()
+
+        request = RequestFactory().post("/", notification)
+        result = self.redsys.process_data(self.payment, request)
+
+        assert location == self.redsys.get_success_url(self.payment)
+        assert result.url == location
+        self.payment.refresh_from_db()
+        assert self.payment.status == "confirmed"
+        assert self.simulator.stats["authorised"] == 1
+
+    def test_declined_payment(self):
+        self.simulator.decline_rate = 1
+
+        location, notification = self.pay()
+        self.redsys.process_data(self.payment, RequestFactory().post("/", notification))
+
+        assert location == self.redsys.get_failure_url(self.payment)
+        self.payment.refresh_from_db()
+        assert self.payment.status == "rejected"
+
+    def test_invalid_signature(self):
+        form = self.redsys.get_form(self.payment)
+        data = {name: field.initial for name, field in form.fields.items()}
+        data["Ds_Signature"] = "forged"
+
+        status, _, content = call(
+            self.simulator,
+            form.action,
+            urlencode(data).encode(),
+            "application/x-www-form-urlencoded",
+        )
+
+        assert content.startswith(b"SIS0042")
+        assert self.simulator.stats["invalid_signature"] == 1
+
+    def test_invalid_json(self):
+        for url in (self.redsys.endpoint_rest, self.redsys.endpoint_query):
+            for body in (b"{not json", b"[1, 2]", b'"Ds_Signature"', b"\xff"):
+                status, _, content = call(self.simulator, url, body)
+
+                assert status == "200 OK"
+                assert json.loads(content) == {"errorCode": "SIS0007"}
+        assert self.simulator.stats["invalid_request"] == 8
+
+    def test_invalid_merchant_parameters(self):
+        for merchant_parameters in ("WzEsIDJd", "e30=", 1):  # [1, 2] and {}
+            body = json.dumps(
+                {"Ds_MerchantParameters": merchant_parameters, "Ds_Signature": "x"}
+            ).encode()
+
+            _, _, content = call(self.simulator, self.redsys.endpoint_rest, body)
+
+            assert json.loads(content) == {"errorCode": "SIS0042"}
+
+    def test_refund_and_query(self):
+        self.pay()
+
+        amount = self.redsys.refund(self.payment, Decimal("4.0"))
+        status = self.redsys.query_status(self.payment)
+
+        assert amount == Decimal("4.0")
+        assert status == "refunded"
+        assert self.simulator.stats["transaction_type_3"] == 1
+
+    def test_refund_unknown_order(self):
+        results = self.redsys.refund_many([self.payment], [Decimal("1.0")])
+
+        assert results[0].error_code == "SIS0054"
+
+    def test_error_rate(self):
+        self.simulator.error_rate = 1
+
+        results = self.redsys.refund_many([self.payment], [Decimal("1.0")])
+
+        assert results[0].error_code == "SIS9999"
+        assert self.simulator.stats["errors"] == 1
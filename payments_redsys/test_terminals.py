@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+
+from payments_redsys import compute_signature
+from payments_redsys.ciphers import OrderKeyCache
+from payments_redsys.terminals import Terminal, TerminalRouter
+
+SECRET = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+OTHER_SECRET = "Mk9m98IfEblmPfrpsawt7BmxObt98Jev"
+
+
+def make_router(attribute=None):
+    return TerminalRouter(
+        [
+            Terminal("999008881", "001", SECRET),
+            Terminal("999008881", "002", OTHER_SECRET, currency="840", key="us"),
+            Terminal("999008882", "001", OTHER_SECRET, key="outlet"),
+        ],
+        attribute=attribute,
+    )
+
+
+def test_sign():
+    terminal = Terminal("999008881", "001", SECRET)
+
+    assert terminal.sign("SMPL000001", b"payload") == compute_signature(
+        "SMPL000001", b"payload", SECRET
+    )
+    assert terminal.sign(
+        "SMPL000001", b"payload", OrderKeyCache()
+    ) == compute_signature("SMPL000001", b"payload", SECRET)
+
+
+def test_for_payment_by_currency():
+    router = make_router()
+
+    assert router.for_payment(SimpleNamespace(), "840").terminal == "002"
+    assert router.for_payment(SimpleNamespace(), "978") is router.default
+
+
+def test_for_payment_by_attribute():
+    router = make_router(attribute="storefront")
+
+    outlet = router.for_payment(SimpleNamespace(storefront="outlet"), "978")
+    unknown = router.for_payment(SimpleNamespace(storefront="other"), "840")
+
+    assert outlet.merchant_code == "999008882"
+    assert unknown.terminal == "002"  # falls back to the currency
+
+
+@pytest.mark.parametrize("terminal", ["1", "001", 1])
+def test_for_notification(terminal):
+    router = make_router()
+
+    assert router.for_notification("999008881", terminal) is router.default
+    assert router.for_notification("999008882", terminal).key == "outlet"
+    assert router.for_notification("999008883", terminal) is None
+    assert router.for_notification(None, terminal) is None
+
+
+def test_duplicate_terminal():
+    with pytest.raises(ValueError):
+        TerminalRouter(
+            [
+                Terminal("999008881", "001", SECRET),
+                Terminal("999008881", "1", OTHER_SECRET),
+            ]
+        )
+
+
+def test_verification_order():
+    terminal = Terminal("999008881", "001", SECRET, previous_secrets=[OTHER_SECRET])
+
+    assert list(terminal.verification_order()) == [0, 1]
+    terminal.record_match(1)
+    assert list(terminal.verification_order()) == [1, 0]
+    assert terminal.matches == [0, 1]
+    assert terminal.sign("SMPL000001", b"payload", secret_index=1) == (
+        compute_signature("SMPL000001", b"payload", OTHER_SECRET)
+    )
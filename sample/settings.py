@@ -19,6 +19,7 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     "django.forms",
     "payments",
+    "payments_redsys",
     "sample",
 ]
 
@@ -99,6 +100,8 @@ PAYMENT_VARIANTS = {
             "language": "002",  # english. Use 003 for catalan, 001 for spanish
             "currency": "EUR",
             "process_on_redirect": ENVIRONMENT == "dev",
+            # "test", "real" or the URL of payments_redsys.simulator
+            "environment": os.getenv("REDSYS_ENVIRONMENT", "test"),
         },
     )
 }